@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures how long the 'pycloud' command takes to start, for commands that
+should not need the AWS provisioners, and which of the slow to import
+dependencies (boto, paramiko, sultan) each of them ends up importing.
+
+    $ python benchmarks/import_time.py --repeat 10
+
+Every run happens in a fresh interpreter, with HOME pointing at a temporary
+directory so that the state of the real '~/.pycloud' is left alone.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import timeit
+
+HEAVY_MODULES = ['boto', 'paramiko', 'sultan']
+
+MARKER = '__pycloud_imported__'
+
+RUNNER = textwrap.dedent('''
+    import atexit, json, sys
+    atexit.register(lambda: sys.stderr.write('\\n%s' + json.dumps(
+        [m for m in %r if m in sys.modules]) + '\\n'))
+    from pycloud.core.cli import pycloud
+    sys.argv[0] = 'pycloud'
+    pycloud()
+''') % (MARKER, HEAVY_MODULES)
+
+DEBUG_PLAN = textwrap.dedent('''
+    ---
+    tasks:
+        - debug:
+            name: Say Hello
+            echo: Hello World
+''')
+
+
+def run(args, env):
+    '''
+    Runs 'pycloud <args>' once, returning the wall time it took, its exit
+    status and the heavy modules it imported.
+    '''
+    start = timeit.default_timer()
+    process = subprocess.Popen([sys.executable, '-c', RUNNER] + args, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    elapsed = timeit.default_timer() - start
+
+    imported = None
+    for line in stderr.decode('utf-8', 'replace').splitlines():
+        if line.startswith(MARKER):
+            imported = json.loads(line[len(MARKER):])
+    return elapsed, process.returncode, imported
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Runs per command. Default: 5')
+    options = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='pycloud-bench-')
+    try:
+        plan_path = os.path.join(home, 'debug_plan.yml')
+        with open(plan_path, 'w') as f:
+            f.write(DEBUG_PLAN)
+
+        env = dict(os.environ)
+        env['HOME'] = home
+        env['AWS_ACCESS_KEY'] = 'bench'
+        env['AWS_SECRET_KEY'] = 'bench'
+        src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+        env['PYTHONPATH'] = os.pathsep.join([src] + [p for p in [env.get('PYTHONPATH')] if p])
+
+        commands = [
+            ('python -c pass', None),
+            ('pycloud --help', ['--help']),
+            ('pycloud docs', ['docs']),
+            ('pycloud setup <debug plan>', ['setup', plan_path]),
+        ]
+
+        print('%-28s %10s %10s  %s' % ('command', 'min (ms)', 'median', 'imports'))
+        for label, args in commands:
+            timings = []
+            status, imported = 0, []
+            for _ in range(options.repeat):
+                if args == None:
+                    start = timeit.default_timer()
+                    subprocess.check_call([sys.executable, '-c', 'pass'], env=env)
+                    timings.append(timeit.default_timer() - start)
+                    continue
+                elapsed, status, imported = run(args, env)
+                timings.append(elapsed)
+
+            timings.sort()
+            notes = ', '.join(imported) if imported else '-'
+            if status != 0:
+                notes += ' (exit status %d)' % status
+            print('%-28s %10.1f %10.1f  %s' % (
+                label, timings[0] * 1000, timings[len(timings) // 2] * 1000, notes))
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
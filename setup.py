@@ -15,6 +15,7 @@ requirements = [
     'Click>=6.0',
     'boto>=2.49.0',
     'PyYAML>=3.0',
+    'cryptography>=3.0',
     'paramiko>=2.4.1',
     'sultan>=0.8.1'
 ]
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from pycloud.base import Base
+from pycloud.core.config import PyCloudConfig
+from pycloud.core.provisioners.base import GLOBAL_ARGS
+from pycloud.core.state import atomic_write
+
+STARTED = 'started'
+
+COMPLETED = 'completed'
+
+FAILED = 'failed'
+
+
+def fingerprint(slug, kwargs, version=None):
+    '''
+    Returns a hash of the resolved arguments (including defaults) a task
+    with Provisioner 'slug' runs with, and of the Provisioner's 'version',
+    leaving out the arguments PyCloud passes to every task.
+    '''
+    args = dict((arg, value) for arg, value in kwargs.items() if arg not in GLOBAL_ARGS)
+    encoded = json.dumps([slug, version, args], sort_keys=True, default=repr)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def plan_id(plan_path):
+    '''
+    Returns the name that the checkpoints and fingerprints of the plan at
+    'plan_path' are stored under.
+    '''
+    plan_path = os.path.abspath(plan_path)
+    digest = hashlib.sha256(plan_path.encode('utf-8')).hexdigest()[:16]
+    return '%s-%s' % (os.path.splitext(os.path.basename(plan_path))[0], digest)
+
+
+def task_keys(nodes):
+    '''
+    Returns the checkpoint key of every node, by index: the name of its
+    task, numbered if earlier tasks of the plan have the same name.
+    '''
+    seen = {}
+    keys = {}
+    for node in sorted(nodes, key=lambda node: node.index):
+        count = seen.get(node.name, 0)
+        seen[node.name] = count + 1
+        keys[node.index] = node.name if count == 0 else '%s#%d' % (node.name, count + 1)
+    return keys
+
+
+class CheckpointJournal(Base):
+    '''
+    Records, per plan, the progress of every task that was set up or torn
+    down: its status, the fingerprint of its arguments, and the state keys
+    it set (its outputs). Every record is a JSON encoded line that is synced
+    to disk before the task goes on, so the journal survives a crash.
+
+    The latest record of a task is the one that counts. Once the journal
+    holds more than 'compact_ratio' lines per task, it is rewritten with
+    only the latest records.
+    '''
+    DEFAULT_CHECKPOINT_DIR_PATH = os.path.join(PyCloudConfig.DEFAULT_CONFIG_DIR_PATH, 'checkpoints')
+
+    DEFAULT_COMPACT_RATIO = 4
+
+    def __init__(self, path, compact_ratio=None):
+
+        super(CheckpointJournal, self).__init__()
+        self.path = path
+        self.compact_ratio = compact_ratio if compact_ratio != None else CheckpointJournal.DEFAULT_COMPACT_RATIO
+        self.__lock = threading.Lock()
+        self.__records = None
+
+    @classmethod
+    def for_plan(cls, plan_path, checkpoint_dir=None):
+        '''
+        Returns the journal of the plan at 'plan_path'.
+        '''
+        checkpoint_dir = checkpoint_dir if checkpoint_dir != None else cls.DEFAULT_CHECKPOINT_DIR_PATH
+        return cls(os.path.join(checkpoint_dir, '%s.journal' % plan_id(plan_path)))
+
+    @property
+    def exists(self):
+
+        return os.path.exists(self.path)
+
+    def read(self):
+        '''
+        Returns the latest record of every task, and how many lines the
+        journal has.
+        '''
+        records = {}
+        lines = 0
+        if not self.exists:
+            return records, lines
+
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a crash in the middle of an append leaves a partial line
+                    self.logger.warning("Skipping corrupt entry in checkpoint journal '%s'." % self.path)
+                    continue
+                records[record['task']] = record
+        return records, lines
+
+    def load(self):
+        '''
+        Reads the journal, if it hasn't been, and returns the latest record
+        of every task.
+        '''
+        with self.__lock:
+            if self.__records == None:
+                self.__records, lines = self.read()
+                if lines > self.compact_ratio * max(1, len(self.__records)):
+                    self.compact()
+            return self.__records
+
+    def get(self, task):
+        '''
+        Returns the latest record of 'task', or None.
+        '''
+        return self.load().get(task)
+
+    def record(self, task, action, status, fingerprint=None, outputs=None, error=None):
+        '''
+        Durably appends a record for 'task'.
+        '''
+        record = {
+            'task': task,
+            'action': action,
+            'status': status,
+            'fingerprint': fingerprint,
+            'time': time.time(),
+        }
+        if outputs:
+            record['outputs'] = outputs
+        if error != None:
+            record['error'] = error
+        line = json.dumps(record, sort_keys=True, default=repr) + '\n'
+
+        self.load()
+        with self.__lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.__records[task] = json.loads(line)
+
+    def compact(self):
+        '''
+        Rewrites the journal with only the latest record of every task.
+        Called with the lock held.
+        '''
+        self.logger.debug("Compacting checkpoint journal '%s'." % self.path)
+        records = sorted(self.__records.values(), key=lambda record: record['time'])
+        atomic_write(self.path, ''.join(json.dumps(record, sort_keys=True) + '\n' for record in records))
+
+    def is_completed(self, task, fingerprint):
+        '''
+        Returns whether 'task' was last set up successfully, with arguments
+        matching 'fingerprint'.
+        '''
+        record = self.get(task)
+        return record != None and record['action'] == 'setup' and record['status'] == COMPLETED \
+            and record['fingerprint'] == fingerprint
+
+    def is_applied(self, task):
+        '''
+        Returns whether 'task' may have changed something that a teardown
+        has to undo: it was set up (even partially), and not torn down since.
+        '''
+        record = self.get(task)
+        if record == None:
+            return False
+        return not (record['action'] == 'teardown' and record['status'] == COMPLETED)
+
+
+class AppliedFingerprints(Base):
+    '''
+    The fingerprint every task of a plan was last set up with, kept in the
+    PyCloudConfig state under 'fingerprints:<plan id>'.
+    '''
+    def __init__(self, plan_id):
+
+        super(AppliedFingerprints, self).__init__()
+        self.key = 'fingerprints:%s' % plan_id
+        self.config = PyCloudConfig()
+
+    def get(self):
+        '''
+        Returns the applied fingerprints, by task.
+        '''
+        return dict(self.config.get(self.key) or {})
+
+    def set(self, task, fingerprint):
+
+        def set_fingerprint(fingerprints):
+            fingerprints = dict(fingerprints or {})
+            fingerprints[task] = fingerprint
+            return fingerprints
+        self.config.update(self.key, set_fingerprint)
+
+    def discard(self, task):
+
+        def discard_fingerprint(fingerprints):
+            fingerprints = dict(fingerprints or {})
+            fingerprints.pop(task, None)
+            return fingerprints
+        self.config.update(self.key, discard_fingerprint)
@@ -8,6 +8,8 @@ from pycloud.logger import configure_logger, get_logger, ALLOWED_LOG_LEVELS
 from pycloud.core.provisioners.plan_executor import PlanExecutor
 from pycloud.core.config import PyCloudConfig
 from pycloud.core.keypair_storage import KeyPairStorage
+from pycloud.core.metrics import Metrics
+from pycloud.core.tracing import Tracer
 
 logger = get_logger()
 
@@ -29,6 +31,25 @@ def validate_for_aws(access_key, secret_key):
         raise click.BadParameter('Secret Key is not set.')
 
 
+def run_traced(trace, metrics, func, **kwargs):
+    '''
+    Calls 'func(**kwargs)', and even if it fails, writes a timeline of the
+    spans it recorded to 'trace', and the metrics it recorded to 'metrics'
+    (when they are set).
+    '''
+    Metrics.reset()
+    if trace:
+        Tracer.enable()
+    try:
+        return func(**kwargs)
+    finally:
+        if trace:
+            Tracer.disable()
+            Tracer.export(trace)
+        if metrics:
+            Metrics.export(metrics)
+
+
 
 @click.group()
 @click.option('-l', '--log-level', envvar='PYCLOUD_LOG_LEVEL',
@@ -52,9 +73,23 @@ def pycloud(ctx, log_level):
               help='AWS Access Key. You can also set environment variable AWS_ACCESS_KEY.')
 @click.option('-s', '--secret-key', envvar='AWS_SECRET_KEY',
               help='AWS Secret Key. You can also set environment variable AWS_SECRET_KEY.')
+@click.option('-j', '--jobs', envvar='PYCLOUD_JOBS', type=click.IntRange(min=1), default=1,
+              help='Number of tasks that can run at the same time. Default: 1')
+@click.option('--resume', is_flag=True, default=False,
+              help='Skip the tasks that an earlier run completed with the same arguments.')
+@click.option('--changed-only', is_flag=True, default=False,
+              help='Only run the tasks whose arguments (or the ones of the tasks they depend on) '
+                   'changed since they were last set up.')
+@click.option('--dry-run', is_flag=True, default=False,
+              help='Show which tasks would run and which would be skipped, without changing anything.')
+@click.option('--trace', type=click.Path(dir_okay=False, writable=True),
+              help='Write a timeline of the run to this file, in the Chrome trace event format.')
+@click.option('--metrics', type=click.Path(dir_okay=False, writable=True),
+              help='Write the metrics of the run (AWS API calls, SSH connections and commands, SFTP bytes...) '
+                   'to this file, in the Prometheus text format if it ends with .prom, and as JSON otherwise.')
 @click.argument('plan', type=click.Path(exists=True))
 @click.pass_context
-def setup(ctx, access_key, secret_key, plan):
+def setup(ctx, access_key, secret_key, jobs, resume, changed_only, dry_run, trace, metrics, plan):
     '''
     Sets up the infrastructure as specified by the plan.
     '''
@@ -62,16 +97,28 @@ def setup(ctx, access_key, secret_key, plan):
     ctx.obj['AWS_ACCESS_KEY'] = access_key
     ctx.obj['AWS_SECRET_KEY'] = secret_key
     executor = PlanExecutor(plan, _globals=ctx.obj)
-    executor.setup()
+    run_traced(trace, metrics, executor.dry_setup if dry_run else executor.setup, jobs=jobs, resume=resume,
+               changed_only=changed_only)
 
 @pycloud.command()
 @click.option('-a', '--access-key', envvar='AWS_ACCESS_KEY',
               help='AWS Access Key. You can also set environment variable AWS_ACCESS_KEY.')
 @click.option('-s', '--secret-key', envvar='AWS_SECRET_KEY',
               help='AWS Secret Key. You can also set environment variable AWS_SECRET_KEY.')
+@click.option('-j', '--jobs', envvar='PYCLOUD_JOBS', type=click.IntRange(min=1), default=1,
+              help='Number of tasks that can be torn down at the same time. Default: 1')
+@click.option('--all', 'all_tasks', is_flag=True, default=False,
+              help='Also tear down the tasks that were never set up, according to the checkpoints of the plan.')
+@click.option('--dry-run', is_flag=True, default=False,
+              help='Show which tasks would be torn down and which would be skipped, without changing anything.')
+@click.option('--trace', type=click.Path(dir_okay=False, writable=True),
+              help='Write a timeline of the run to this file, in the Chrome trace event format.')
+@click.option('--metrics', type=click.Path(dir_okay=False, writable=True),
+              help='Write the metrics of the run (AWS API calls, SSH connections and commands, SFTP bytes...) '
+                   'to this file, in the Prometheus text format if it ends with .prom, and as JSON otherwise.')
 @click.argument('plan', type=click.Path(exists=True))
 @click.pass_context
-def teardown(ctx, access_key, secret_key, plan):
+def teardown(ctx, access_key, secret_key, jobs, all_tasks, dry_run, trace, metrics, plan):
     '''
     Tears down the infrastructure as specified by the plan.
     '''
@@ -79,7 +126,8 @@ def teardown(ctx, access_key, secret_key, plan):
     ctx.obj['AWS_ACCESS_KEY'] = access_key
     ctx.obj['AWS_SECRET_KEY'] = secret_key
     executor = PlanExecutor(plan, _globals=ctx.obj)
-    executor.teardown()
+    run_traced(trace, metrics, executor.dry_teardown if dry_run else executor.teardown, jobs=jobs,
+               all_tasks=all_tasks)
 
 @pycloud.command()
 @click.pass_context
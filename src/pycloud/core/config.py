@@ -1,19 +1,44 @@
+import contextlib
 import os
-import yaml
-from hashlib import md5 
+import threading
+from collections import OrderedDict
+from hashlib import md5
 
 from pycloud.base import Base
+from pycloud.core.metrics import Metrics
+from pycloud.core.state import JournalStateBackend, STATE_BACKENDS
 from pycloud.logger import get_logger
 
 logger = get_logger()
 
+STATE_LOADS = Metrics.counter('pycloud_state_loads_total', 'Times the state was read from its backend.')
+
+STATE_WRITES = Metrics.counter('pycloud_state_writes_total', 'Writes to the state backend.')
+
+STATE_CHANGES = Metrics.counter('pycloud_state_changes_total', 'Keys set or deleted in the state backend.')
+
+STATE_WRITE_SECONDS = Metrics.histogram('pycloud_state_write_seconds', 'How long writes to the state backend took.')
+
 class PyCloudConfig(Base):
 
     DEFAULT_CONFIG_DIR_PATH = os.path.expanduser('~/.pycloud')
     DEFAULT_CONFIG_FILE_PATH = os.path.join(DEFAULT_CONFIG_DIR_PATH, 'config.yml')
+    DEFAULT_STATE_JOURNAL_PATH = os.path.join(DEFAULT_CONFIG_DIR_PATH, 'state.journal')
+
+    # name of the 'STATE_BACKENDS' entry used to store the state, which can be
+    # overridden with the PYCLOUD_STATE_BACKEND environment variable.
+    DEFAULT_STATE_BACKEND = 'journal'
 
     STATE = None
-    
+
+    BACKEND = None
+
+    # guards STATE when tasks run on several threads at once
+    LOCK = threading.RLock()
+
+    # changes made inside 'batch()', which are kept per thread
+    PENDING = threading.local()
+
     @classmethod
     def initialize_state_mgmt(cls):
 
@@ -25,6 +50,37 @@ class PyCloudConfig(Base):
                 logger.info("Creating 'pycloud' config file: %s" % cls.DEFAULT_CONFIG_FILE_PATH)
                 f.write('{}')
 
+    @classmethod
+    def use_backend(cls, backend):
+        '''
+        Makes PyCloudConfig store its state with 'backend', an instance of
+        'pycloud.core.state.StateBackend'. The state is reloaded from it on
+        next use.
+        '''
+        with cls.LOCK:
+            cls.BACKEND = backend
+            cls.STATE = None
+
+    @classmethod
+    def get_backend(cls):
+        '''
+        Returns the configured state backend, creating the default one if
+        none has been configured.
+        '''
+        with cls.LOCK:
+            if cls.BACKEND == None:
+                name = os.environ.get('PYCLOUD_STATE_BACKEND', cls.DEFAULT_STATE_BACKEND)
+                if name not in STATE_BACKENDS:
+                    raise ValueError("Invalid State Backend provided: %s; Allowed: %s" % (
+                        name, sorted(STATE_BACKENDS.keys())))
+
+                if STATE_BACKENDS[name] == JournalStateBackend:
+                    cls.BACKEND = JournalStateBackend(
+                        cls.DEFAULT_STATE_JOURNAL_PATH, legacy_path=cls.DEFAULT_CONFIG_FILE_PATH)
+                else:
+                    cls.BACKEND = STATE_BACKENDS[name](cls.DEFAULT_CONFIG_FILE_PATH)
+            return cls.BACKEND
+
     # commenting out because hashing with task_name and generating a new key
     # doesn't allow me to share variables between different tasks.
     # ---------------------------
@@ -37,50 +93,116 @@ class PyCloudConfig(Base):
     #     m.update(task_name)
     #     return '%s_%s' % (m.hexdigest(), key)
 
+    def load(self):
+        '''
+        Loads PyCloudConfig.STATE from the state backend, if it hasn't been.
+        '''
+        with PyCloudConfig.LOCK:
+            if PyCloudConfig.STATE == None:
+                PyCloudConfig.STATE = PyCloudConfig.get_backend().load()
+                STATE_LOADS.inc()
+            return PyCloudConfig.STATE
+
+    @property
+    def pending_changes(self):
+
+        if not hasattr(PyCloudConfig.PENDING, 'changes'):
+            PyCloudConfig.PENDING.changes = None
+        return PyCloudConfig.PENDING.changes
+
+    @property
+    def pending_keys(self):
+        '''
+        Returns the keys changed inside the current 'batch()' of this
+        thread, in the order they were first changed.
+        '''
+        return list(OrderedDict((key, None) for _, key, _ in (self.pending_changes or [])).keys())
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Delays writing the changes made on this thread to the state backend
+        until the outermost 'batch()' block exits.
+        '''
+        outermost = self.pending_changes == None
+        if outermost:
+            PyCloudConfig.PENDING.changes = []
+        try:
+            yield self
+        finally:
+            if outermost:
+                self.flush()
+                PyCloudConfig.PENDING.changes = None
+
+    def record(self, op, key, value=None):
+
+        pending = self.pending_changes
+        if pending != None:
+            pending.append((op, key, value))
+        else:
+            self.write([(op, key, value)])
+
+    def write(self, changes):
+
+        with PyCloudConfig.LOCK:
+            self.logger.debug('Writing %d change(s) to the state backend.' % len(changes))
+            with STATE_WRITE_SECONDS.time():
+                PyCloudConfig.get_backend().write(changes, PyCloudConfig.STATE)
+            STATE_WRITES.inc()
+            STATE_CHANGES.inc(len(changes))
 
     def flush(self):
         '''
-        Writes the contents of PyCloudConfig.STATE to disk.
+        Writes the changes to PyCloudConfig.STATE that are waiting in a
+        'batch()' to disk.
         '''
-        self.logger.debug('Flushing contents to "%s"' % (PyCloudConfig.DEFAULT_CONFIG_FILE_PATH))
-        self.logger.debug('Contents: %s' % str(PyCloudConfig.STATE))
-        with open(PyCloudConfig.DEFAULT_CONFIG_FILE_PATH, 'w') as outfile:
-            yaml.dump(PyCloudConfig.STATE, outfile, default_flow_style=False)
+        pending = self.pending_changes
+        if not pending:
+            return
+
+        # only the latest value of every key is written, taken from STATE so
+        # that the backend ends up agreeing with it even if another thread
+        # changed the same key in the meantime.
+        with PyCloudConfig.LOCK:
+            changes = []
+            for key in self.pending_keys:
+                if key in PyCloudConfig.STATE:
+                    changes.append(('set', key, PyCloudConfig.STATE[key]))
+                else:
+                    changes.append(('delete', key, None))
+            self.write(changes)
+        del pending[:]
 
     def get(self, key):
         '''
         Gets the value for the given key.
         '''
-        if PyCloudConfig.STATE == None:
-            with open(PyCloudConfig.DEFAULT_CONFIG_FILE_PATH) as f:
-                try:
-                    
-                    PyCloudConfig.STATE = yaml.load(f)
-                except yaml.YAMLError as err:
-                    logger.exception("Unable to load YAML from file '%s'" % PyCloudConfig.DEFAULT_CONFIG_FILE_PATH)
-                    PyCloudConfig.STATE = {}
-        
-        # key = self.get_hash_key(task_name, key)
-        return PyCloudConfig.STATE.get(key)
+        with PyCloudConfig.LOCK:
+            # key = self.get_hash_key(task_name, key)
+            return self.load().get(key)
 
     def set(self, key, value):
         '''
         Sets the value to it's corresponding key.
         '''
-        if PyCloudConfig.STATE == None:
-            PyCloudConfig.STATE = {}
+        with PyCloudConfig.LOCK:
+            # key = self.get_hash_key(task_name, key)
+            self.load()[key] = value
+            self.record('set', key, value)
 
-        # key = self.get_hash_key(task_name, key)
-        PyCloudConfig.STATE[key] = value
-        self.flush()
+    def update(self, key, func):
+        '''
+        Sets the key to 'func(current_value)' in a single step that no other
+        thread or process can interleave with, and returns the new value.
+        '''
+        with PyCloudConfig.LOCK:
+            return PyCloudConfig.get_backend().update(self.load(), key, func)
 
     def delete(self, key):
         '''
         Deletes the Key from the Config file
         '''
-        if PyCloudConfig.STATE == None:
-            return
-
-        # key = self.get_hash_key(task_name, key)
-        del PyCloudConfig.STATE[key]
-        self.flush()
\ No newline at end of file
+        with PyCloudConfig.LOCK:
+            # key = self.get_hash_key(task_name, key)
+            del self.load()[key]
+            self.record('delete', key)
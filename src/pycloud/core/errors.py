@@ -2,3 +2,25 @@
 class InvalidPlanError(ValueError):
 
     pass
+
+
+class HostFailureError(RuntimeError):
+    '''
+    Raised when more hosts failed a per-host operation than the provisioner
+    was configured to tolerate.
+    '''
+    def __init__(self, message, results=None):
+
+        super(HostFailureError, self).__init__(message)
+        self.results = results
+
+
+class WaiterTimeoutError(RuntimeError):
+    '''
+    Raised when resources did not reach the state being waited for before
+    the deadline. 'pending' lists the ones that did not.
+    '''
+    def __init__(self, message, pending=None):
+
+        super(WaiterTimeoutError, self).__init__(message)
+        self.pending = pending
@@ -1,13 +1,52 @@
+import io
 import os
+import threading
+
 from pycloud.base import Base
+from pycloud.core.metrics import Metrics
 
 PYCLOUD_ROOT = os.path.expanduser('~/.pycloud')
 
-class KeyPairStorage(Base):
+# the paramiko key class names to try for each kind of PEM header, in order
+KEY_CLASS_NAMES = {
+    'RSA': ['RSAKey'],
+    'EC': ['ECDSAKey'],
+    'OPENSSH': ['Ed25519Key', 'ECDSAKey', 'RSAKey'],
+}
+
+PRIVATE_KEY_LOOKUPS = Metrics.counter('pycloud_private_key_lookups_total',
+                                      'Private keys asked for, by whether they were cached or parsed.',
+                                      label_names=['result'])
+
+PRIVATE_KEY_PARSE_SECONDS = Metrics.histogram('pycloud_private_key_parse_seconds', 'How long parsing private keys took.')
+
+
+class CachedKey(object):
+    '''
+    A parsed private key, and the inode and modification time of the file
+    it was parsed from.
+    '''
+    def __init__(self, key, inode, mtime):
+
+        self.key = key
+        self.inode = inode
+        self.mtime = mtime
 
 
+class KeyPairStorage(Base):
+    '''
+    The pem files of the EC2 key pairs PyCloud created, and the private keys
+    parsed from them. Parsed keys are cached (for every 'KeyPairStorage' of
+    the process) until the inode or modification time of their file
+    changes, so every SSH connection to a fleet does not parse the key again.
+    '''
     KEY_PAIR_DIR = os.path.join(PYCLOUD_ROOT, 'keypairs')
 
+    # parsed keys, by path
+    key_cache = {}
+
+    key_cache_lock = threading.Lock()
+
     @classmethod
     def initialize(cls):
 
@@ -43,16 +82,77 @@ class KeyPairStorage(Base):
 
     def save(self, keypair):
         '''
-        Saves the contents of the boto.ec2.KeyPair class to disk
+        Saves the contents of the boto.ec2.KeyPair class to disk, and caches
+        the key parsed from them.
         '''
         with open(self.path, 'wb') as f:
             f.write(keypair.material.encode('utf-8'))
         os.chmod(self.path, 0o600)
+        self.cache(self.parse(keypair.material))
 
     def delete(self):
         '''
         Deletes the pem file corresponding to this keypair.
         '''
+        with KeyPairStorage.key_cache_lock:
+            KeyPairStorage.key_cache.pop(self.path, None)
         if self.exists:
             os.remove(self.path)
+
+    @classmethod
+    def key_classes(cls, material):
+        '''
+        Returns the paramiko key classes the PEM encoded 'material' may hold,
+        most likely first.
+        '''
+        # imported here, so that commands that never connect to an instance
+        # do not pay for importing paramiko
+        import paramiko
+
+        for kind, names in KEY_CLASS_NAMES.items():
+            if '-----BEGIN %s PRIVATE KEY-----' % kind in material:
+                return [getattr(paramiko, name) for name in names]
+        return [paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key]
+
+    def parse(self, material):
+        '''
+        Returns the private key in the PEM encoded 'material', detecting its
+        type.
+        '''
+        import paramiko
+
+        error = None
+        for key_class in KeyPairStorage.key_classes(material):
+            try:
+                return key_class.from_private_key(io.StringIO(material))
+            except paramiko.SSHException as e:
+                error = e
+        raise paramiko.SSHException("Unable to parse the private key in '%s': %s" % (self.path, error))
+
+    def cache(self, key):
+
+        stat = os.stat(self.path)
+        with KeyPairStorage.key_cache_lock:
+            KeyPairStorage.key_cache[self.path] = CachedKey(key, stat.st_ino, stat.st_mtime_ns)
+
+    @property
+    def private_key(self):
+        '''
+        The paramiko key parsed from the pem file, only parsing the file
+        again when it was replaced or modified since it was last parsed.
+        '''
+        stat = os.stat(self.path)
+        with KeyPairStorage.key_cache_lock:
+            cached = KeyPairStorage.key_cache.get(self.path)
+        if cached != None and cached.inode == stat.st_ino and cached.mtime == stat.st_mtime_ns:
+            PRIVATE_KEY_LOOKUPS.inc(result='cached')
+            return cached.key
+
+        self.logger.debug("Parsing private key '%s'." % self.path)
+        PRIVATE_KEY_LOOKUPS.inc(result='parsed')
+        with open(self.path) as f, PRIVATE_KEY_PARSE_SECONDS.time():
+            key = self.parse(f.read())
+        with KeyPairStorage.key_cache_lock:
+            KeyPairStorage.key_cache[self.path] = CachedKey(key, stat.st_ino, stat.st_mtime_ns)
+        return key
     
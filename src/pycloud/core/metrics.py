@@ -0,0 +1,269 @@
+import bisect
+import contextlib
+import json
+import threading
+import time
+
+from pycloud.base import Base
+from pycloud.core.state import atomic_write
+
+# the upper bounds of the buckets latencies are counted in, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def format_labels(labels):
+    '''
+    Returns the labels in the Prometheus text format, like '{a="1",b="2"}'.
+    '''
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')) for name, value in labels)
+
+
+def format_value(value):
+
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    '''
+    A named measurement, with one value for every combination of the values
+    of its 'label_names' it was recorded with.
+    '''
+    type = None
+
+    def __init__(self, name, description, label_names=None):
+
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names if label_names != None else ())
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError("Metric '%s' takes the labels %s, not %s." % (
+                self.name, list(self.label_names), sorted(labels.keys())))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def labels_of(self, key):
+
+        return list(zip(self.label_names, key))
+
+    def reset(self):
+
+        with self.lock:
+            self.values = {}
+
+
+class Counter(Metric):
+    '''
+    Counts how often something happened (or how much of it, like bytes).
+    '''
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    @property
+    def total(self):
+
+        with self.lock:
+            return sum(self.values.values())
+
+    def to_dict(self):
+
+        with self.lock:
+            return [{'labels': dict(self.labels_of(key)), 'value': value}
+                    for key, value in sorted(self.values.items())]
+
+    def to_prometheus(self):
+
+        with self.lock:
+            return ['%s%s %s' % (self.name, format_labels(self.labels_of(key)), format_value(value))
+                    for key, value in sorted(self.values.items())]
+
+
+class HistogramValue(object):
+
+    def __init__(self, buckets):
+
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    '''
+    Counts observed values (like latencies, in seconds) in buckets by their
+    upper bound, along with how many there were and their sum.
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, description, label_names=None, buckets=None):
+
+        super(Histogram, self).__init__(name, description, label_names=label_names)
+        self.buckets = tuple(sorted(buckets if buckets != None else DEFAULT_BUCKETS))
+
+    def observe(self, value, **labels):
+
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = HistogramValue(self.buckets)
+            observed = self.values[key]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                observed.counts[index] += 1
+            observed.count += 1
+            observed.sum += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        '''
+        Observes how long the block takes, whether or not it raises.
+        '''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def get(self, **labels):
+        '''
+        Returns how many values were observed, and their sum.
+        '''
+        with self.lock:
+            observed = self.values.get(self.key(labels))
+            return (observed.count, observed.sum) if observed != None else (0, 0.0)
+
+    def cumulative(self, observed):
+        '''
+        Returns '(upper_bound, count)' for every bucket, where 'count' is how
+        many values were at most 'upper_bound', ending with '+Inf'.
+        '''
+        counts = []
+        total = 0
+        for upper_bound, count in zip(self.buckets, observed.counts):
+            total += count
+            counts.append((upper_bound, total))
+        counts.append((float('inf'), observed.count))
+        return counts
+
+    def to_dict(self):
+
+        with self.lock:
+            return [{
+                'labels': dict(self.labels_of(key)),
+                'count': observed.count,
+                'sum': round(observed.sum, 6),
+                'buckets': dict((format_value(upper_bound), count)
+                                for upper_bound, count in self.cumulative(observed)),
+            } for key, observed in sorted(self.values.items())]
+
+    def to_prometheus(self):
+
+        lines = []
+        with self.lock:
+            for key, observed in sorted(self.values.items()):
+                labels = self.labels_of(key)
+                for upper_bound, count in self.cumulative(observed):
+                    lines.append('%s_bucket%s %d' % (
+                        self.name, format_labels(labels + [('le', format_value(upper_bound))]), count))
+                lines.append('%s_sum%s %s' % (self.name, format_labels(labels), format_value(observed.sum)))
+                lines.append('%s_count%s %d' % (self.name, format_labels(labels), observed.count))
+        return lines
+
+
+class MetricsRegistry(Base):
+    '''
+    The counters and latency histograms that the parts of PyCloud talking
+    to AWS, to instances over SSH and to the state report into, so that a
+    run can be summarized by how many API calls, SSH connections, remote
+    commands and bytes it took.
+
+    Metrics are created on first use, and looking one up by name again
+    returns the same metric. The registry is written out as JSON, or in the
+    Prometheus text format (for the node exporter's textfile collector).
+    '''
+    def __init__(self):
+
+        super(MetricsRegistry, self).__init__()
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def register(self, metric_class, name, description, **kwargs):
+
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric == None:
+                metric = self.__metrics[name] = metric_class(name, description, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError("Metric '%s' is a %s, not a %s." % (name, metric.type, metric_class.type))
+            return metric
+
+    def counter(self, name, description, label_names=None):
+
+        return self.register(Counter, name, description, label_names=label_names)
+
+    def histogram(self, name, description, label_names=None, buckets=None):
+
+        return self.register(Histogram, name, description, label_names=label_names, buckets=buckets)
+
+    def get(self, name):
+
+        with self.__lock:
+            return self.__metrics.get(name)
+
+    @property
+    def metrics(self):
+
+        with self.__lock:
+            return [self.__metrics[name] for name in sorted(self.__metrics)]
+
+    def reset(self):
+        '''
+        Forgets the values recorded so far, keeping the metrics.
+        '''
+        for metric in self.metrics:
+            metric.reset()
+
+    def to_dict(self):
+
+        return dict((metric.name, {'type': metric.type, 'help': metric.description, 'values': metric.to_dict()})
+                    for metric in self.metrics)
+
+    def to_prometheus(self):
+
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.description))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.to_prometheus())
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        '''
+        Writes the metrics to 'path', in the Prometheus text format if it
+        ends with '.prom', and as JSON otherwise.
+        '''
+        if path.endswith('.prom'):
+            atomic_write(path, self.to_prometheus())
+        else:
+            atomic_write(path, json.dumps(self.to_dict(), indent=2, sort_keys=True))
+        self.logger.info("Wrote metrics to '%s'." % path)
+
+
+Metrics = MetricsRegistry()
@@ -0,0 +1,135 @@
+import hashlib
+import marshal
+import os
+import sys
+
+import pycloud
+from pycloud.base import Base
+from pycloud.core.config import PyCloudConfig
+from pycloud.core.state import atomic_write
+
+
+class ParsedPlanCache(Base):
+    '''
+    Keeps the parsed and validated form of the plans that have been run, so
+    that running the same plan again skips parsing its YAML.
+
+    Entries are 'marshal' files named after the hash of the plan's content,
+    the version of PyCloud and the version of Python (which the 'marshal'
+    format depends on), so an edited plan or an upgrade never sees a stale
+    entry. Only the 'max_entries' most recently used entries are kept.
+
+    Setting the PYCLOUD_PLAN_CACHE environment variable to '0' turns the
+    cache off.
+    '''
+    DEFAULT_CACHE_DIR_PATH = os.path.join(PyCloudConfig.DEFAULT_CONFIG_DIR_PATH, 'plan_cache')
+
+    DEFAULT_MAX_ENTRIES = 32
+
+    def __init__(self, cache_dir=None, max_entries=None):
+
+        super(ParsedPlanCache, self).__init__()
+        self.cache_dir = cache_dir if cache_dir != None else ParsedPlanCache.DEFAULT_CACHE_DIR_PATH
+        self.max_entries = max_entries if max_entries != None else ParsedPlanCache.DEFAULT_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+
+        return os.environ.get('PYCLOUD_PLAN_CACHE', '1') != '0'
+
+    def key(self, content):
+        '''
+        Returns the cache key of a plan whose file holds 'content'.
+        '''
+        digest = hashlib.sha256()
+        digest.update(('pycloud-%s-py%d.%d\n' % ((pycloud.__version__,) + tuple(sys.version_info[:2]))).encode('utf-8'))
+        digest.update(content)
+        return digest.hexdigest()
+
+    def path(self, key):
+
+        return os.path.join(self.cache_dir, '%s.marshal' % key)
+
+    def load(self, plan_path, parse):
+        '''
+        Returns the parsed plan at 'plan_path', calling 'parse(content)' to
+        parse (and validate) it if it is not cached.
+        '''
+        with open(plan_path, 'rb') as f:
+            content = f.read()
+
+        if not self.enabled:
+            return parse(content)
+
+        key = self.key(content)
+        cached = self.read(key)
+        if cached != None:
+            self.hits += 1
+            self.logger.debug("Using the cached parse of plan '%s'." % plan_path)
+            return cached
+
+        self.misses += 1
+        plan = parse(content)
+        self.write(key, plan)
+        return plan
+
+    def read(self, key):
+
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                plan = marshal.loads(f.read())
+        except (IOError, OSError):
+            return None
+        except (EOFError, ValueError, TypeError):
+            self.logger.debug("Ignoring corrupt plan cache entry '%s'." % path)
+            return None
+
+        # mark the entry as recently used, so that it is pruned last
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return plan
+
+    def write(self, key, plan):
+
+        try:
+            data = marshal.dumps(plan)
+        except ValueError:
+            # the plan holds values (like dates) that marshal can't store
+            self.logger.debug("Not caching a plan that marshal can not serialize.")
+            return
+
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            atomic_write(self.path(key), data)
+            self.prune()
+        except (IOError, OSError):
+            self.logger.debug("Unable to write to the plan cache '%s'." % self.cache_dir, exc_info=True)
+
+    def prune(self):
+        '''
+        Removes all but the 'max_entries' most recently used entries.
+        '''
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.marshal'):
+                path = os.path.join(self.cache_dir, filename)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+
+        entries.sort(reverse=True)
+        for _, path in entries[self.max_entries:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+PlanCache = ParsedPlanCache()
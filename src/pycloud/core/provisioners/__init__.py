@@ -1,2 +0,0 @@
-from .debug import *
-from .aws import *
\ No newline at end of file
@@ -1,2 +0,0 @@
-from .ec2 import *
-from .os import *
\ No newline at end of file
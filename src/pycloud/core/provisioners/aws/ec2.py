@@ -1,10 +1,10 @@
-import time
-
 from boto import ec2
 
 from pycloud.core.keypair_storage import KeyPairStorage
 from pycloud.core.provisioners.base import BaseProvisioner
 from pycloud.core.provisioners.utils.mixins import AWSProvisionerMixin
+from pycloud.core.provisioners.utils.resource_index import INSTANCES, KEY_PAIRS, SECURITY_GROUPS
+from pycloud.core.provisioners.utils.waiters import InstanceWaiter
 from pycloud.core.registry import Registry
 
 class EC2KeyPairProvisioner(AWSProvisionerMixin, BaseProvisioner):
@@ -19,6 +19,8 @@ class EC2KeyPairProvisioner(AWSProvisionerMixin, BaseProvisioner):
 
     optional_args = None
 
+    provides_args = ['key_name']
+
     def verify(self, name, key_name=None, region=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None):
 
         self.verify_is_not_null('region', region)
@@ -32,15 +34,15 @@ class EC2KeyPairProvisioner(AWSProvisionerMixin, BaseProvisioner):
         conn = self.ec2_connect(region, AWS_ACCESS_KEY, AWS_SECRET_KEY)
         
         # determine if this key pair already exists or not
-        try:
-            existing_key_pairs = conn.get_all_key_pairs(keynames=[key_name])
+        if self.find_key_pair(conn, region, key_name) != None:
             self.logger.warn('A Key Pair with the name "%s" already exists. Skipping now.' % (key_name))
-        except Exception:
-            existing_key_pairs = []
-
-        if existing_key_pairs == []:
+        else:
             self.logger.info('Creating a new Key Pair with name "%s"'% (key_name))
-            ec2_keypair = conn.create_key_pair(key_name, dry_run=self.dry_run)
+            ec2_keypair = self.call_aws('Creating Key Pair "%s"' % key_name, conn.create_key_pair, key_name,
+                                        dry_run=self.dry_run)
+            if self.dry_run:
+                return
+            self.invalidate_resource(region, KEY_PAIRS, key_name)
             fs_keypair = KeyPairStorage(key_name)
             fs_keypair.save(ec2_keypair)
             
@@ -51,15 +53,22 @@ class EC2KeyPairProvisioner(AWSProvisionerMixin, BaseProvisioner):
         conn = self.ec2_connect(region, AWS_ACCESS_KEY, AWS_SECRET_KEY)
 
         # determine if this key pair already exists or not
-        try:
-            self.logger.info('Deleting Key Pair with name "%s"'% (key_name))
-            existing_key_pairs = conn.get_all_key_pairs(keynames=[key_name])
-            conn.delete_key_pair(key_name, dry_run=self.dry_run)
-            fs_keypair = KeyPairStorage(key_name)
-            fs_keypair.delete()
+        if self.find_key_pair(conn, region, key_name) == None:
+            self.logger.warn('A Key Pair with the name "%s" does not exist. Skipping now.' % (key_name))
+            return
 
+        self.logger.info('Deleting Key Pair with name "%s"'% (key_name))
+        try:
+            self.call_aws('Deleting Key Pair "%s"' % key_name, conn.delete_key_pair, key_name,
+                          dry_run=self.dry_run)
         except Exception:
-            self.logger.warn('A Key Pair with the name "%s" does not exist. Skipping now.' % (key_name))
+            self.logger.warning('Unable to delete Key Pair "%s". Skipping now.' % key_name, exc_info=True)
+            return
+        if self.dry_run:
+            return
+        self.invalidate_resource(region, KEY_PAIRS, key_name)
+        fs_keypair = KeyPairStorage(key_name)
+        fs_keypair.delete()
             
 
 
@@ -69,15 +78,20 @@ class EC2SecurityGroupProvisioner(AWSProvisionerMixin, BaseProvisioner):
 
     slug = 'ec2_security_group'
 
-    description = 'The EC2 Security Group provisioner can be used to create a AWS\'s EC2 Service\'s Security Groups'
+    description = 'The EC2 Security Group provisioner can be used to create a AWS\'s EC2 Service\'s Security Groups. ' \
+                  'If "prune" is set, rules of the group that are not in "rules" are revoked.'
 
     required_args = ['group_name', 'group_description', 'region', 'rules']
 
-    optional_args = None
+    optional_args = ['prune']
+
+    arg_types = {'rules': list, 'prune': bool}
+
+    provides_args = ['group_name']
 
     def verify(self, name, 
             group_name=None, group_description=None, 
-            region=None, rules=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None):
+            region=None, rules=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, prune=None):
 
         self.verify_is_not_null('group_name', group_name)
         self.verify_is_not_null('region', region)
@@ -86,7 +100,6 @@ class EC2SecurityGroupProvisioner(AWSProvisionerMixin, BaseProvisioner):
         self.verify_is_not_null('AWS_SECRET_KEY', AWS_SECRET_KEY)
 
         # ensure that the rules are setup properly
-        self.verify_is_type('rules', rules, list)
         for rule in rules:
             rule_keys = list(rule.keys())
             if len(rule_keys) != 1:
@@ -107,79 +120,131 @@ class EC2SecurityGroupProvisioner(AWSProvisionerMixin, BaseProvisioner):
             if 'cidr_ip' not in rule[rule_key]:
                 raise ValueError('Rule "%s" does not have "cidr_ip" value.' % (rule_key))
 
+    def existing_permissions(self, security_group):
+        '''
+        Returns the CIDR rules of 'security_group' as a set of
+        '(protocol, from_port, to_port, cidr_ip)' tuples. The ports are None
+        for rules without a port range, like the ones allowing all traffic
+        (protocol '-1').
+        '''
+        def port(value):
+            return str(value) if value not in (None, '') else None
+
+        permissions = set()
+        for rule in security_group.rules:
+            for grant in rule.grants:
+                if grant.cidr_ip:
+                    permissions.add((rule.ip_protocol, port(rule.from_port), port(rule.to_port), grant.cidr_ip))
+        return permissions
+
+    def desired_permissions(self, rules):
+        '''
+        Returns the 'rules' of the plan as a set of
+        '(protocol, from_port, to_port, cidr_ip)' tuples.
+        '''
+        permissions = set()
+        for rule in rules:
+            protocol = list(rule.keys())[0]
+            permissions.add((
+                protocol,
+                str(rule[protocol]['start']),
+                str(rule[protocol]['end']),
+                rule[protocol]['cidr_ip']))
+        return permissions
+
+    def apply_permissions(self, conn, security_group, action, permissions):
+        '''
+        Authorizes or revokes (depending on 'action') every permission in
+        'permissions' with a single API call, grouping the CIDR blocks of
+        rules that share a protocol and port range.
+        '''
+        if not permissions:
+            return
+
+        port_ranges = {}
+        for protocol, from_port, to_port, cidr_ip in permissions:
+            port_ranges.setdefault((protocol, from_port, to_port), []).append(cidr_ip)
+
+        params = {'GroupId': security_group.id}
+        ordered = sorted(port_ranges.items(), key=lambda item: tuple(part or '' for part in item[0]))
+        for i, ((protocol, from_port, to_port), cidr_ips) in enumerate(ordered, 1):
+            params['IpPermissions.%d.IpProtocol' % i] = protocol
+            # rules without a port range (like all traffic) have no ports
+            if from_port != None:
+                params['IpPermissions.%d.FromPort' % i] = from_port
+            if to_port != None:
+                params['IpPermissions.%d.ToPort' % i] = to_port
+            for j, cidr_ip in enumerate(sorted(cidr_ips), 1):
+                params['IpPermissions.%d.IpRanges.%d.CidrIp' % (i, j)] = cidr_ip
+        if self.dry_run:
+            params['DryRun'] = 'true'
+
+        self.call_aws('%s of %d rules' % (action, len(permissions)), conn.get_status, action, params, verb='POST')
+
 
     def up(self, name, 
             group_name=None, group_description=None, 
-            region=None, rules=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None):
+            region=None, rules=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, prune=None):
 
         # make the connection and get all the available security groups
         conn = self.ec2_connect(region, AWS_ACCESS_KEY, AWS_SECRET_KEY)
-        try:
-
-            existing_security_groups = conn.get_all_security_groups(groupnames=[group_name])
+        security_group = self.find_security_group(conn, region, group_name)
+        if security_group != None:
             self.logger.info("Security Group already exists. Using Security Group '%s'" % group_name)
-            security_group = existing_security_groups[0]
-        except Exception:
-
+        else:
             self.logger.info("Creating New Security Group '%s'" % group_name)
-            security_group = conn.create_security_group(group_name, group_description)
-        
+            security_group = self.call_aws("Creating Security Group '%s'" % group_name,
+                                           conn.create_security_group, group_name, group_description,
+                                           dry_run=self.dry_run)
+            if self.dry_run:
+                self.logger.info("The %d rules of Security Group '%s' would be authorized once it exists." % (
+                    len(rules), group_name))
+                return
+            self.invalidate_resource(region, SECURITY_GROUPS, group_name)
             
-        existing_rules = security_group.rules
-        for rule in rules:
+        existing = self.existing_permissions(security_group)
+        desired = self.desired_permissions(rules)
 
-            rule_keys = list(rule.keys())
-            protocol = rule_keys[0]
-            from_port = str(rule[protocol]['start'])
-            to_port = str(rule[protocol]['end'])
-            cidr_ip = rule[protocol]['cidr_ip']
-
-            rule_exists = False
-            for existing_rule in existing_rules:
-
-                if existing_rule.ip_protocol == protocol and \
-                    existing_rule.from_port == from_port and \
-                    existing_rule.to_port == to_port and \
-                    cidr_ip in [str(g) for g in existing_rule.grants]:
-                    
-                    rule_exists = True
-                    break
-
-            if rule_exists:
-                self.logger.warn("Rule: '%s' (%s-%s :: %s) already exists. Skipping Creation." % (
-                    protocol,
-                    from_port,
-                    to_port,
-                    cidr_ip
-                ))
-            else:
-                self.logger.info("Authorizing Rule for Security Group '%s': %s (%s-%s) for %s" % (
-                    group_name, 
-                    protocol, 
-                    from_port, 
-                    to_port, 
-                    cidr_ip))
-                security_group.authorize(
-                    ip_protocol=protocol, 
-                    from_port=from_port, 
-                    to_port=to_port, 
-                    cidr_ip=cidr_ip, 
-                    dry_run=self.dry_run)
+        for permission in sorted(desired & existing):
+            self.logger.warn("Rule: '%s' (%s-%s :: %s) already exists. Skipping Creation." % permission)
+
+        missing = desired - existing
+        for permission in sorted(missing):
+            self.logger.info("Authorizing Rule for Security Group '%s': %s (%s-%s) for %s" % ((group_name,) + permission))
+        self.apply_permissions(conn, security_group, 'AuthorizeSecurityGroupIngress', missing)
+
+        if prune:
+            extra = existing - desired
+            for permission in sorted(extra):
+                self.logger.info("Revoking Rule for Security Group '%s': %s (%s-%s) for %s" % ((group_name,) + permission))
+            self.apply_permissions(conn, security_group, 'RevokeSecurityGroupIngress', extra)
+
+        # the indexed copy of the group no longer has every rule
+        self.invalidate_resource(region, SECURITY_GROUPS, group_name)
 
 
     def down(self, name, 
             group_name=None, group_description=None, 
-            region=None, rules=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None):
+            region=None, rules=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, prune=None):
 
         # make the connection and get all the available security groups
         conn = self.ec2_connect(region, AWS_ACCESS_KEY, AWS_SECRET_KEY)
-        try:
-            existing_security_groups = conn.get_all_security_groups(groupnames=[group_name])
-            self.logger.info('Deleting Security Group "%s".' % group_name)
-            conn.delete_security_group(name=group_name, dry_run=self.dry_run)
+        security_group = self.find_security_group(conn, region, group_name)
+        if security_group == None:
+            self.logger.warning('Security Group "%s" does not exist. Skipping Now.' % group_name)
+            return
 
+        self.logger.info('Deleting Security Group "%s".' % group_name)
+        try:
+            self.call_aws('Deleting Security Group "%s"' % group_name, conn.delete_security_group,
+                          group_id=security_group.id, dry_run=self.dry_run)
         except Exception:
-            self.logger.warning('Security Group "%s" does not exist. Skipping Now.' % group_name)
+            # for instance, when instances of other plans still use it
+            self.logger.warning('Unable to delete Security Group "%s". Skipping Now.' % group_name, exc_info=True)
+            return
+        if self.dry_run:
+            return
+        self.invalidate_resource(region, SECURITY_GROUPS, group_name)
         
 
 class EC2InstanceProvisioner(AWSProvisionerMixin, BaseProvisioner):
@@ -188,14 +253,26 @@ class EC2InstanceProvisioner(AWSProvisionerMixin, BaseProvisioner):
 
     slug = 'ec2_instance'
 
-    description = 'The EC2 Instance Provisioner can be used to Provision Amazon Web Service\'s EC2 Service'
+    description = 'The EC2 Instance Provisioner can be used to Provision Amazon Web Service\'s EC2 Service. ' \
+                  'It waits up to "wait_timeout" seconds (default: 600) for the instances to be running, ' \
+                  'and if "wait_for_status_ok" is set, for their status checks to pass as well.'
 
     required_args = ['region', 'ami_id', 'instance_type', 'security_group', 'key_name', 'instance_id_ref']
 
-    optional_args = ['min_count', 'max_count']
+    optional_args = ['min_count', 'max_count', 'wait_timeout', 'wait_for_status_ok']
+
+    arg_types = {'min_count': int, 'max_count': int, 'wait_timeout': (int, float), 'wait_for_status_ok': bool}
+
+    arg_defaults = {'min_count': 1, 'max_count': 1}
+
+    provides_args = ['instance_id_ref']
+
+    # tasks using the instances can start on each one as soon as it runs
+    stream_outputs = ['instance_id_ref']
 
     def verify(self, name, region=None, ami_id=None, instance_type=None, security_group=None, key_name=None,
-                  AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, instance_id_ref=None, min_count=None, max_count=None):
+                  AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, instance_id_ref=None, min_count=None, max_count=None,
+                  wait_timeout=None, wait_for_status_ok=None):
         
         self.verify_is_not_null('region', region)
         self.verify_is_not_null('ami_id', ami_id)
@@ -208,7 +285,8 @@ class EC2InstanceProvisioner(AWSProvisionerMixin, BaseProvisioner):
         self.verify_is_not_null('AWS_SECRET_KEY', AWS_SECRET_KEY)
 
     def up(self, name, region=None, ami_id=None, instance_type=None, security_group=None, key_name=None,
-                  AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, instance_id_ref=None, min_count=None, max_count=None):
+                  AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, instance_id_ref=None, min_count=None, max_count=None,
+                  wait_timeout=None, wait_for_status_ok=None):
 
 
         # set default values for optional fields
@@ -219,18 +297,20 @@ class EC2InstanceProvisioner(AWSProvisionerMixin, BaseProvisioner):
         connection = self.ec2_connect(region, AWS_ACCESS_KEY, AWS_SECRET_KEY)
 
         # get the security group corresponding to the provided 'security_group' name
-        sg = [s for s in connection.get_all_security_groups() if s.name == security_group]
-        if len(sg) != 1:
+        sg = self.find_security_group(connection, region, security_group)
+        if sg == None and self.dry_run:
+            self.logger.info("%d instances would be created once Security Group '%s' exists." % (
+                max_count, security_group))
+            return
+        if sg == None:
             raise ValueError("Security Group does not exist. Please create using 'ec2_security_group' first.")
-        else:
-            sg = sg[0]
 
         # existing instances
         existing_instance_ids = self.config.get(instance_id_ref)
         if existing_instance_ids == None:
             
             # create the instances
-            reservation = connection.run_instances(
+            reservation = self.call_aws('Creating %d instances' % max_count, connection.run_instances,
                 ami_id, 
                 min_count=min_count,
                 max_count=max_count,
@@ -238,31 +318,30 @@ class EC2InstanceProvisioner(AWSProvisionerMixin, BaseProvisioner):
                 security_group_ids=[sg.id],
                 key_name=key_name,
                 dry_run=self.dry_run)
+            if self.dry_run:
+                return
             instances = reservation.instances
             self.logger.info("Created %d instances with reservation id: %s" % (len(reservation.instances), reservation.id))
             for instance in instances:
                 self.logger.info("Instance ID '%s' was created." % (instance.id))
             instance_ids = [instance.id for instance in instances]
 
-            # wait for all instances to start
-            for instance in instances:
-                while instance.state != 'running':
-                    self.logger.info('Waiting for Instance '\
-                        '(id=%s) to go from "%s" to "running"' % (
-                            instance.id, instance.state))
-                    time.sleep(5)
-                    instance.update()
-                time.sleep(5)
-                self.logger.info("Instance State is '%s'" % (instance.state))
+            # wait for all instances to start, streaming each one to the
+            # tasks using them once it runs
+            stream = self.output_streams.get('instance_id_ref')
+            waiter = InstanceWaiter(connection, timeout=wait_timeout)
+            waiter.wait(instance_ids, state='running', status_ok=bool(wait_for_status_ok),
+                        on_ready=stream.put if stream != None else None)
+            self.logger.info("All %d instances are running." % len(instance_ids))
 
             # store instance state in config
-            if not self.dry_run:
-                self.config.set(instance_id_ref, instance_ids)
+            self.config.set(instance_id_ref, instance_ids)
         else:
             self.logger.warning("Instances already exist for this task. Skipping Instance Creation.")
 
     def down(self, name, region=None, ami_id=None, instance_type=None, security_group=None, key_name=None,
-                  AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, instance_id_ref=None, min_count=None, max_count=None):
+                  AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, instance_id_ref=None, min_count=None, max_count=None,
+                  wait_timeout=None, wait_for_status_ok=None):
         
         # create a connection and use boto to setup instances
         connection = self.ec2_connect(region, AWS_ACCESS_KEY, AWS_SECRET_KEY)
@@ -275,11 +354,20 @@ class EC2InstanceProvisioner(AWSProvisionerMixin, BaseProvisioner):
             self.logger.warning("Skipping EC2 Instance Provision teardown() process")
         else:
             self.logger.info('Terminating "%d" Instances.' % (len(existing_instance_ids)))
-            connection.terminate_instances(instance_ids=existing_instance_ids, dry_run=self.dry_run)
+            self.call_aws('Terminating %d instances' % len(existing_instance_ids), connection.terminate_instances,
+                          instance_ids=existing_instance_ids, dry_run=self.dry_run)
+            if self.dry_run:
+                return
+            for instance_id in existing_instance_ids:
+                self.invalidate_resource(region, INSTANCES, instance_id)
+
+            # resources the instances use (like their security group) can
+            # only be deleted once the instances are gone
+            waiter = InstanceWaiter(connection, timeout=wait_timeout)
+            waiter.wait(existing_instance_ids, state='terminated')
 
             # store instance state in config
-            if not self.dry_run:
-                self.config.delete(instance_id_ref)
+            self.config.delete(instance_id_ref)
 
 
 Registry.register_provisioner(EC2InstanceProvisioner)
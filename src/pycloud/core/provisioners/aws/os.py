@@ -1,9 +1,12 @@
 import os
+import shlex
 from pycloud.base import Base
 from pycloud.core.provisioners.base import BaseProvisioner
 from pycloud.core.keypair_storage import KeyPairStorage
 from pycloud.core.registry import Registry
+from pycloud.core.provisioners.utils.keygen import IN_PROCESS_KEY_TYPES, write_key_pairs
 from pycloud.core.provisioners.utils.mixins import AWSProvisionerMixin, FileSystemProvisionerMixin
+from pycloud.core.provisioners.utils.remote_script import RemoteScript
 
 from sultan.api import Sultan
 
@@ -13,13 +16,36 @@ class SSHKeyGenerator(FileSystemProvisionerMixin, BaseProvisioner):
 
     slug = 'ssh_keygen'
 
-    description = 'Generates a SSH Key in a temporary directory, and moves it to the requested directory.'
+    description = 'Generates a SSH Key named "file" in "out_dir", encrypted with "passphrase" unless it is empty. ' \
+                  'Given a list of "users", generates a key for each of them, in "out_dir/<user>/". ' \
+                  'RSA, ECDSA and Ed25519 keys are generated without running ssh-keygen.'
 
     required_args = ['key_type', 'file', 'passphrase', 'out_dir']
 
-    optional_args = None
+    optional_args = ['users']
 
-    def verify(self, name, key_type=None, file=None, passphrase=None, out_dir=None, **kwargs):
+    arg_types = {'users': list}
+
+    @classmethod
+    def key_paths(cls, file=None, out_dir=None, users=None, **kwargs):
+        '''
+        Returns the path of every private key the task generates. The public
+        keys are next to them, with a '.pub' extension.
+        '''
+        if users:
+            return [os.path.join(out_dir, str(user), file) for user in users]
+        return [os.path.join(out_dir, file)]
+
+    @classmethod
+    def references(cls, **kwargs):
+
+        provides, consumes = super(SSHKeyGenerator, cls).references(**kwargs)
+        if kwargs.get('out_dir') and kwargs.get('file'):
+            for path in cls.key_paths(**kwargs):
+                provides.add(('path', os.path.normpath('%s.pub' % path)))
+        return provides, consumes
+
+    def verify(self, name, key_type=None, file=None, passphrase=None, out_dir=None, users=None, **kwargs):
 
         self.verify_is_not_null('key_type', key_type)
         self.verify_is_not_null('file', file)
@@ -35,33 +61,17 @@ class SSHKeyGenerator(FileSystemProvisionerMixin, BaseProvisioner):
                 )
             )
 
-    def up(self, name, key_type=None, file=None, passphrase=None, out_dir=None, **kwargs):
+    def run_ssh_keygen(self, key_type, private_path, passphrase, comment=None):
+        '''
+        Generates a key with 'ssh-keygen', for the key types that are not
+        generated in-process.
+        '''
+        with Sultan.load(cwd=os.path.dirname(private_path) or '.') as s:
 
-        public_keypath = os.path.join(out_dir, 'id_%s.pub' % (key_type))
-        private_keypath = os.path.join(out_dir, 'id_%s' % (key_type))
-
-        # make output directory if it doesn't exist
-        if not os.path.exists(out_dir):
-            self.make_directory(out_dir)
-
-        # don't create a new ssh-key if one already exists, and raise an error.
-        if os.path.exists(public_keypath):
-            raise IOError("Public Key exists. Halting generation because we don't want to overwrite it.")
-        
-        if os.path.exists(private_keypath):
-            raise IOError("Private Key exists. Halting generation because we don't want to overwrite it.")
-
-        if self.dry_run:
-            self.logger.info("A '%s' SSH Key will be generated in '%s' if dry-run flag was not set." % (key_type, out_dir))
-            return
-
-        # run ssh-keygen to generate files
-        with Sultan.load(cwd=out_dir) as s:
-            
-            response = s.ssh__keygen(
-                '-t', key_type,
-                '-f', 'id_%s' % key_type,
-            ).run()
+            args = ['-q', '-t', key_type, '-f', shlex.quote(private_path), '-N', shlex.quote(passphrase or '')]
+            if comment:
+                args.extend(['-C', shlex.quote(comment)])
+            response = s.ssh__keygen(*args).run()
 
             if response.stdout:
                 for line in response.stdout:
@@ -71,16 +81,46 @@ class SSHKeyGenerator(FileSystemProvisionerMixin, BaseProvisioner):
                 for line in response.stderr:
                     self.logger.error('STDERR: %s' % line.strip('\n'))
 
-    def down(self, name, key_type=None, file=None, passphrase=None, out_dir=None, **kwargs):
+    def up(self, name, key_type=None, file=None, passphrase=None, out_dir=None, users=None, **kwargs):
+
+        private_keypaths = self.key_paths(file=file, out_dir=out_dir, users=users)
+
+        # don't create a new ssh-key if one already exists, and raise an error.
+        for private_keypath in private_keypaths:
+            if os.path.exists('%s.pub' % private_keypath):
+                raise IOError("Public Key exists. Halting generation because we don't want to overwrite it.")
+
+            if os.path.exists(private_keypath):
+                raise IOError("Private Key exists. Halting generation because we don't want to overwrite it.")
+
+        if self.dry_run:
+            self.logger.info("%d '%s' SSH Key(s) will be generated in '%s' if dry-run flag was not set." % (
+                len(private_keypaths), key_type, out_dir))
+            return
+
+        # make output directories if they don't exist
+        for private_keypath in private_keypaths:
+            if not os.path.exists(os.path.dirname(private_keypath)):
+                self.make_directory(os.path.dirname(private_keypath))
+
+        comments = [str(user) for user in users] if users else None
+        if key_type in IN_PROCESS_KEY_TYPES:
+            write_key_pairs(key_type, private_keypaths, passphrase=passphrase, comments=comments)
+        else:
+            for index, private_keypath in enumerate(private_keypaths):
+                self.run_ssh_keygen(key_type, private_keypath, passphrase,
+                                    comment=comments[index] if comments else None)
+        self.logger.info("Generated %d '%s' SSH Key(s) in '%s'." % (len(private_keypaths), key_type, out_dir))
+
+    def down(self, name, key_type=None, file=None, passphrase=None, out_dir=None, users=None, **kwargs):
 
         if self.dry_run:
             self.logger.info("Dry-Run Enabled, so stopping here.")
             return
 
-        public_keypath = os.path.join(out_dir, 'id_%s.pub' % (key_type))
-        private_keypath = os.path.join(out_dir, 'id_%s' % (key_type))
-        self.delete_file(public_keypath)
-        self.delete_file(private_keypath)
+        for private_keypath in self.key_paths(file=file, out_dir=out_dir, users=users):
+            self.delete_file('%s.pub' % private_keypath)
+            self.delete_file(private_keypath)
 
 
 class UserAdd(AWSProvisionerMixin, FileSystemProvisionerMixin, BaseProvisioner):
@@ -89,13 +129,25 @@ class UserAdd(AWSProvisionerMixin, FileSystemProvisionerMixin, BaseProvisioner):
 
     slug = 'user_add'
 
-    description = 'The Linux User Add Provisioner creates a new user on the referenced EC2 Instances.'
+    description = 'The Linux User Add Provisioner creates a new user on the referenced EC2 Instances. ' \
+                  'Up to "max_parallel_hosts" instances (default: 10) are configured at the same time, ' \
+                  'and the task fails if more than "max_failed_hosts_percent" (default: 0) of them fail.'
 
     required_args = ['instance_id_ref', 'region', 'key_name', 'user_name',]
 
-    optional_args = ['remote_ssh_port', 'default_shell', 'public_key']
+    optional_args = ['remote_ssh_port', 'default_shell', 'public_key', 'max_parallel_hosts', 'max_failed_hosts_percent']
+
+    arg_types = {'remote_ssh_port': int, 'max_parallel_hosts': int, 'max_failed_hosts_percent': (int, float)}
+
+    arg_defaults = {'remote_ssh_port': 22}
+
+    # users are added to every instance as soon as it runs
+    stream_inputs = ['instance_id_ref']
 
-    def verify(self, name, instance_id_ref=None, region=None, key_name=None, user_name=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, remote_ssh_port=None, default_shell=None, public_key=None):
+    # 'useradd' exits with this status when the user already exists
+    USER_EXISTS_EXIT_STATUS = 9
+
+    def verify(self, name, instance_id_ref=None, region=None, key_name=None, user_name=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, remote_ssh_port=None, default_shell=None, public_key=None, max_parallel_hosts=None, max_failed_hosts_percent=None):
 
         self.verify_is_not_null('instance_id_ref', instance_id_ref)
         self.verify_is_not_null('region', region)
@@ -109,9 +161,9 @@ class UserAdd(AWSProvisionerMixin, FileSystemProvisionerMixin, BaseProvisioner):
             raise ValueError("Unable to run user add because there are 0 referenced instances.")
         return instance_ids
 
-    def up(self, name, instance_id_ref=None, region=None, key_name=None, user_name=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, remote_ssh_port=22, default_shell=None, public_key=None):
+    def up(self, name, instance_id_ref=None, region=None, key_name=None, user_name=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, remote_ssh_port=22, default_shell=None, public_key=None, max_parallel_hosts=None, max_failed_hosts_percent=None):
 
-        if not self.dry_run:
+        if public_key and not self.dry_run:
             self.verify_exists(public_key)
 
         # create connection
@@ -120,61 +172,71 @@ class UserAdd(AWSProvisionerMixin, FileSystemProvisionerMixin, BaseProvisioner):
         # get keypair reference from fs
         fs_keypair = KeyPairStorage(key_name)
 
+        if self.dry_run and not self.config.get(instance_id_ref):
+            self.logger.info("User '%s' will be created on the instances referenced by '%s' once they exist." % (
+                user_name, instance_id_ref))
+            return
+
         # create the requested user and setup their public SSH Key
         admin_user = 'ubuntu'
-        instance_ids = self.fetch_instance_ids(instance_id_ref)
-        instances = conn.get_only_instances(instance_ids=instance_ids)
-        for instance in instances:
+        instances = self.iter_instances(conn, region, instance_id_ref)
 
-            if self.dry_run:
-                self.logger.info("User '%s' will be created if dry-run flag was not set." % user_name)
-            else: 
-                self.logger.info("Creating User '%s'" % (user_name))
-                exit_status = self.run_shell_command(conn, instance, fs_keypair, admin_user, remote_ssh_port, 
-                    'sudo useradd {username} -m -s {default_shell}'.format(
-                        username=user_name,
-                        default_shell=default_shell
-                    )
-                )
-                if exit_status == 0:
-                    self.logger.info("Successfully added user '%s'" % user_name)
-                else:
-                    self.logger.error("Unable to add user '%s'" % user_name)
+        def add_user(instance):
 
-            # check if the public key exists
-            if public_key:
-
-                if self.dry_run:
+            if self.dry_run:
+                self.logger.info("User '%s' will be created on '%s' if dry-run flag was not set." % (user_name, instance.id))
+                if public_key:
                     self.logger.info("Public Key '%s' would be transfered to '%s' if dry-run flag was not set." % (public_key, instance.public_dns_name))
-                    return
+                return 0
+
+            self.logger.info("Creating User '%s' on '%s'" % (user_name, instance.public_dns_name))
+            script = RemoteScript()
+            script.run('sudo useradd {username} -m -s {default_shell}'.format(
+                username=user_name,
+                default_shell=default_shell
+            ), ok_statuses=[0, UserAdd.USER_EXISTS_EXIT_STATUS])
 
-                self.logger.info("Public Key '%s' was provided. Setting it up for user '%s' on remote instance." % (public_key, user_name))
-                public_key_name = os.path.basename(public_key)
+            # set up the public key in the same round trip, only sending it
+            # when it is not already there
+            if public_key:
                 remote_user_ssh_dir = os.path.join('/home', user_name, '.ssh/')
                 remote_user_publickey = os.path.join(remote_user_ssh_dir, 'authorized_keys')
-                self.run_shell_command(conn, instance, fs_keypair, admin_user, remote_ssh_port,
-                    'sudo mkdir -p {ssh_dir}'.format(ssh_dir=remote_user_ssh_dir)
-                )
-                self.sftp_file(conn, instance, fs_keypair, admin_user, remote_ssh_port, public_key, remote_user_publickey)
-                self.run_shell_command(conn, instance, fs_keypair, admin_user, remote_ssh_port,
-                    'sudo chown -R {username}:{groupname} {ssh_dir}'.format(
-                        ssh_dir=remote_user_ssh_dir,
-                        username=user_name,
-                        groupname=user_name)
-                )
-                self.run_shell_command(conn, instance, fs_keypair, admin_user, remote_ssh_port,
-                    'sudo chmod -R 700 {path}'.format(
-                        path=remote_user_ssh_dir
-                    )
-                )
-                self.run_shell_command(conn, instance, fs_keypair, admin_user, remote_ssh_port,
-                    'sudo chmod -R 400 {path}'.format(
-                        path=remote_user_publickey
-                    )
-                )
-        
+                script.run('sudo mkdir -p {ssh_dir}'.format(ssh_dir=remote_user_ssh_dir))
+                script.run('sudo chown -R {username}:{groupname} {ssh_dir}'.format(
+                    ssh_dir=remote_user_ssh_dir,
+                    username=user_name,
+                    groupname=user_name))
+                script.run('sudo chmod -R 700 {path}'.format(path=remote_user_ssh_dir))
+                script.put_file(public_key, remote_user_publickey, sudo=True, mode=0o400,
+                                owner='%s:%s' % (user_name, user_name))
+
+            result = self.run_script(conn, instance, fs_keypair, admin_user, remote_ssh_port, script)
+            useradd_status = result.status_of(0)
+            if useradd_status == 0:
+                self.logger.info("Successfully added user '%s' on '%s'" % (user_name, instance.public_dns_name))
+            elif useradd_status == UserAdd.USER_EXISTS_EXIT_STATUS:
+                self.logger.warning("User '%s' already exists on '%s'" % (user_name, instance.public_dns_name))
+            else:
+                self.logger.error("Unable to add user '%s' on '%s'" % (user_name, instance.public_dns_name))
+
+            if result.ok and public_key:
+                self.logger.info("Public Key '%s' was set up for user '%s' on '%s'." % (
+                    public_key, user_name, instance.public_dns_name))
+            return result.exit_status
+
+        result = self.run_on_instances(instances, add_user,
+            max_parallel_hosts=max_parallel_hosts,
+            max_failed_hosts_percent=max_failed_hosts_percent,
+            ssh_port=remote_ssh_port if not self.dry_run else None)
+        self.logger.info("Added user '%s': %s" % (user_name, result.summary()))
+        return result
 
-    def down(self, name, instance_id_ref=None, region=None, key_name=None, user_name=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, remote_ssh_port=22, default_shell=None, public_key=None):
+    def down(self, name, instance_id_ref=None, region=None, key_name=None, user_name=None, AWS_ACCESS_KEY=None, AWS_SECRET_KEY=None, remote_ssh_port=22, default_shell=None, public_key=None, max_parallel_hosts=None, max_failed_hosts_percent=None):
+
+        if self.dry_run:
+            self.logger.info("User '%s' would be deleted from the instances referenced by '%s' if dry-run flag was not set." % (
+                user_name, instance_id_ref))
+            return
 
         # create connection
         conn = self.ec2_connect(region, AWS_ACCESS_KEY, AWS_SECRET_KEY)
@@ -184,20 +246,30 @@ class UserAdd(AWSProvisionerMixin, FileSystemProvisionerMixin, BaseProvisioner):
 
         admin_user = 'ubuntu'
         instance_ids = self.fetch_instance_ids(instance_id_ref)
-        instances = conn.get_only_instances(instance_ids=instance_ids)
-        for instance in instances:
+        instances = self.find_instances(conn, region, instance_ids)
 
-            exit_status = self.run_shell_command(conn, instance, fs_keypair, admin_user, remote_ssh_port, 
+        def delete_user(instance):
+
+            exit_status = self.run_shell_command(conn, instance, fs_keypair, admin_user, remote_ssh_port,
                 'sudo userdel {username} -r'.format(
                     username=user_name,
                 )
             )
 
             if exit_status == 0:
-                self.logger.info("Successfully deleted user '%s'" % user_name)
+                self.logger.info("Successfully deleted user '%s' on '%s'" % (user_name, instance.public_dns_name))
             else:
-                self.logger.exception("Unable to delete user. Not raising any errors.")
-        
+                self.logger.error("Unable to delete user on '%s'. Not raising any errors." % instance.public_dns_name)
+            return exit_status
+
+        # failing to delete a user never fails the teardown
+        result = self.run_on_instances(instances, delete_user,
+            max_parallel_hosts=max_parallel_hosts,
+            max_failed_hosts_percent=100,
+            ssh_port=remote_ssh_port)
+        self.logger.info("Deleted user '%s': %s" % (user_name, result.summary()))
+        return result
+
 
 Registry.register_provisioner(UserAdd)
 Registry.register_provisioner(SSHKeyGenerator)
\ No newline at end of file
@@ -7,11 +7,83 @@ from pycloud.core.config import PyCloudConfig
 
 pycloud_config = PyCloudConfig()
 
+# Maps a task argument to the namespace of the resource its value names. Two
+# tasks that mention the same value in the same namespace share a resource,
+# which is how the scheduler works out the order tasks have to run in.
+REFERENCE_ARGS = {
+    'instance_id_ref': 'instance_id_ref',
+    'group_name': 'security_group',
+    'security_group': 'security_group',
+    'key_name': 'key_name',
+    'public_key': 'path',
+}
+
 class ImproperlyConfiguredProvisionerError(ValueError):
 
     pass
 
 
+# arguments every task accepts: the ones PyCloud passes to every provisioner,
+# and the name of the task itself.
+GLOBAL_ARGS = frozenset(['PLAN', 'AWS_ACCESS_KEY', 'AWS_SECRET_KEY'])
+
+TASK_ARGS = frozenset(['name'])
+
+
+class ArgumentSpec(object):
+    '''
+    The arguments a Provisioner Class accepts, compiled once per class from
+    its 'required_args', 'optional_args', 'arg_types' and 'arg_defaults', so
+    that validating a task takes a couple of set operations.
+    '''
+    def __init__(self, required, optional, types=None, defaults=None):
+
+        self.required = frozenset(required) | TASK_ARGS
+        self.optional = frozenset(optional)
+        self.allowed = self.required | self.optional | GLOBAL_ARGS
+        self.types = dict(types) if types != None else {}
+        self.defaults = dict(defaults) if defaults != None else {}
+
+        for arg in set(self.types.keys()) | set(self.defaults.keys()):
+            if arg not in self.allowed:
+                raise ValueError("'arg_types' and 'arg_defaults' can only refer to the provisioner's "
+                                 "arguments, but '%s' is not one of them." % arg)
+
+    def validate(self, kwargs):
+        '''
+        Raises 'ImproperlyConfiguredProvisionerError' unless 'kwargs' has
+        every required argument, no unknown ones, and values of the expected
+        types.
+        '''
+        missing = self.required.difference(kwargs)
+        if missing:
+            raise ImproperlyConfiguredProvisionerError('Required argument "%s" is not found in kwargs.' % (
+                sorted(missing)[0]))
+
+        unexpected = frozenset(kwargs).difference(self.allowed)
+        if unexpected:
+            raise ImproperlyConfiguredProvisionerError('The configured argument "%s" is not an allowed argument.' % (
+                sorted(unexpected)[0]))
+
+        for arg, data_type in self.types.items():
+            value = kwargs.get(arg)
+            if value != None and not isinstance(value, data_type):
+                raise ImproperlyConfiguredProvisionerError('"%s" is not of type "%s". It is "%s"' % (
+                    arg, data_type, type(value)))
+
+    def with_defaults(self, kwargs):
+        '''
+        Returns a copy of 'kwargs', with the defaults of the arguments it
+        does not set.
+        '''
+        if not self.defaults:
+            return dict(kwargs)
+
+        merged = dict(self.defaults)
+        merged.update(kwargs)
+        return merged
+
+
 class BaseProvisioner(Base):
     '''
     All provisioners must inherit from this base class. 
@@ -26,40 +98,90 @@ class BaseProvisioner(Base):
 
     description = None
 
-    required_args = []
+    required_args = None
+
+    optional_args = None
+
+    # the type (or tuple of types) each argument has to be, when it is set
+    arg_types = None
 
-    optional_args = []
+    # the values of the optional arguments a task does not set
+    arg_defaults = None
 
+    # arguments that name a resource created by this provisioner, rather than
+    # one it expects to already exist.
+    provides_args = None
+
+    # arguments naming an output this provisioner can stream to the tasks
+    # that depend on it while it is still running, and arguments naming an
+    # output this provisioner can consume that way. See 'OutputStream'.
+    stream_outputs = None
+
+    stream_inputs = None
+
+    # part of the fingerprint of every task, so that bumping it when 'up()'
+    # changes what it does makes '--changed-only' run the tasks again.
+    version = 1
 
     def __init__(self):
 
         super(BaseProvisioner, self).__init__()
         self.kwargs = None
 
-        # inject the 'task_name' argument to 'required_arguments'
-        self.required_args.append('name')
+        # the 'OutputStream' of each streamed argument, when the plan
+        # executor connects this task to others with streaming edges.
+        self.output_streams = {}
+        self.input_streams = {}
 
         # verify that Provisioner is configured properly
-        if not self.name:
+        self.argument_spec()
+
+    @classmethod
+    def compile_argument_spec(cls):
+        '''
+        Verifies that the Provisioner Class is configured properly, and
+        compiles the 'ArgumentSpec' its tasks are validated with. Called
+        when the class is registered.
+        '''
+        if not cls.name:
             raise ValueError("Subclass of 'BaseProvisioner' has not defined 'name'.")
 
-        if not self.description:
+        if not cls.description:
             raise ValueError("Subclass of 'BaseProvisioner' has not defined 'description'.")
 
-        if not self.slug:
+        if not cls.slug:
             raise ValueError("Subclass of 'BaseProvisioner' has not defined 'slug'.")
 
-        if (self.required_args != None) and (len(self.required_args) == 0):
+        if (cls.required_args != None) and (len(cls.required_args) == 0):
             raise ValueError("Subclass of 'BaseProvisioner' needs to have 'required_args' be a list greater than 0, or set to None.")
 
-        if (self.optional_args != None) and (len(self.optional_args) == 0):
+        if (cls.optional_args != None) and (len(cls.optional_args) == 0):
             raise ValueError("Subclass of 'BaseProvisioner' needs to have 'optional_args' be a list greater than 0, or set to None.")
 
+        cls._argument_spec = ArgumentSpec(
+            cls.required_args if cls.required_args != None else [],
+            cls.optional_args if cls.optional_args != None else [],
+            types=cls.arg_types,
+            defaults=cls.arg_defaults)
+        return cls._argument_spec
+
+    @classmethod
+    def argument_spec(cls):
+        '''
+        Returns the compiled 'ArgumentSpec' of this class (and not the one
+        of a parent class), compiling it on first use.
+        '''
+        spec = cls.__dict__.get('_argument_spec')
+        if spec == None:
+            spec = cls.compile_argument_spec()
+        return spec
+
     def set_arguments(self, **kwargs):
         '''
-        Sets the Provisioner's kwargs.
+        Sets the Provisioner's kwargs, along with the defaults of the ones
+        that are not set.
         '''
-        self.kwargs = kwargs
+        self.kwargs = self.argument_spec().with_defaults(kwargs)
         self.validate_kwargs()
 
     def verify_is_not_null(self, name, val):
@@ -85,30 +207,15 @@ class BaseProvisioner(Base):
         if self.kwargs == None:
             raise ImproperlyConfiguredProvisionerError('Provisioner was not instantiated with arguments. Call set_arguments first.')
 
-        allowed_args = ['PLAN', 'AWS_ACCESS_KEY', 'AWS_SECRET_KEY']
-        if self.required_args != None:
-            allowed_args += self.required_args
-
-        if self.optional_args != None:
-            allowed_args += self.optional_args
-
-        provided_args = self.kwargs.keys()
-
-        # validate required args
-        for arg in self.required_args:
-            if arg not in self.kwargs:
-                raise ImproperlyConfiguredProvisionerError('Required argument "%s" is not found in kwargs.' % arg)
-
-        # ensure that no other args are provided
-        for arg in provided_args:
-            if arg not in allowed_args:
-                raise ImproperlyConfiguredProvisionerError('The configured argument "%s" is not an allowed argument.' % arg)
+        self.argument_spec().validate(self.kwargs)
 
-    def verify(self, **kwargs):
+    def verify(self, name, **kwargs):
         '''
-        This method needs to be implemented and use 'kwargs' for parameters it needs.
+        Verifies the values in 'kwargs' before 'up()' or 'down()' run. They have
+        already been checked against the class's 'ArgumentSpec', so subclasses
+        only need to implement this to check more than that.
         '''
-        raise NotImplementedError("Subclass of 'BaseProvisioner' has not implemented 'verify()'.")
+        pass
 
     def up(self, name, **kwargs):
         '''
@@ -157,6 +264,45 @@ class BaseProvisioner(Base):
         except Exception:
             click.secho("An Error Occurred while trying to run %s.down()" % (self.__class__.__name__), fg='red')
             raise
+    # Dependencies -----------------------------------------------------------------------------------------------------
+    @classmethod
+    def references(cls, **kwargs):
+        '''
+        Returns a tuple of sets '(provides, consumes)', where each entry is a
+        '(namespace, value)' pair naming a resource that a task with the given
+        'kwargs' creates or uses.
+        '''
+        provides_args = cls.provides_args if cls.provides_args != None else []
+        provides = set()
+        consumes = set()
+        for arg, value in kwargs.items():
+            if arg not in REFERENCE_ARGS or value == None:
+                continue
+
+            namespace = REFERENCE_ARGS[arg]
+            if namespace == 'path':
+                value = os.path.normpath(value)
+
+            reference = (namespace, value)
+            if arg in provides_args:
+                provides.add(reference)
+            else:
+                consumes.add(reference)
+        return provides, consumes - provides
+
+    @classmethod
+    def streamed_references(cls, args, **kwargs):
+        '''
+        Returns a dictionary of the '(namespace, value)' reference of each
+        argument in 'args' that the task with the given 'kwargs' sets, to the
+        argument.
+        '''
+        references = {}
+        for arg in (args or []):
+            if arg in REFERENCE_ARGS and kwargs.get(arg) != None:
+                references[(REFERENCE_ARGS[arg], kwargs[arg])] = arg
+        return references
+
     # State Management -------------------------------------------------------------------------------------------------
     @property
     def config(self):
@@ -174,14 +320,17 @@ class BaseProvisioner(Base):
         for txt in textwrap.wrap(cls.description, 70):
             click.secho("             %s" % txt, fg='green')
         click.secho('Required Arguments:', fg='green')
+        click.secho("                    - name", fg='green')
         if cls.required_args != None:
             for arg in cls.required_args:
                 click.secho("                    - %s" % arg, fg='green')
-        else:
-            click.secho("                    There are 0 required arguments.", fg='green')
         click.secho('Optional Arguments:', fg='green')
         if cls.optional_args != None:
+            defaults = cls.arg_defaults if cls.arg_defaults != None else {}
             for arg in cls.optional_args:
-                click.secho("                    - %s" % arg, fg='green')
+                if arg in defaults:
+                    click.secho("                    - %s (default: %s)" % (arg, defaults[arg]), fg='green')
+                else:
+                    click.secho("                    - %s" % arg, fg='green')
         else:
             click.secho("                    There are 0 optional arguments.", fg='green')
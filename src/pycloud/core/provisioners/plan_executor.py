@@ -4,10 +4,28 @@ import time
 import traceback
 from yaml import load
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    # PyYAML was built without libyaml
+    from yaml import SafeLoader
+
 from pycloud.base import Base
+from pycloud.core.checkpoints import AppliedFingerprints, CheckpointJournal, COMPLETED, FAILED, STARTED, \
+    fingerprint, plan_id, task_keys
+from pycloud.core.config import PyCloudConfig
+from pycloud.core.plan_cache import PlanCache
 from pycloud.core.registry import Registry
+from pycloud.core.run_report import RunReport
 from pycloud.core.errors import InvalidPlanError
+from pycloud.core.provisioners.scheduler import DependencyGraph, TaskScheduler
+from pycloud.core.provisioners.utils.connections import EC2Connections, normalize_region
+from pycloud.core.provisioners.utils.resource_index import ResourceIndex
+from pycloud.core.provisioners.utils.networking import PortProber
+from pycloud.core.provisioners.utils.session_pool import SessionPool
+from pycloud.core.provisioners.utils.streams import OutputStream
 from pycloud.core.timer import TimeContext
+from pycloud.core.tracing import Tracer
 
 
 class PlanExecutor(Base):
@@ -19,126 +37,434 @@ class PlanExecutor(Base):
         super(PlanExecutor, self).__init__()
         self.__globals = _globals if _globals != None else {}
 
+        self.plan_path = plan_path
+
+        # where the report of each run is saved, or None to only print it
+        self.report_dir = RunReport.DEFAULT_REPORT_DIR_PATH if plan_path != None else None
         if plan_path != None:
-            with open(plan_path) as f:
-                self.__plan = load(f.read())
-            self.validate_plan()
+            self.__tasks = PlanCache.load(plan_path, self.parse_plan)
+            self.checkpoints = CheckpointJournal.for_plan(plan_path)
+            self.fingerprints = AppliedFingerprints(plan_id(plan_path))
         else:
-            self.__plan = []
+            self.__tasks = []
+            self.checkpoints = None
+            self.fingerprints = None
 
-    def validate_plan(self):
+    def parse_plan(self, content):
+        '''
+        Parses and validates the YAML 'content' of a plan, returning its
+        tasks as a list of '[slug, details]' pairs.
+        '''
+        plan = load(content, Loader=SafeLoader)
+        self.validate_plan(plan)
+        return [list(current_task.items())[0] for current_task in plan['tasks']]
+
+    def validate_plan(self, plan):
 
         required_keys = ['tasks']
 
         self.logger.debug("Validating Plan.")
+        if not isinstance(plan, dict):
+            raise InvalidPlanError("Plan does not have a set of 'tasks'")
+
         for key in required_keys:
-            if key not in self.__plan:
+            if key not in plan:
                 raise InvalidPlanError("Plan does not have a set of 'tasks'")
                 
-        if not isinstance(self.__plan['tasks'], list):
+        if not isinstance(plan['tasks'], list):
             self.logger.error("The plan provided is not a list.")
             raise InvalidPlanError('Plan is not a list')
 
 
-        for current_task in self.__plan['tasks']:
-            if len(current_task) > 1:
+        for current_task in plan['tasks']:
+            if not isinstance(current_task, dict) or len(current_task) != 1:
                 raise InvalidPlanError("Plan's entries must be a dictionary inside a dictionary, of size 1")
 
+            details = list(current_task.values())[0]
+            if not isinstance(details, dict):
+                raise InvalidPlanError("The details of the '%s' task must be a dictionary." % (
+                    list(current_task.keys())[0]))
+
 
 
     @property
-    def setup_provisioners(self):
+    def tasks(self):
+        '''
+        Returns the tasks of the plan as a list of '(slug, details)' tuples.
+        '''
+        return [(provisioner_slug, dict(details)) for provisioner_slug, details in self.__tasks]
 
+    @property
+    def dependency_graph(self):
+        '''
+        Returns the 'DependencyGraph' of the tasks in the plan.
+        '''
         try:
-            for current_task in self.__plan['tasks']:
-
-                provisioner_slug = list(current_task.keys())[0]
-                task_details = current_task[provisioner_slug]
-
-                self.logger.debug("Instantiating Provisioner '%s' with details '%s'" % (
-                    provisioner_slug,
-                    task_details))
-
-                task_details.update(self.__globals)
-                Provisioner = Registry.get(provisioner_slug)
-                provisioner = Provisioner()
-                provisioner.set_arguments(**task_details)
-                yield provisioner
+            return DependencyGraph.from_tasks(self.tasks, Registry)
         except ValueError as e:
             click.secho("ERROR: %s" % e, fg='red')
             raise InvalidPlanError(e)
 
-    @property
-    def teardown_provisioners(self):
-
+    def make_provisioners(self, graph):
+        '''
+        Instantiates and validates the Provisioner of every node in 'graph',
+        returning a dictionary keyed by the index of the node.
+        '''
+        provisioners = {}
         try:
-            for current_task in self.__plan['tasks'][::-1]:
-
-                provisioner_slug = list(current_task.keys())[0]
-                task_details = current_task[provisioner_slug]
+            for node in graph.nodes:
 
                 self.logger.debug("Instantiating Provisioner '%s' with details '%s'" % (
-                    provisioner_slug,
-                    task_details))
+                    node.slug,
+                    node.details))
 
+                task_details = dict(node.details)
                 task_details.update(self.__globals)
-                Provisioner = Registry.get(provisioner_slug)
-                provisioner = Provisioner()
+                provisioner = node.provisioner_klass()
                 provisioner.set_arguments(**task_details)
-                yield provisioner
+                provisioners[node.index] = provisioner
         except ValueError as e:
             click.secho("ERROR: %s" % e, fg='red')
             raise InvalidPlanError(e)
+        return provisioners
 
-
-    def setup(self):
+    def prefetch(self, graph, skip=None):
         '''
-        Executes the Provisioners requested by the plan with the details
-        provided by the Plan.
+        Describes every security group, key pair and instance the plan refers
+        to, with one call per kind of resource and region, so that the
+        provisioners can look them up in the 'ResourceIndex' instead of
+        asking AWS one at a time. The nodes in 'skip' are left out.
         '''
-        for provisioner in self.setup_provisioners:
+        skip = skip if skip != None else {}
+        ResourceIndex.clear()
+        aws_access = self.__globals.get('AWS_ACCESS_KEY')
+        aws_secret = self.__globals.get('AWS_SECRET_KEY')
+        if not aws_access or not aws_secret:
+            return
+
+        config = PyCloudConfig()
+        wanted = {}
+        for node in graph.nodes:
+            region = node.details.get('region')
+            if not region or node.index in skip:
+                continue
+
+            resources = wanted.setdefault(normalize_region(region), {
+                'security_groups': set(), 'key_pairs': set(), 'instance_ids': set()})
+            provides, consumes = node.provisioner_klass.references(**node.details)
+            for namespace, value in provides | consumes:
+                if namespace == 'security_group':
+                    resources['security_groups'].add(value)
+                elif namespace == 'key_name':
+                    resources['key_pairs'].add(value)
+                elif namespace == 'instance_id_ref':
+                    resources['instance_ids'].update(config.get(value) or [])
+
+        for region, resources in sorted(wanted.items()):
+            self.logger.debug("Prefetching AWS resources in '%s': %s" % (region, resources))
+            try:
+                connection = EC2Connections.get(region, aws_access, aws_secret)
+                ResourceIndex.prefetch(connection, region, **resources)
+            except Exception:
+                # the index is only a shortcut, provisioners ask AWS for
+                # anything that it does not have
+                self.logger.warning("Unable to prefetch AWS resources in '%s'." % region, exc_info=True)
+
+    def classify_tasks(self, graph, action, keys, fingerprints, resume=None, changed_only=None, all_tasks=None):
+        '''
+        Decides which nodes of 'graph' to run, returning two dictionaries by
+        index: the reason for skipping each skipped node, and the reason for
+        running each other node (or None, if it runs for no special reason).
+
+        With 'resume', a setup skips the tasks the checkpoint journal says
+        were completed with the same fingerprint. With 'changed_only', it
+        skips the tasks whose fingerprint matches the one they were last set
+        up with. Either way, a task only gets skipped if every task it
+        depends on is skipped too. Unless 'all_tasks' is set, a teardown
+        skips the tasks that were never set up, or have been torn down
+        already.
+        '''
+        resume = resume if resume != None else False
+        changed_only = changed_only if changed_only != None else False
+        all_tasks = all_tasks if all_tasks != None else False
+
+        skipped = {}
+        reasons = {}
+        if self.checkpoints == None:
+            return skipped, dict((node.index, None) for node in graph.nodes)
+
+        if action == 'setup' and (resume or changed_only):
+            applied = self.fingerprints.get() if changed_only else {}
+            for node in graph.order:
+                key = keys[node.index]
+                if any(index not in skipped for index in node.upstream):
+                    reasons[node.index] = 'an upstream task runs'
+                elif resume and self.checkpoints.is_completed(key, fingerprints[node.index]):
+                    skipped[node.index] = 'completed in an earlier run'
+                elif changed_only and applied.get(key) == fingerprints[node.index]:
+                    skipped[node.index] = 'unchanged'
+                elif changed_only:
+                    reasons[node.index] = 'changed' if key in applied else 'new'
+                else:
+                    reasons[node.index] = 'not completed'
+
+        elif action == 'teardown' and not all_tasks and self.checkpoints.exists:
+            for node in graph.order:
+                if not self.checkpoints.is_applied(keys[node.index]):
+                    skipped[node.index] = 'not set up'
+
+        for node in graph.nodes:
+            if node.index not in skipped:
+                reasons.setdefault(node.index, None)
+        return skipped, reasons
+
+    def print_summary(self, graph, action, skipped, reasons):
+        '''
+        Prints which tasks a dry run would run, and which it would skip.
+        '''
+        click.secho("--| DRY RUN - %s: %d to run, %d to skip" % (
+            action.upper(), len(graph.nodes) - len(skipped), len(skipped)), fg='green')
+        for node in graph.order:
+            if node.index in skipped:
+                click.secho("      skip: %s (%s)" % (node.name, skipped[node.index]), fg='yellow')
+            elif reasons[node.index]:
+                click.secho("      run:  %s (%s)" % (node.name, reasons[node.index]), fg='green')
+            else:
+                click.secho("      run:  %s" % node.name, fg='green')
+
+    def restore_outputs(self, key):
+        '''
+        Puts the state a skipped task set back, if it has gone missing.
+        '''
+        record = self.checkpoints.get(key)
+        if record == None:
+            return
 
-            with TimeContext(provisioner.name):
-                provisioner.dry_run = False
-                provisioner.setup()
+        config = PyCloudConfig()
+        for state_key, value in record.get('outputs', {}).items():
+            if value != None and config.get(state_key) == None:
+                self.logger.info("Restoring '%s' from the checkpoint of task '%s'." % (state_key, key))
+                config.set(state_key, value)
 
+    def connect_streams(self, graph, provisioners, skipped):
+        '''
+        Gives the tasks joined by a streaming edge an 'OutputStream' for
+        every output streamed along it, and returns the streams. Edges from
+        or to a skipped task are turned into ordinary edges.
+        '''
+        streams = {}
+        for node in graph.nodes:
+            for upstream_index in sorted(node.streaming_upstream):
+                if node.index in skipped or upstream_index in skipped:
+                    node.streaming_upstream.discard(upstream_index)
+                    continue
+
+                upstream = graph.nodes[upstream_index]
+                outputs = upstream.provisioner_klass.streamed_references(
+                    upstream.provisioner_klass.stream_outputs, **upstream.details)
+                inputs = node.provisioner_klass.streamed_references(
+                    node.provisioner_klass.stream_inputs, **node.details)
+                for reference in set(outputs.keys()) & set(inputs.keys()):
+                    if (upstream_index, reference) not in streams:
+                        self.logger.debug("Streaming '%s' from task '%s'." % (reference[1], upstream.name))
+                        streams[(upstream_index, reference)] = OutputStream(reference[1])
+                        provisioners[upstream_index].output_streams[outputs[reference]] = \
+                            streams[(upstream_index, reference)]
+                    provisioners[node.index].input_streams[inputs[reference]] = streams[(upstream_index, reference)]
+        return list(streams.values())
+
+    def run_graph(self, graph, action, jobs=None, dry_run=None, resume=None, changed_only=None, all_tasks=None):
+        '''
+        Runs 'action' (either 'setup' or 'teardown') on the Provisioner of
+        every node in 'graph', using up to 'jobs' workers at once. The
+        progress of every task is recorded in the checkpoint journal, and
+        the fingerprint of every task that was set up in the state.
+        '''
+        jobs = jobs if jobs != None else 1
+        dry_run = dry_run if dry_run != None else False
+        provisioners = self.make_provisioners(graph)
+
+        keys = task_keys(graph.nodes)
+        fingerprints = dict((node.index, fingerprint(node.slug, provisioners[node.index].kwargs,
+                                                     version=node.provisioner_klass.version))
+                            for node in graph.nodes)
+        skipped, reasons = self.classify_tasks(graph, action, keys, fingerprints, resume=resume,
+                                               changed_only=changed_only, all_tasks=all_tasks)
+        if dry_run:
+            self.print_summary(graph, action, skipped, reasons)
+        elif skipped:
+            self.logger.info("Skipping %d of %d tasks." % (len(skipped), len(graph.nodes)))
+        self.prefetch(graph, skip=skipped)
+        record = self.checkpoints != None and not dry_run
+
+        # tasks only stream their outputs to the tasks running alongside them
+        if jobs > 1 and not dry_run:
+            streams = self.connect_streams(graph, provisioners, skipped)
+        else:
+            streams = []
+            for node in graph.nodes:
+                node.streaming_upstream.clear()
+
+        def run_task(node):
+
+            key = keys[node.index]
+            if node.index in skipped:
+                click.secho("--| SKIP - TASK: %s (%s)" % (node.name, skipped[node.index]), fg='yellow')
+                if action == 'setup' and not dry_run:
+                    self.restore_outputs(key)
+                return
+
+            provisioner = provisioners[node.index]
+            label = node.name if jobs > 1 else None
+            with Tracer.span(node.name, category='task', parent=plan_span, slug=node.slug, action=action,
+                             task=key), \
+                    TimeContext(provisioner.name, dry_run=dry_run, label=label):
+                provisioner.dry_run = dry_run
+                if record:
+                    self.checkpoints.record(key, action, STARTED, fingerprint=fingerprints[node.index])
+
+                # the state a task changes is written out once it finishes
+                with provisioner.config.batch():
+                    try:
+                        getattr(provisioner, action)()
+                    except Exception as e:
+                        for stream in provisioner.output_streams.values():
+                            stream.fail(e)
+                        if record:
+                            self.checkpoints.record(key, action, FAILED, fingerprint=fingerprints[node.index],
+                                                    error='%s: %s' % (e.__class__.__name__, e))
+                        raise
+
+                    outputs = dict((state_key, provisioner.config.get(state_key))
+                                   for state_key in provisioner.config.pending_keys)
+
+                for stream in provisioner.output_streams.values():
+                    stream.close()
+
+                if record:
+                    self.checkpoints.record(key, action, COMPLETED, fingerprint=fingerprints[node.index],
+                                            outputs=outputs)
+                    if action == 'setup':
+                        self.fingerprints.set(key, fingerprints[node.index])
+                    else:
+                        self.fingerprints.discard(key)
+
+        def execute(node):
+
+            try:
+                run_task(node)
+            finally:
+                # whatever stopped the task (even before or after its action
+                # ran), its consumers must not wait for more outputs
+                for stream in provisioners[node.index].output_streams.values():
+                    stream.fail(RuntimeError("Task '%s' stopped before it finished." % node.name))
+
+        # the report of the run is built from its spans, so they are
+        # recorded even when no trace was asked for
+        tracing = Tracer.enabled
+        if not tracing and not dry_run:
+            Tracer.enable()
+        plan_span = None
+        try:
+            with Tracer.span(action, category='plan', plan=self.plan_path, jobs=jobs, tasks=len(graph.nodes),
+                             skipped=len(skipped), dry_run=dry_run) as plan_span:
+                TaskScheduler(graph, jobs=jobs).run(execute)
+        finally:
+            for stream in streams:
+                stream.fail(RuntimeError('The plan stopped before the task finished.'))
+            ResourceIndex.clear()
+            self.close_sessions()
+            self.report_connections()
+            if not dry_run and plan_span != None:
+                self.report_run(graph, action, keys, plan_span, skipped)
+            if not tracing:
+                Tracer.disable()
+
+    def report_run(self, graph, action, keys, plan_span, skipped):
+        '''
+        Prints the 'RunReport' of the run, and saves it in 'report_dir'.
+        The report is only a summary, so failing to make it never fails the
+        run, nor hides the error the run failed with.
+        '''
+        try:
+            run_report = RunReport(graph, action, keys, plan_span, Tracer.spans, skipped=skipped)
+            report = run_report.to_dict()
+            run_report.print_report(report)
+            if self.report_dir != None:
+                run_report.save(RunReport.path_for(self.plan_path, action, self.report_dir), report)
+        except Exception:
+            self.logger.warning("Unable to report on the run.", exc_info=True)
+
+    def close_sessions(self):
+        '''
+        Closes the SSH sessions opened while running the plan, forgets which
+        SSH ports were found open, and reports how often both were reused.
+        '''
+        stats = SessionPool.stats
+        SessionPool.close_all()
+        if stats['hits'] or stats['misses']:
+            self.logger.info("SSH Session Pool: %d hits, %d misses, %d evictions." % (
+                stats['hits'], stats['misses'], stats['evictions']))
+        SessionPool.reset_stats()
+
+        stats = PortProber.stats
+        PortProber.forget()
+        if stats['attempts'] or stats['hits']:
+            self.logger.info("SSH Port Checks: %d connection attempts, %d answered from earlier checks." % (
+                stats['attempts'], stats['hits']))
+        PortProber.reset_stats()
+
+    def report_connections(self):
+        '''
+        Reports how many EC2 connections the plan created.
+        '''
+        stats = EC2Connections.stats
+        if stats['created'] or stats['hits']:
+            self.logger.info("EC2 Connections: %d created, %d reused, regions: %s." % (
+                stats['created'], stats['hits'], ', '.join(stats['regions'])))
+        EC2Connections.reset_stats()
 
-    def dry_setup(self):
+    def setup(self, jobs=None, resume=None, changed_only=None):
         '''
-        Simply prints out the plans that are going to be executed.
+        Executes the Provisioners requested by the plan with the details
+        provided by the Plan. Tasks that do not depend on each other run
+        concurrently on up to 'jobs' workers. With 'resume', the tasks that
+        an earlier run completed with the same arguments are skipped, and
+        with 'changed_only', the tasks whose fingerprint (and the ones of
+        the tasks they depend on) did not change since they were last set
+        up.
         '''
-        for provisioner in self.setup_provisioners:
+        self.run_graph(self.dependency_graph, 'setup', jobs=jobs, resume=resume, changed_only=changed_only)
 
-            with TimeContext(provisioner.name, dry_run=True):
-                provisioner.dry_run = True
-                provisioner.setup()
 
-    def teardown(self):
+    def dry_setup(self, jobs=None, resume=None, changed_only=None):
         '''
-        Executes the Provisioners requested by the plan in erverse order with
-        the details provided by the Plan.
+        Simply prints out the plans that are going to be executed.
         '''
-        for provisioner in self.teardown_provisioners:
+        self.run_graph(self.dependency_graph, 'setup', jobs=jobs, dry_run=True, resume=resume,
+                       changed_only=changed_only)
 
-            with TimeContext(provisioner.name):
-                provisioner.dry_run = False
-                provisioner.teardown()
-
-    def dry_teardown(self):
+    def teardown(self, jobs=None, all_tasks=None):
         '''
-        Executes the Provisioners requested by the plan in erverse order with
-        the details provided by the Plan.
+        Executes the Provisioners requested by the plan in reverse order with
+        the details provided by the Plan. A task is torn down once every task
+        that depended on it has been torn down, and independent tasks are
+        torn down concurrently on up to 'jobs' workers. Tasks the checkpoint
+        journal has no record of setting up are skipped, unless 'all_tasks'
+        is set.
         '''
-        for provisioner in self.teardown_provisioners:
+        self.run_graph(self.dependency_graph.reversed(), 'teardown', jobs=jobs, all_tasks=all_tasks)
 
-            with TimeContext(provisioner.name):
-                provisioner.dry_run = True
-                provisioner.teardown()
+    def dry_teardown(self, jobs=None, all_tasks=None):
+        '''
+        Simply prints out the teardown plans that are going to be executed.
+        '''
+        self.run_graph(self.dependency_graph.reversed(), 'teardown', jobs=jobs, dry_run=True, all_tasks=all_tasks)
 
     def help(self):
         '''
         Prints out helpful information for each Provisioner.
         '''
-        for slug, Provisioner in Registry.content.items():
+        for slug in Registry.slugs:
 
-            Provisioner.help()
+            Registry.get(slug).help()
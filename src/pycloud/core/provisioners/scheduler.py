@@ -0,0 +1,241 @@
+import heapq
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from pycloud.base import Base
+from pycloud.core.errors import InvalidPlanError
+
+
+class TaskNode(object):
+    '''
+    A single task of the plan, along with the tasks it has to wait for.
+    '''
+    def __init__(self, index, slug, details, depends_on=None):
+
+        self.index = index
+        self.slug = slug
+        self.details = details
+        self.name = details.get('name')
+        self.explicit_depends_on = depends_on if depends_on != None else []
+
+        # indices of the nodes that this node waits for, and that wait for it
+        self.upstream = set()
+        self.downstream = set()
+
+        # the upstream nodes this node only has to wait to start for (rather
+        # than finish), since it consumes their outputs as they are streamed
+        self.streaming_upstream = set()
+
+    def __repr__(self):
+
+        return '<TaskNode %d: %s (%s)>' % (self.index, self.name, self.slug)
+
+
+class DependencyGraph(Base):
+    '''
+    Builds a directed acyclic graph from the tasks of a plan.
+
+    Edges are inferred from the resources that tasks share (see
+    'BaseProvisioner.references()'), and from the explicit 'depends_on' key
+    of a task, which holds the name (or list of names) of the tasks it needs
+    to run after.
+
+    An inferred edge is a streaming edge when the upstream task streams the
+    output the downstream task uses ('stream_outputs'), and the downstream
+    task can consume it that way ('stream_inputs'). The downstream task may
+    then run alongside the upstream one.
+    '''
+    def __init__(self, nodes, reverse=None):
+
+        super(DependencyGraph, self).__init__()
+        self.nodes = nodes
+
+        # a reversed graph prefers to run later tasks of the plan first
+        self.reverse = reverse if reverse != None else False
+
+    @classmethod
+    def from_tasks(cls, tasks, registry):
+        '''
+        Creates the graph for a list of '(slug, details)' tuples, using
+        'registry' to look up the Provisioner Class of each slug.
+        '''
+        nodes = []
+        for index, (slug, details) in enumerate(tasks):
+            details = dict(details)
+            depends_on = details.pop('depends_on', None)
+            if depends_on == None:
+                depends_on = []
+            elif not isinstance(depends_on, list):
+                depends_on = [depends_on]
+
+            node = TaskNode(index, slug, details, depends_on=depends_on)
+            node.provisioner_klass = registry.get(slug)
+            nodes.append(node)
+
+        graph = cls(nodes)
+        graph.link_nodes()
+        graph.order = graph.topological_order()
+        return graph
+
+    def reversed(self):
+        '''
+        Returns a copy of this graph with every edge pointing the other way,
+        so that a task only runs once every task that depended on it has.
+        '''
+        nodes = []
+        for node in self.nodes:
+            copy = TaskNode(node.index, node.slug, node.details, depends_on=node.explicit_depends_on)
+            copy.provisioner_klass = node.provisioner_klass
+            copy.upstream = set(node.downstream)
+            copy.downstream = set(node.upstream)
+            nodes.append(copy)
+
+        graph = DependencyGraph(nodes, reverse=not self.reverse)
+        graph.order = graph.topological_order()
+        return graph
+
+    def priority(self, index):
+        '''
+        Returns the sort key used to pick between nodes that are ready to run.
+        '''
+        return -index if self.reverse else index
+
+    def add_edge(self, upstream, downstream, streaming=None):
+
+        if upstream.index == downstream.index:
+            return
+
+        # an edge is only streaming if every reason for it is
+        if streaming and upstream.index not in downstream.upstream:
+            downstream.streaming_upstream.add(upstream.index)
+        elif not streaming:
+            downstream.streaming_upstream.discard(upstream.index)
+        downstream.upstream.add(upstream.index)
+        upstream.downstream.add(downstream.index)
+
+    def link_nodes(self):
+        '''
+        Adds the inferred and explicit edges between the nodes.
+        '''
+        producers = {}
+        names = {}
+        for node in self.nodes:
+            names.setdefault(node.name, []).append(node)
+
+        for node in self.nodes:
+            klass = node.provisioner_klass
+            provides, consumes = klass.references(**node.details)
+            stream_inputs = klass.streamed_references(klass.stream_inputs, **node.details)
+
+            # a task waits for the most recent earlier task that created
+            # a resource it uses
+            for reference in consumes:
+                if reference in producers:
+                    producer = producers[reference]
+                    stream_outputs = producer.provisioner_klass.streamed_references(
+                        producer.provisioner_klass.stream_outputs, **producer.details)
+                    self.add_edge(producer, node,
+                                  streaming=reference in stream_inputs and reference in stream_outputs)
+
+            for reference in provides:
+                producers[reference] = node
+
+            for task_name in node.explicit_depends_on:
+                if task_name not in names:
+                    raise InvalidPlanError("Task '%s' depends on '%s', which is not a task in the plan." % (
+                        node.name, task_name))
+                for upstream in names[task_name]:
+                    self.add_edge(upstream, node)
+
+    def topological_order(self):
+        '''
+        Returns the nodes in an order that respects every edge, keeping to
+        the order of the plan wherever the edges allow it.
+        '''
+        remaining = dict((node.index, len(node.upstream)) for node in self.nodes)
+        ready = [(self.priority(node.index), node.index) for node in self.nodes if remaining[node.index] == 0]
+        heapq.heapify(ready)
+
+        order = []
+        while ready:
+            _, index = heapq.heappop(ready)
+            order.append(self.nodes[index])
+            for downstream in self.nodes[index].downstream:
+                remaining[downstream] -= 1
+                if remaining[downstream] == 0:
+                    heapq.heappush(ready, (self.priority(downstream), downstream))
+
+        if len(order) != len(self.nodes):
+            cyclic = [node.name for node in self.nodes if remaining[node.index] > 0]
+            raise InvalidPlanError("The plan has a dependency cycle between tasks: %s" % ', '.join(cyclic))
+        return order
+
+
+class TaskScheduler(Base):
+    '''
+    Runs the nodes of a 'DependencyGraph' on a bounded pool of workers,
+    starting each node as soon as everything it depends on has finished,
+    or for streaming edges, has started.
+
+    When a node fails, no new nodes are started, the nodes that are already
+    running are allowed to finish, and the first error is raised.
+    '''
+    def __init__(self, graph, jobs=None):
+
+        super(TaskScheduler, self).__init__()
+        self.graph = graph
+        self.jobs = jobs if jobs != None else 1
+
+    def run(self, execute):
+        '''
+        Calls 'execute(node)' for every node of the graph.
+        '''
+        if self.jobs <= 1:
+            for node in self.graph.order:
+                execute(node)
+            return
+
+        graph = self.graph
+        nodes = graph.nodes
+
+        # how many upstream nodes each node still waits for
+        remaining = dict((node.index, len(node.upstream)) for node in nodes)
+        ready = [(graph.priority(node.index), node.index) for node in nodes if remaining[node.index] == 0]
+        heapq.heapify(ready)
+
+        # lets the nodes that wait for 'node' to start (over a streaming edge)
+        # or to finish know that it did
+        def release(node, streaming):
+            for downstream in node.downstream:
+                if (node.index in nodes[downstream].streaming_upstream) == streaming:
+                    remaining[downstream] -= 1
+                    if remaining[downstream] == 0:
+                        heapq.heappush(ready, (graph.priority(downstream), downstream))
+
+        running = {}
+        failure = None
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while running or (ready and failure == None):
+
+                while ready and failure == None and len(running) < self.jobs:
+                    _, index = heapq.heappop(ready)
+                    node = nodes[index]
+                    self.logger.debug("Scheduling task '%s'." % node.name)
+                    running[pool.submit(execute, node)] = node
+                    release(node, streaming=True)
+
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    error = future.exception()
+                    if error != None:
+                        if failure == None:
+                            self.logger.error("Task '%s' failed. Waiting for %d running task(s) to finish." % (
+                                node.name, len(running)))
+                            failure = error
+                        continue
+
+                    release(node, streaming=False)
+
+        if failure != None:
+            raise failure
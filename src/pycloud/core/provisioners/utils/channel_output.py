@@ -0,0 +1,166 @@
+import codecs
+import os
+import re
+import threading
+import time
+
+from pycloud.core.metrics import Metrics
+
+# how many bytes are read from a channel at a time
+DEFAULT_CHUNK_SIZE = 32768
+
+# lines longer than this many characters are passed on in pieces, so that
+# output without newlines does not pile up in memory
+DEFAULT_MAX_LINE_LENGTH = 65536
+
+# how long to sleep when a channel has nothing to read
+DEFAULT_POLL_INTERVAL = 0.02
+
+# the directory the output of the commands run on each host is written to
+HOST_LOG_DIR_ENV = 'PYCLOUD_HOST_LOG_DIR'
+
+# every command run on an instance gets an exec channel of its own
+SSH_COMMANDS = Metrics.counter('pycloud_ssh_commands_total', 'Commands run over SSH exec channels, by outcome.',
+                               label_names=['result'])
+
+SSH_COMMAND_SECONDS = Metrics.histogram('pycloud_ssh_command_seconds', 'How long commands run over SSH took.')
+
+# scripts are sent to 'bash -s' on the stdin of their command
+SSH_STDIN_BYTES = Metrics.counter('pycloud_ssh_stdin_bytes_total',
+                                  'Bytes written to the stdin of commands run over SSH (like scripts).')
+
+
+class LineSplitter(object):
+    '''
+    Turns the chunks of bytes read from a stream into lines (without their
+    newline), and calls 'callback(line)' for every one of them. At most
+    'max_line_length' characters of an unfinished line are held.
+    '''
+    def __init__(self, callback, max_line_length=None):
+
+        self.callback = callback
+        self.max_line_length = max_line_length if max_line_length != None else DEFAULT_MAX_LINE_LENGTH
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.pending = ''
+
+    def feed(self, data):
+
+        self.pending += self.decoder.decode(data)
+        lines = self.pending.split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.callback(line.rstrip('\r'))
+
+        while len(self.pending) >= self.max_line_length:
+            self.callback(self.pending[:self.max_line_length])
+            self.pending = self.pending[self.max_line_length:]
+
+    def flush(self):
+        '''
+        Passes on what is left of the last line, once the stream ended.
+        '''
+        self.pending += self.decoder.decode(b'', final=True)
+        if self.pending:
+            self.callback(self.pending.rstrip('\r'))
+        self.pending = ''
+
+
+def stream_channel(channel, on_stdout=None, on_stderr=None, chunk_size=None, poll_interval=None, stdin_data=None):
+    '''
+    Writes 'stdin_data' to the stdin of the command running on the paramiko
+    'channel' and closes it, while reading its stdout and stderr as the
+    output arrives, passing every line to 'on_stdout(line)' or
+    'on_stderr(line)', until the command exits. Returns its exit status.
+
+    Writes only go out when the channel's window has room, and both output
+    streams are drained as they fill, so neither side ever blocks on a full
+    window, however much the command reads or writes.
+    '''
+    chunk_size = chunk_size if chunk_size != None else DEFAULT_CHUNK_SIZE
+    poll_interval = poll_interval if poll_interval != None else DEFAULT_POLL_INTERVAL
+    stdout = LineSplitter(on_stdout if on_stdout != None else (lambda line: None))
+    stderr = LineSplitter(on_stderr if on_stderr != None else (lambda line: None))
+
+    if isinstance(stdin_data, str):
+        stdin_data = stdin_data.encode('utf-8')
+    pending = memoryview(stdin_data if stdin_data != None else b'')
+    if not pending:
+        channel.shutdown_write()
+
+    while True:
+        idle = True
+        if pending and channel.exit_status_ready():
+            # the command exited without reading all of its stdin
+            pending = pending[:0]
+        elif pending and channel.send_ready():
+            try:
+                sent = channel.send(bytes(pending[:chunk_size]))
+            except (EOFError, OSError):
+                sent = len(pending)
+            else:
+                SSH_STDIN_BYTES.inc(sent)
+            pending = pending[sent:]
+            if not pending:
+                channel.shutdown_write()
+            idle = idle and sent == 0
+
+        if channel.recv_ready():
+            stdout.feed(channel.recv(chunk_size))
+            idle = False
+        if channel.recv_stderr_ready():
+            stderr.feed(channel.recv_stderr(chunk_size))
+            idle = False
+
+        if idle:
+            # paramiko buffers all the output sent before the exit status
+            # by the time the exit status is ready
+            if not pending and channel.exit_status_ready() and not channel.recv_ready() \
+                    and not channel.recv_stderr_ready():
+                break
+            time.sleep(poll_interval)
+
+    stdout.flush()
+    stderr.flush()
+    return channel.recv_exit_status()
+
+
+class HostLogFile(object):
+    '''
+    Appends the output of the commands run on 'host' to '<log_dir>/<host>.log',
+    one line at a time, prefixed with the stream it came from.
+    '''
+    # one lock per path, since several commands can run on a host at once
+    locks = {}
+
+    locks_lock = threading.Lock()
+
+    def __init__(self, log_dir, host):
+
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir, exist_ok=True)
+        self.path = os.path.join(log_dir, '%s.log' % re.sub(r'[^A-Za-z0-9._-]', '_', host))
+        with HostLogFile.locks_lock:
+            self.lock = HostLogFile.locks.setdefault(self.path, threading.Lock())
+        self.file = open(self.path, 'a')
+
+    @classmethod
+    def open_for(cls, host):
+        '''
+        Returns the log file of 'host' in the directory named by the
+        PYCLOUD_HOST_LOG_DIR environment variable, or None when it is not
+        set.
+        '''
+        log_dir = os.environ.get(HOST_LOG_DIR_ENV)
+        if not log_dir:
+            return None
+        return cls(log_dir, host)
+
+    def write(self, stream, line):
+
+        with self.lock:
+            self.file.write('%s %s: %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), stream, line))
+            self.file.flush()
+
+    def close(self):
+
+        self.file.close()
@@ -0,0 +1,127 @@
+import re
+import threading
+
+from pycloud.base import Base
+from pycloud.core.metrics import Metrics
+from pycloud.core.tracing import Tracer
+
+# an availability zone is its region followed by a single letter
+AVAILABILITY_ZONE_PATTERN = re.compile(r'^([a-z]{2}(?:-[a-z]+)*-\d+)[a-z]$')
+
+AWS_REQUESTS = Metrics.counter('pycloud_aws_requests_total', 'AWS API requests, by action, region and HTTP status.',
+                               label_names=['action', 'region', 'status'])
+
+AWS_REQUEST_SECONDS = Metrics.histogram('pycloud_aws_request_seconds', 'Latency of AWS API requests, by action.',
+                                        label_names=['action'])
+
+
+def normalize_region(region):
+    '''
+    Returns the region name for 'region', which can also be an availability
+    zone like 'us-east-1a'.
+    '''
+    region = region.strip().lower()
+    match = AVAILABILITY_ZONE_PATTERN.match(region)
+    if match:
+        return match.group(1)
+    return region
+
+
+class EC2ConnectionCache(Base):
+    '''
+    Shares one boto EC2 connection per (region, access key) across every
+    provisioner and thread of the process, instead of connecting for each
+    'up()' and 'down()'.
+    '''
+    def __init__(self):
+
+        super(EC2ConnectionCache, self).__init__()
+        self.__connections = {}
+        self.__lock = threading.Lock()
+
+        self.hits = 0
+        self.created = 0
+
+    def get(self, region, aws_access, aws_secret):
+        '''
+        Returns the connection to 'region' for the given credentials.
+        '''
+        region = normalize_region(region)
+        key = (region, aws_access)
+        with self.__lock:
+            if key in self.__connections:
+                self.hits += 1
+                return self.__connections[key]
+
+            # boto is slow to import, so it is only imported once a
+            # provisioner actually talks to AWS.
+            from boto import ec2
+
+            self.logger.debug("Connecting to EC2 in region '%s'." % region)
+            connection = ec2.connect_to_region(
+                region,
+                aws_access_key_id=aws_access,
+                aws_secret_access_key=aws_secret)
+            if connection == None:
+                raise ValueError("'%s' is not a valid AWS region." % region)
+            self.trace_requests(connection, region)
+
+            self.created += 1
+            self.__connections[key] = connection
+            return connection
+
+    def trace_requests(self, connection, region):
+        '''
+        Times every API call made with 'connection' (they all go through
+        its 'make_request') in an 'aws' span, and counts it in the metrics.
+        '''
+        make_request = connection.make_request
+
+        def traced_make_request(action, *args, **kwargs):
+            status = 'error'
+            try:
+                with Tracer.span(action, category='aws', region=region) as span, \
+                        AWS_REQUEST_SECONDS.time(action=action):
+                    response = make_request(action, *args, **kwargs)
+                    status = getattr(response, 'status', None)
+                    span.set(status=status)
+                    return response
+            finally:
+                AWS_REQUESTS.inc(action=action, region=region, status=status)
+        connection.make_request = traced_make_request
+
+    def clear(self):
+        '''
+        Closes and forgets every cached connection.
+        '''
+        with self.__lock:
+            connections = list(self.__connections.values())
+            self.__connections.clear()
+
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception:
+                self.logger.debug("Unable to cleanly close EC2 connection.", exc_info=True)
+
+    @property
+    def stats(self):
+        '''
+        Returns how many connections were created, how often a cached one
+        was reused, and which regions are connected.
+        '''
+        with self.__lock:
+            return {
+                'created': self.created,
+                'hits': self.hits,
+                'regions': sorted(set(region for region, _ in self.__connections.keys())),
+            }
+
+    def reset_stats(self):
+
+        with self.__lock:
+            self.hits = 0
+            self.created = 0
+
+
+EC2Connections = EC2ConnectionCache()
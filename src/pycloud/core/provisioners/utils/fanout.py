@@ -0,0 +1,127 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pycloud.core.errors import HostFailureError
+from pycloud.core.tracing import Tracer
+from pycloud.logger import get_logger
+
+logger = get_logger()
+
+DEFAULT_MAX_PARALLEL_HOSTS = 10
+
+
+class HostResult(object):
+    '''
+    The outcome of running a per-host operation on a single host.
+    '''
+    def __init__(self, host, exit_status=None, error=None):
+
+        self.host = host
+        self.exit_status = exit_status
+        self.error = error
+
+    @property
+    def ok(self):
+
+        return self.error == None and self.exit_status == 0
+
+    def __repr__(self):
+
+        if self.error != None:
+            return '<HostResult %s: %s>' % (self.host, self.error)
+        return '<HostResult %s: exit status %s>' % (self.host, self.exit_status)
+
+
+class FanOutResult(object):
+    '''
+    The aggregated outcome of running a per-host operation on many hosts.
+    '''
+    def __init__(self):
+
+        self.results = []
+        self.__lock = threading.Lock()
+
+    def add(self, result):
+
+        with self.__lock:
+            self.results.append(result)
+
+    @property
+    def succeeded(self):
+
+        return [r for r in self.results if r.ok]
+
+    @property
+    def failed(self):
+
+        return [r for r in self.results if not r.ok]
+
+    @property
+    def exit_statuses(self):
+        '''
+        Returns a dictionary of host to exit status (None if it raised).
+        '''
+        return dict((r.host, r.exit_status) for r in self.results)
+
+    @property
+    def failure_percent(self):
+
+        if not self.results:
+            return 0.0
+        return 100.0 * len(self.failed) / len(self.results)
+
+    def summary(self):
+
+        return '%d/%d hosts succeeded' % (len(self.succeeded), len(self.results))
+
+
+def fan_out(items, func, host=None, max_parallel_hosts=None, max_failed_hosts_percent=None):
+    '''
+    Calls 'func(item)' for every item in 'items', running up to
+    'max_parallel_hosts' of them at the same time, and returns a
+    'FanOutResult'.
+
+    'func' returns the exit status of the work it did on the host, where 0
+    means success. 'host(item)' returns the name the item is reported under.
+    'items' is consumed lazily, so work on the first hosts starts while later
+    ones are still being produced.
+
+    If more than 'max_failed_hosts_percent' (default 0) of the hosts failed,
+    a 'HostFailureError' is raised once every host has finished.
+    '''
+    host = host if host != None else str
+    max_parallel_hosts = max_parallel_hosts if max_parallel_hosts != None else DEFAULT_MAX_PARALLEL_HOSTS
+    max_failed_hosts_percent = max_failed_hosts_percent if max_failed_hosts_percent != None else 0
+
+    result = FanOutResult()
+
+    # the hosts run on the pool's threads, but are part of the caller's span
+    parent = Tracer.current()
+
+    def run(item):
+
+        name = host(item)
+        with Tracer.span(name, category='host', parent=parent, host=name) as span:
+            try:
+                exit_status = func(item)
+                span.set(exit_status=exit_status)
+                result.add(HostResult(name, exit_status=exit_status))
+            except Exception as e:
+                logger.exception("Operation failed on host '%s'." % name)
+                span.set(error='%s: %s' % (e.__class__.__name__, e))
+                result.add(HostResult(name, error=e))
+
+    with ThreadPoolExecutor(max_workers=max(1, int(max_parallel_hosts))) as pool:
+        for item in items:
+            pool.submit(run, item)
+
+    for failure in result.failed:
+        logger.error("Host '%s' failed: %s" % (failure.host, failure.error if failure.error != None
+                                                 else 'exit status %s' % failure.exit_status))
+
+    if result.failure_percent > max_failed_hosts_percent:
+        raise HostFailureError('%s; %.1f%% of hosts failed, which is more than the %s%% tolerated.' % (
+            result.summary(), result.failure_percent, max_failed_hosts_percent), results=result)
+
+    return result
@@ -0,0 +1,93 @@
+import getpass
+import multiprocessing
+import os
+import socket
+
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+# the key types that are generated in-process, instead of with 'ssh-keygen'
+IN_PROCESS_KEY_TYPES = ['ecdsa', 'ed25519', 'rsa']
+
+# the key sizes 'ssh-keygen' uses by default
+RSA_KEY_SIZE = 3072
+
+ECDSA_CURVE = ec.SECP256R1
+
+
+def default_comment():
+    '''
+    Returns the comment 'ssh-keygen' gives keys by default: 'user@host'.
+    '''
+    return '%s@%s' % (getpass.getuser(), socket.gethostname())
+
+
+def generate_key(key_type):
+    '''
+    Returns a new private key of 'key_type' ('rsa', 'ecdsa' or 'ed25519').
+    '''
+    if key_type == 'rsa':
+        return rsa.generate_private_key(public_exponent=65537, key_size=RSA_KEY_SIZE)
+    elif key_type == 'ecdsa':
+        return ec.generate_private_key(ECDSA_CURVE())
+    elif key_type == 'ed25519':
+        return ed25519.Ed25519PrivateKey.generate()
+    raise ValueError("Key type '%s' can not be generated in-process. Allowed types: %s" % (
+        key_type, IN_PROCESS_KEY_TYPES))
+
+
+def serialize_key(key, passphrase=None, comment=None):
+    '''
+    Returns the private key in the OpenSSH format (encrypted with
+    'passphrase' unless it is empty), and the public key line.
+    '''
+    encryption = serialization.BestAvailableEncryption(passphrase.encode('utf-8')) if passphrase \
+        else serialization.NoEncryption()
+    private_bytes = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH, encryption)
+    public_bytes = key.public_key().public_bytes(serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH)
+    if comment:
+        public_bytes += b' ' + comment.encode('utf-8')
+    return private_bytes, public_bytes + b'\n'
+
+
+def write_key_pair(key_type, private_path, passphrase=None, comment=None):
+    '''
+    Generates a key of 'key_type', and writes it to 'private_path' (only
+    readable by its owner) and its public key to '<private_path>.pub', like
+    'ssh-keygen -f private_path' would. Returns the path of the public key.
+    '''
+    private_bytes, public_bytes = serialize_key(generate_key(key_type), passphrase=passphrase,
+        comment=comment if comment != None else default_comment())
+
+    fd = os.open(private_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(private_bytes)
+
+    public_path = '%s.pub' % private_path
+    with open(public_path, 'wb') as f:
+        f.write(public_bytes)
+    return public_path
+
+
+def write_key_pairs(key_type, private_paths, passphrase=None, comments=None, max_workers=None):
+    '''
+    Generates a key of 'key_type' for every path in 'private_paths' (see
+    'write_key_pair'), with the comment of the same index in 'comments', and
+    returns the paths of the public keys.
+
+    RSA keys take long enough to generate that they are spread across a pool
+    of up to 'max_workers' processes (default: one per CPU). Other keys are
+    generated here. The pool's processes are spawned rather than forked,
+    since other threads (running other tasks) may hold locks a forked
+    process would inherit held.
+    '''
+    comments = comments if comments != None else [None] * len(private_paths)
+    if key_type != 'rsa' or len(private_paths) < 2:
+        return [write_key_pair(key_type, path, passphrase, comment) for path, comment in zip(private_paths, comments)]
+
+    max_workers = min(len(private_paths), max_workers if max_workers != None else (os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return list(pool.map(write_key_pair, [key_type] * len(private_paths), private_paths,
+                             [passphrase] * len(private_paths), comments))
@@ -1,14 +1,30 @@
+import contextlib
 import os
 import paramiko
 import shutil
-import time
-import uuid
 
-from boto import ec2
+from boto.exception import EC2ResponseError
 from sultan.api import Sultan
 
 from pycloud.base import Base
-from pycloud.core.provisioners.utils.networking import is_port_open
+from pycloud.core.errors import WaiterTimeoutError
+from pycloud.core.provisioners.utils.channel_output import HostLogFile, SSH_COMMAND_SECONDS, SSH_COMMANDS, \
+    stream_channel
+from pycloud.core.provisioners.utils.connections import EC2Connections
+from pycloud.core.provisioners.utils.fanout import fan_out
+from pycloud.core.provisioners.utils.networking import PortProber
+from pycloud.core.provisioners.utils.remote_script import STEP_MARKER
+from pycloud.core.provisioners.utils.resource_index import ResourceIndex, UNKNOWN, \
+    INSTANCES, KEY_PAIRS, SECURITY_GROUPS
+from pycloud.core.provisioners.utils.session_pool import SessionPool
+from pycloud.core.provisioners.utils.transfers import FileTransfer
+from pycloud.core.metrics import Metrics
+from pycloud.core.tracing import Tracer
+
+SSH_CONNECTIONS = Metrics.counter('pycloud_ssh_connections_total', 'SSH connections (and handshakes), by outcome.',
+                                  label_names=['result'])
+
+SSH_CONNECT_SECONDS = Metrics.histogram('pycloud_ssh_connect_seconds', 'How long SSH handshakes took.')
 
 class FileSystemProvisionerMixin(Base):
 
@@ -38,95 +54,296 @@ class FileSystemProvisionerMixin(Base):
 
 class AWSProvisionerMixin(Base):
 
-    def get_paramiko_client(self, connection, instance, fs_keypair, username, ssh_port=22, max_rt=5):
+    @contextlib.contextmanager
+    def ssh_client(self, connection, instance, fs_keypair, username, ssh_port=22, max_rt=5):
+        '''
+        Yields a connected Paramiko Client for the instance from the SSH
+        session pool, only connecting when the pool has no live session to
+        the instance for this user and key. The pool does not close the
+        session while the block runs.
         '''
-        Generates a new Paramiko Client from the AWS connection, instance details
-        and fs key pair details.
+        hostname = instance.public_dns_name
+        session_key = (hostname, int(ssh_port), username, fs_keypair.path)
+        with SessionPool.session(session_key, lambda: self.connect_paramiko_client(
+                hostname, fs_keypair, username, ssh_port=ssh_port, max_rt=max_rt)) as client:
+            yield client
+
+    # seconds 'max_rt' retries of the SSH port check add up to
+    SSH_PORT_RETRY_INTERVAL = 10
+
+    def wait_for_ssh(self, hostnames, ssh_port=22, max_rt=5):
+        '''
+        Waits for the SSH port of every host in 'hostnames' to accept
+        connections, probing all of them at once, for up to 'max_rt' times
+        'SSH_PORT_RETRY_INTERVAL' seconds.
+        '''
+        with Tracer.span('ssh port wait', category='wait', hosts=len(hostnames), port=int(ssh_port)):
+            PortProber.wait([(hostname, int(ssh_port)) for hostname in hostnames],
+                            timeout=max_rt * AWSProvisionerMixin.SSH_PORT_RETRY_INTERVAL)
+
+    def connect_paramiko_client(self, hostname, fs_keypair, username, ssh_port=22, max_rt=5):
         '''
-        key = paramiko.RSAKey.from_private_key_file(fs_keypair.path)
+        Generates a new Paramiko Client from the instance's hostname and fs
+        key pair details.
+        '''
+        key = fs_keypair.private_key
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-        # get details about the instance
-        hostname = instance.public_dns_name
-
         # test if default ssh port is accepting connections
-        for i in range(max_rt):
-
-            if is_port_open(hostname, int(ssh_port)):
-                break
-            
-            self.logger.info("SSH Port Check %d/%d Times - Port is Not Open. Trying in 10 seconds" % (i+1, max_rt))
-            time.sleep(10)
-        self.logger.debug("SSH Port Check %d/%d Times - Passed" % (i, max_rt))
-        
+        self.wait_for_ssh([hostname], ssh_port=ssh_port, max_rt=max_rt)
+
         # make connection
-        client.connect(hostname=hostname, username=username, pkey=key)
+        try:
+            with Tracer.span('ssh connect', category='ssh', host=hostname, port=int(ssh_port), user=username), \
+                    SSH_CONNECT_SECONDS.time():
+                client.connect(hostname=hostname, port=int(ssh_port), username=username, pkey=key)
+        except Exception:
+            SSH_CONNECTIONS.inc(result='failed')
+            PortProber.forget(hostname, ssh_port)
+            raise
+        SSH_CONNECTIONS.inc(result='ok')
         return client
 
-    def sftp_file(self, connection, instance, fs_keypair, username, ssh_port, source, destination, max_rt=5):
+    def sftp_file(self, connection, instance, fs_keypair, username, ssh_port, source, destination, max_rt=5,
+                  mode=None, owner=None, sudo=None):
         '''
-        Transfers an individual file from source to destination using Secure 
-        File Transfer Protocol (SFTP).
+        Transfers an individual file from source to destination using Secure
+        File Transfer Protocol (SFTP), skipping it if an identical file is
+        already there, and returns a 'TransferResult'. Destinations the user
+        can not write to are staged and moved into place with sudo. See
+        'pycloud.core.provisioners.utils.transfers.FileTransfer' for details.
         '''
-        transfer_id = str(uuid.uuid4()).replace('-', '')
-        hostname = instance.public_dns_name
-        client = self.get_paramiko_client(connection, instance, fs_keypair, username, ssh_port=ssh_port, max_rt=max_rt)
-        
-        # scp to a temporary place, and then move to final path
-        filename = os.path.basename(source)
-        temp_destination = os.path.join('/tmp', transfer_id, filename)
-        
-        # make the parent directory in the remote system
-        temp_destination_parent = os.path.dirname(temp_destination)
-        self.logger.debug("Making directory: %s" % temp_destination_parent)
-        self.run_shell_command(connection, instance, fs_keypair, username, ssh_port, 
-            'sudo mkdir -p "%s"' % (temp_destination_parent), 
-            max_rt=max_rt)
-
-        self.logger.debug("Changing Ownership of Temporary Directory to %s:%s: %s " % (username, username, temp_destination))
-        self.run_shell_command(connection, instance, fs_keypair, username, ssh_port,
-            'sudo chown -R %s:%s %s' % (username, username, temp_destination_parent)
-        )
-
-        self.logger.info("Starting transfer of '%s' to '%s@%s:%s'" % (source, username, hostname, destination))
-        self.logger.debug("Transfering '%s' temporarily to '%s' before moving to '%s'" % (source, temp_destination, destination))
-        sftp_client = client.open_sftp()
-        sftp_client.put(source, temp_destination)
-        sftp_client.close()
-
-        # move the file to the final destination
-        self.run_shell_command(connection, instance, fs_keypair, username, ssh_port, 
-            'sudo mv "%s" "%s"' % (temp_destination, destination), 
-            max_rt=max_rt)
-
-    def run_shell_command(self, connection, instance, fs_keypair, username, ssh_port, command, max_rt=5):
-        '''
-        Runs a command on the provided EC2 Instance as the user.
+        with self.ssh_client(connection, instance, fs_keypair, username, ssh_port=ssh_port, max_rt=max_rt) as client:
+            return FileTransfer(client, instance.public_dns_name).put(source, destination, mode=mode, owner=owner,
+                                                                         sudo=sudo)
+
+    # how many lines of a script's output are kept to report it
+    MAX_CAPTURED_LINES = 1000
+
+    def exec_command(self, client, hostname, command, stdin_data=None, on_stdout=None, on_stderr=None):
+        '''
+        Runs 'command' over a new channel of 'client', writing 'stdin_data'
+        to its stdin, and returns its exit status. Its output is streamed,
+        line by line, to 'on_stdout(line)' and 'on_stderr(line)' (by
+        default, the log), and to the host's log file when
+        PYCLOUD_HOST_LOG_DIR is set.
+        '''
+        host_log = HostLogFile.open_for(hostname)
+        on_stdout = on_stdout if on_stdout != None else \
+            (lambda line: self.logger.debug('[%s] STDOUT: %s' % (hostname, line)))
+        on_stderr = on_stderr if on_stderr != None else \
+            (lambda line: self.logger.warning('[%s] STDERR: %s' % (hostname, line)))
+
+        def stdout_line(line):
+            on_stdout(line)
+            if host_log != None:
+                host_log.write('STDOUT', line)
+
+        def stderr_line(line):
+            on_stderr(line)
+            if host_log != None:
+                host_log.write('STDERR', line)
+
+        exit_status = None
+        try:
+            if host_log != None:
+                host_log.write('COMMAND', command)
+            with Tracer.span('remote command', category='ssh', host=hostname, command=command) as span, \
+                    SSH_COMMAND_SECONDS.time():
+                _, stdout, _ = client.exec_command(command)
+                exit_status = stream_channel(stdout.channel, on_stdout=stdout_line, on_stderr=stderr_line,
+                                             stdin_data=stdin_data)
+                span.set(exit_status=exit_status, stdin_bytes=len(stdin_data) if stdin_data != None else 0)
+            if host_log != None:
+                host_log.write('EXIT', str(exit_status))
+        finally:
+            SSH_COMMANDS.inc(result='ok' if exit_status == 0 else 'failed')
+            if host_log != None:
+                host_log.close()
+        return exit_status
+
+    def run_shell_command(self, connection, instance, fs_keypair, username, ssh_port, command, max_rt=5,
+                          on_stdout=None, on_stderr=None):
+        '''
+        Runs a command on the provided EC2 Instance as the user, streaming
+        its output to 'on_stdout(line)' and 'on_stderr(line)' (by default,
+        the log) while it runs, and returns its exit status.
         '''
         hostname = instance.public_dns_name
-        client = self.get_paramiko_client(connection, instance, fs_keypair, username, ssh_port=ssh_port, max_rt=max_rt)
         self.logger.info("Running Command on %s@%s: %s" % (username, hostname, command))
-        result = client.exec_command(command)
-        exit_status = -1
-        if result:
-            stdin, stdout, stderr = result
-            exit_status = stdout.channel.recv_exit_status()
+        with self.ssh_client(connection, instance, fs_keypair, username, ssh_port=ssh_port, max_rt=max_rt) as client:
+            exit_status = self.exec_command(client, hostname, command, on_stdout=on_stdout, on_stderr=on_stderr)
+        if exit_status != 0:
+            self.logger.error("Command on '%s' exited with status %s: %s" % (hostname, exit_status, command))
+        return exit_status
 
-            for line in stdout.readlines():
-                self.logger.error('STDOUT: %s' % line.strip('\n'))
-                self.logger.error('EXIT CODE: %s' % exit_status)
+    def run_script(self, connection, instance, fs_keypair, username, ssh_port, script, max_rt=5):
+        '''
+        Runs the 'RemoteScript' on the provided EC2 Instance as the user,
+        sending it over a single channel, and returns its
+        'RemoteScriptResult'. Only the first 'MAX_CAPTURED_LINES' lines of
+        its output are kept in the result.
+        '''
+        hostname = instance.public_dns_name
+        self.logger.info("Running %d steps on %s@%s: %s" % (
+            len(script.steps), username, hostname, '; '.join(step.description for step in script.steps)))
 
-            for line in stderr.readlines():
-                self.logger.error('STDERR: %s' % line.strip('\n'))
-                self.logger.error('EXIT CODE: %s' % exit_status)
+        stdout_lines = []
+        stderr_lines = []
 
-        return exit_status
-     
-    def ec2_connect(self, region, aws_access, aws_secret):
+        def capture(lines, log):
+            def on_line(line):
+                # the step markers are always kept
+                if STEP_MARKER in line or len(lines) < AWSProvisionerMixin.MAX_CAPTURED_LINES:
+                    lines.append(line)
+                if STEP_MARKER not in line:
+                    log(line)
+            return on_line
+
+        with self.ssh_client(connection, instance, fs_keypair, username, ssh_port=ssh_port, max_rt=max_rt) as client:
+            exit_status = self.exec_command(client, hostname, 'bash -s', stdin_data=script.render(),
+                on_stdout=capture(stdout_lines, lambda line: self.logger.debug('[%s] STDOUT: %s' % (hostname, line))),
+                on_stderr=capture(stderr_lines,
+                                  lambda line: self.logger.warning('[%s] STDERR: %s' % (hostname, line))))
+        result = script.parse(stdout_lines, stderr_lines, exit_status)
 
-        conn = ec2.connect_to_region(
-            'us-east-1', 
-            aws_access_key_id=aws_access, 
-            aws_secret_access_key=aws_secret)
-        return conn
\ No newline at end of file
+        if result.failed_step != None:
+            self.logger.error("Step '%s' failed on '%s' with exit status %s." % (
+                result.failed_step.description, hostname, result.exit_status))
+        return result
+
+    def run_on_instances(self, instances, func, max_parallel_hosts=None, max_failed_hosts_percent=None,
+                         ssh_port=None, max_rt=5):
+        '''
+        Calls 'func(instance)' for every instance, on up to 'max_parallel_hosts'
+        instances at the same time, and returns the aggregated 'FanOutResult'.
+        See 'pycloud.core.provisioners.utils.fanout.fan_out' for details.
+
+        With 'ssh_port' set, the SSH ports of a list of instances are all
+        probed at once before the fan-out starts, and the instances whose
+        port did not open fail without running 'func'. Streamed instances
+        are probed one at a time, as they arrive.
+        '''
+        if ssh_port != None and isinstance(instances, (list, tuple)) and instances:
+            unreachable = set()
+            try:
+                self.wait_for_ssh([instance.public_dns_name for instance in instances], ssh_port=ssh_port,
+                                  max_rt=max_rt)
+            except WaiterTimeoutError as e:
+                unreachable = set(host for host, _ in e.pending or [])
+                self.logger.error(str(e))
+
+            def probed(instance):
+
+                if instance.public_dns_name in unreachable:
+                    raise WaiterTimeoutError("SSH port %s of '%s' did not open." % (
+                        ssh_port, instance.public_dns_name), pending=[(instance.public_dns_name, int(ssh_port))])
+                return func(instance)
+        else:
+            probed = func
+
+        return fan_out(instances, probed,
+            host=lambda instance: instance.public_dns_name or instance.id,
+            max_parallel_hosts=max_parallel_hosts,
+            max_failed_hosts_percent=max_failed_hosts_percent)
+
+    def iter_instances(self, connection, region, instance_id_ref):
+        '''
+        Returns the instances referenced by 'instance_id_ref'. When the task
+        creating them streams them, they are yielded as they start running,
+        and the ones it had already created before are yielded once it ends.
+        Otherwise, they are returned as a list.
+        '''
+        stream = self.input_streams.get('instance_id_ref')
+        if stream == None:
+            instance_ids = self.config.get(instance_id_ref) or []
+            if not instance_ids:
+                raise ValueError("There are 0 instances referenced by '%s'." % instance_id_ref)
+            return self.find_instances(connection, region, instance_ids)
+        return self.iter_streamed_instances(connection, region, instance_id_ref, stream)
+
+    def iter_streamed_instances(self, connection, region, instance_id_ref, stream):
+
+        seen = set()
+        for instance in stream:
+            seen.add(instance.id)
+            yield instance
+
+        instance_ids = [instance_id for instance_id in self.config.get(instance_id_ref) or []
+                        if instance_id not in seen]
+        if not seen and not instance_ids:
+            raise ValueError("There are 0 instances referenced by '%s'." % instance_id_ref)
+
+        for instance in self.find_instances(connection, region, instance_ids) if instance_ids else []:
+            yield instance
+
+    def find_security_group(self, connection, region, group_name):
+        '''
+        Returns the security group named 'group_name', or None if it does not
+        exist, using the prefetched resource index when it can.
+        '''
+        group = ResourceIndex.lookup(region, SECURITY_GROUPS, group_name)
+        if group is UNKNOWN:
+            groups = connection.get_all_security_groups(filters={'group-name': group_name})
+            group = groups[0] if groups else None
+        return group
+
+    def find_key_pair(self, connection, region, key_name):
+        '''
+        Returns the key pair named 'key_name', or None if it does not exist,
+        using the prefetched resource index when it can.
+        '''
+        key_pair = ResourceIndex.lookup(region, KEY_PAIRS, key_name)
+        if key_pair is UNKNOWN:
+            key_pairs = connection.get_all_key_pairs(filters={'key-name': key_name})
+            key_pair = key_pairs[0] if key_pairs else None
+        return key_pair
+
+    def find_instances(self, connection, region, instance_ids):
+        '''
+        Returns the instances with the given ids that exist, only describing
+        the ones the prefetched resource index does not know about.
+        '''
+        found = {}
+        missing = []
+        for instance_id in instance_ids:
+            instance = ResourceIndex.lookup(region, INSTANCES, instance_id)
+            if instance is UNKNOWN:
+                missing.append(instance_id)
+            elif instance != None:
+                found[instance_id] = instance
+
+        if missing:
+            for instance in connection.get_only_instances(filters={'instance-id': missing}):
+                found[instance.id] = instance
+        return [found[instance_id] for instance_id in instance_ids if instance_id in found]
+
+    def invalidate_resource(self, region, kind, key):
+        '''
+        Tells the resource index that the resource 'key' of type 'kind' was
+        created, changed or deleted.
+        '''
+        ResourceIndex.invalidate(region, kind, key)
+
+    def call_aws(self, description, func, *args, **kwargs):
+        '''
+        Returns 'func(*args, **kwargs)'. On a dry run, AWS only checks that
+        the call would succeed, and answers with a 'DryRunOperation' error
+        when it would, so that error is logged with 'description' and None
+        is returned instead.
+        '''
+        try:
+            return func(*args, **kwargs)
+        except EC2ResponseError as e:
+            if not self.dry_run or e.error_code != 'DryRunOperation':
+                raise
+            self.logger.info("%s would succeed if dry-run flag was not set." % description)
+            return None
+
+    def ec2_connect(self, region, aws_access, aws_secret):
+        '''
+        Returns the shared EC2 connection to 'region' (which can also be an
+        availability zone, like 'us-east-1a').
+        '''
+        return EC2Connections.get(region, aws_access, aws_secret)
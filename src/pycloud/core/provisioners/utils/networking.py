@@ -1,8 +1,188 @@
+import errno
+import random
+import selectors
 import socket
+import threading
+import time
 
-def is_port_open(host, port):
+from pycloud.base import Base
+from pycloud.core.errors import WaiterTimeoutError
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    result = sock.connect_ex((host, port))
-    return result == 0 # True if result is 0, else False
+# connect_ex() results meaning the connection is still being established
+IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
 
+
+def is_port_open(host, port, timeout=None):
+    '''
+    Returns whether or not a TCP connection to 'port' on 'host' can be made
+    within 'timeout' seconds (default: 3).
+    '''
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout if timeout != None else 3)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
+
+
+class PortReadinessProber(Base):
+    '''
+    Checks whether many '(host, port)' pairs accept TCP connections at once,
+    with one non-blocking socket per pair, all waited on with a single
+    selector.
+
+    Every round gives each pending pair up to 'attempt_timeout' seconds to
+    connect. Rounds are spaced with exponential backoff and jitter, starting
+    at 'initial_delay' seconds and capped at 'max_delay'. Pairs that were
+    found open are remembered until 'forget()' is called, so that later
+    connections to the same host skip the check.
+    '''
+    DEFAULT_ATTEMPT_TIMEOUT = 3
+
+    DEFAULT_INITIAL_DELAY = 1
+
+    DEFAULT_MAX_DELAY = 10
+
+    DEFAULT_TIMEOUT = 300
+
+    def __init__(self, attempt_timeout=None, initial_delay=None, max_delay=None):
+
+        super(PortReadinessProber, self).__init__()
+        self.attempt_timeout = attempt_timeout if attempt_timeout != None \
+            else PortReadinessProber.DEFAULT_ATTEMPT_TIMEOUT
+        self.initial_delay = initial_delay if initial_delay != None else PortReadinessProber.DEFAULT_INITIAL_DELAY
+        self.max_delay = max_delay if max_delay != None else PortReadinessProber.DEFAULT_MAX_DELAY
+
+        self.__open = set()
+        self.__lock = threading.Lock()
+
+        self.attempts = 0
+        self.hits = 0
+
+    def forget(self, host=None, port=None):
+        '''
+        Forgets that '(host, port)' was open, or every pair if neither is
+        given.
+        '''
+        with self.__lock:
+            if host == None and port == None:
+                self.__open.clear()
+            else:
+                self.__open.discard((host, int(port)))
+
+    def connect(self, target):
+        '''
+        Starts a non-blocking connection to 'target', returning the socket,
+        or None if the connection was refused right away or the host can not
+        be resolved.
+        '''
+        host, port = target
+        try:
+            family, kind, proto, _, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        except socket.gaierror as e:
+            self.logger.debug("Unable to resolve '%s': %s" % (host, e))
+            return None
+
+        sock = socket.socket(family, kind, proto)
+        sock.setblocking(False)
+        result = sock.connect_ex(address)
+        if result == 0 or result in IN_PROGRESS:
+            return sock
+        sock.close()
+        return None
+
+    def probe(self, targets, timeout=None):
+        '''
+        Makes one connection attempt to every '(host, port)' pair in
+        'targets' at the same time, and returns the set of pairs that
+        accepted it within 'timeout' seconds (default: 'attempt_timeout').
+        '''
+        timeout = timeout if timeout != None else self.attempt_timeout
+        connected = set()
+        selector = selectors.DefaultSelector()
+        try:
+            for target in targets:
+                sock = self.connect(target)
+                with self.__lock:
+                    self.attempts += 1
+                if sock != None:
+                    selector.register(sock, selectors.EVENT_WRITE, target)
+
+            deadline = time.time() + timeout
+            while selector.get_map():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                for key, _ in selector.select(remaining):
+                    sock = key.fileobj
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                        connected.add(key.data)
+                    selector.unregister(sock)
+                    sock.close()
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+        return connected
+
+    def backoff(self, attempt, deadline):
+        '''
+        Returns how long to sleep before round 'attempt', never sleeping past
+        'deadline'.
+        '''
+        delay = min(self.max_delay, self.initial_delay * (2 ** attempt))
+        delay = random.uniform(delay / 2.0, delay)
+        return max(0, min(delay, deadline - time.time()))
+
+    def wait(self, targets, timeout=None):
+        '''
+        Waits until every '(host, port)' pair in 'targets' accepts
+        connections, probing the pending ones every round, and returns.
+        Raises a 'WaiterTimeoutError' naming the pairs that are still not
+        open after 'timeout' seconds (default: 300).
+        '''
+        targets = [(host, int(port)) for host, port in targets]
+        timeout = timeout if timeout != None else PortReadinessProber.DEFAULT_TIMEOUT
+        deadline = time.time() + timeout
+
+        with self.__lock:
+            pending = [target for target in targets if target not in self.__open]
+            self.hits += len(targets) - len(pending)
+        attempt = 0
+        while pending:
+            opened = self.probe(pending, timeout=min(self.attempt_timeout, max(0, deadline - time.time())))
+            with self.__lock:
+                self.__open.update(opened)
+            pending = [target for target in pending if target not in opened]
+            if not pending:
+                break
+
+            if time.time() >= deadline:
+                raise WaiterTimeoutError('%d of %d ports were not open within %d seconds: %s' % (
+                    len(pending), len(targets), timeout,
+                    ', '.join('%s:%d' % target for target in pending)), pending=pending)
+
+            delay = self.backoff(attempt, deadline)
+            self.logger.info('Waiting for %d of %d ports to open. Checking again in %.1f seconds.' % (
+                len(pending), len(targets), delay))
+            time.sleep(delay)
+            attempt += 1
+
+    @property
+    def stats(self):
+        '''
+        Returns how many connection attempts were made, and how many checks
+        were answered from the pairs known to be open.
+        '''
+        with self.__lock:
+            return {'attempts': self.attempts, 'hits': self.hits, 'open': len(self.__open)}
+
+    def reset_stats(self):
+
+        with self.__lock:
+            self.attempts = 0
+            self.hits = 0
+
+
+PortProber = PortReadinessProber()
@@ -0,0 +1,169 @@
+import base64
+import hashlib
+import shlex
+
+# the line every step of a script prints after it ran, with its index and
+# exit status, so that the statuses can be told apart from its output
+STEP_MARKER = '__PYCLOUD_STEP__'
+
+# the line that ends the embedded content of a file
+PAYLOAD_DELIMITER = '__PYCLOUD_PAYLOAD__'
+
+# base64 encoded payloads are wrapped at this many characters per line
+PAYLOAD_LINE_LENGTH = 76
+
+
+class ScriptStep(object):
+    '''
+    A step of a 'RemoteScript': the shell code it runs, a description to
+    report it under, and the exit statuses that let the script go on.
+    '''
+    def __init__(self, code, description=None, ok_statuses=None):
+
+        self.code = code
+        self.description = description if description != None else code
+        self.ok_statuses = tuple(ok_statuses) if ok_statuses != None else (0,)
+
+
+class RemoteScript(object):
+    '''
+    An ordered list of commands and file payloads that runs on a remote host
+    as a single bash script, sent over one SSH channel. File contents are
+    embedded in the script with heredocs, so no separate transfer is needed,
+    and are only written where the remote file differs.
+
+    The script stops at the first step whose exit status is not one of the
+    step's 'ok_statuses', and reports the exit status of every step that
+    ran.
+    '''
+    def __init__(self):
+
+        self.steps = []
+
+    def run(self, command, description=None, ok_statuses=None):
+        '''
+        Adds a step running the shell 'command'.
+        '''
+        self.steps.append(ScriptStep(command, description=description, ok_statuses=ok_statuses))
+        return self
+
+    def write_file(self, destination, content, sudo=False, mode=None, owner=None, description=None):
+        '''
+        Adds a step writing 'content' (bytes or text) to the remote file
+        'destination', as root if 'sudo' is set, with the given 'mode' and
+        'owner' ('user' or 'user:group'). The file is only written if its
+        sha256 digest differs, and otherwise only gets its mode and owner
+        set.
+        '''
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        encoded = base64.b64encode(content).decode('ascii')
+        lines = [encoded[i:i + PAYLOAD_LINE_LENGTH] for i in range(0, len(encoded), PAYLOAD_LINE_LENGTH)]
+
+        prefix = 'sudo ' if sudo else ''
+        path = shlex.quote(destination)
+        if mode == None and owner == None:
+            write = '%stee %s > /dev/null' % (prefix, path)
+            attributes = []
+        else:
+            options = ['-m %o' % (mode if mode != None else 0o644)]
+            attributes = ['%schmod %o %s' % (prefix, mode, path)] if mode != None else []
+            if owner != None:
+                user, _, group = owner.partition(':')
+                options.append('-o %s' % shlex.quote(user))
+                if group:
+                    options.append('-g %s' % shlex.quote(group))
+                attributes.append('%schown %s %s' % (prefix, shlex.quote(owner), path))
+            write = '%sinstall %s /dev/stdin %s' % (prefix, ' '.join(options), path)
+
+        code = 'if [ "$(%ssha256sum %s 2>/dev/null | cut -d " " -f 1)" != %s ]; then\n' \
+               "base64 -d <<'%s' | %s\n%s\n%s\n" % (
+                   prefix, path, hashlib.sha256(content).hexdigest(), PAYLOAD_DELIMITER, write, '\n'.join(lines),
+                   PAYLOAD_DELIMITER)
+        if attributes:
+            code += 'else\n%s\n' % ' && '.join(attributes)
+        code += 'fi'
+        self.steps.append(ScriptStep(code, description=description if description != None
+                                     else 'write %s' % destination))
+        return self
+
+    def put_file(self, source, destination, sudo=False, mode=None, owner=None, description=None):
+        '''
+        Adds a step copying the local file 'source' to the remote file
+        'destination'. See 'write_file' for details.
+        '''
+        with open(source, 'rb') as f:
+            content = f.read()
+        return self.write_file(destination, content, sudo=sudo, mode=mode, owner=owner,
+                               description=description if description != None
+                               else 'copy %s to %s' % (source, destination))
+
+    def render(self):
+        '''
+        Returns the bash script running every step.
+        '''
+        lines = ['set -o pipefail']
+        for index, step in enumerate(self.steps):
+            # every step runs in a subshell, so that one calling 'exit' is
+            # still reported, and without the stdin the script is read from
+            lines.append('(\n%s\n) < /dev/null' % step.code)
+            lines.append('__status=$?')
+            lines.append('echo "%s %d $__status"' % (STEP_MARKER, index))
+            lines.append('case $__status in %s) ;; *) exit $__status ;; esac' % (
+                '|'.join(str(status) for status in step.ok_statuses)))
+        lines.append('exit 0')
+        return '\n'.join(lines) + '\n'
+
+    def parse(self, stdout_lines, stderr_lines, exit_status):
+        '''
+        Returns the 'RemoteScriptResult' of running the script, given the
+        lines it printed and its exit status.
+        '''
+        statuses = [None] * len(self.steps)
+        output = []
+        for line in stdout_lines:
+            line = line.rstrip('\n')
+
+            # a step whose output does not end with a newline shares its
+            # last line with the marker
+            before, marker, after = line.partition(STEP_MARKER)
+            if before or not marker:
+                output.append(before)
+            if marker:
+                index, status = after.split()
+                statuses[int(index)] = int(status)
+        return RemoteScriptResult(self.steps, statuses, exit_status, output,
+                                  [line.rstrip('\n') for line in stderr_lines])
+
+
+class RemoteScriptResult(object):
+    '''
+    The exit status of every step of a 'RemoteScript' (None for the steps
+    that did not run), the exit status of the whole script, and its output.
+    '''
+    def __init__(self, steps, step_statuses, exit_status, stdout, stderr):
+
+        self.steps = steps
+        self.step_statuses = step_statuses
+        self.exit_status = exit_status
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def ok(self):
+
+        return self.exit_status == 0
+
+    @property
+    def failed_step(self):
+        '''
+        Returns the step that stopped the script, or None.
+        '''
+        for step, status in zip(self.steps, self.step_statuses):
+            if status != None and status not in step.ok_statuses:
+                return step
+        return None
+
+    def status_of(self, index):
+
+        return self.step_statuses[index]
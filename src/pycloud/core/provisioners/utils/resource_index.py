@@ -0,0 +1,95 @@
+import threading
+
+from pycloud.base import Base
+from pycloud.core.provisioners.utils.connections import normalize_region
+
+SECURITY_GROUPS = 'security_groups'
+
+KEY_PAIRS = 'key_pairs'
+
+INSTANCES = 'instances'
+
+
+class Unknown(object):
+    '''
+    Returned by lookups the index cannot answer, in which case the caller
+    has to ask AWS.
+    '''
+    def __repr__(self):
+
+        return 'UNKNOWN'
+
+UNKNOWN = Unknown()
+
+
+class AWSResourceIndex(Base):
+    '''
+    An in-memory index of the security groups, key pairs and instances that
+    a plan refers to, filled in with one describe call per resource type and
+    region before the plan runs, so that provisioners can look resources up
+    without calling AWS again.
+
+    Every prefetched kind of resource in a region is indexed by key (the
+    group name, key name or instance id). A key that was prefetched but not
+    found is known not to exist. Once a provisioner creates or deletes a
+    resource it invalidates its key, and lookups for it go back to AWS.
+    '''
+    def __init__(self):
+
+        super(AWSResourceIndex, self).__init__()
+        self.__lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+
+        with self.__lock:
+            # (region, kind) -> {key: resource}, and the keys that were asked for
+            self.__resources = {}
+            self.__prefetched = {}
+
+    def prefetch(self, connection, region, security_groups=None, key_pairs=None, instance_ids=None):
+        '''
+        Describes the named security groups, key pairs and instances in
+        'region', with one call per kind of resource.
+        '''
+        region = normalize_region(region)
+        if security_groups:
+            groups = connection.get_all_security_groups(filters={'group-name': sorted(security_groups)})
+            self.store(region, SECURITY_GROUPS, security_groups, dict((g.name, g) for g in groups))
+
+        if key_pairs:
+            pairs = connection.get_all_key_pairs(filters={'key-name': sorted(key_pairs)})
+            self.store(region, KEY_PAIRS, key_pairs, dict((k.name, k) for k in pairs))
+
+        if instance_ids:
+            instances = connection.get_only_instances(filters={'instance-id': sorted(instance_ids)})
+            self.store(region, INSTANCES, instance_ids, dict((i.id, i) for i in instances))
+
+    def store(self, region, kind, requested, resources):
+
+        with self.__lock:
+            self.__resources.setdefault((region, kind), {}).update(resources)
+            self.__prefetched.setdefault((region, kind), set()).update(requested)
+            self.logger.debug("Indexed %d of %d %s in '%s'." % (len(resources), len(set(requested)), kind, region))
+
+    def lookup(self, region, kind, key):
+        '''
+        Returns the indexed resource, None if it is known not to exist, or
+        UNKNOWN if the index cannot tell.
+        '''
+        region = normalize_region(region)
+        with self.__lock:
+            if key not in self.__prefetched.get((region, kind), ()):
+                return UNKNOWN
+            return self.__resources[(region, kind)].get(key)
+
+    def invalidate(self, region, kind, key):
+        '''
+        Forgets what the index knows about 'key', after it was changed.
+        '''
+        region = normalize_region(region)
+        with self.__lock:
+            self.__prefetched.get((region, kind), set()).discard(key)
+            self.__resources.get((region, kind), {}).pop(key, None)
+
+ResourceIndex = AWSResourceIndex()
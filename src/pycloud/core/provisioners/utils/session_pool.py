@@ -0,0 +1,220 @@
+import contextlib
+import threading
+import time
+
+from collections import OrderedDict
+
+from pycloud.base import Base
+
+
+class PooledSession(object):
+    '''
+    A connected 'paramiko.SSHClient', how many threads are using it, and
+    when it was last released.
+    '''
+    def __init__(self, client):
+
+        self.client = client
+        self.users = 0
+        self.last_used = time.time()
+
+    @property
+    def in_use(self):
+
+        return self.users > 0
+
+
+class SSHSessionPool(Base):
+    '''
+    Keeps connected SSH clients around so that every command and file
+    transfer to the same host opens a new channel on an existing transport,
+    instead of going through a port check, key parsing and SSH handshake.
+
+    Sessions are keyed by '(host, port, username, key_path)'. A session is
+    in use from 'get()' until the matching 'release()' (see 'session()'),
+    and only sessions no thread is using are closed: once they sat idle for
+    'idle_timeout' seconds, or, least recently used first, while there are
+    more than 'max_size' sessions.
+    '''
+    DEFAULT_MAX_SIZE = 64
+
+    DEFAULT_IDLE_TIMEOUT = 300
+
+    def __init__(self, max_size=None, idle_timeout=None):
+
+        super(SSHSessionPool, self).__init__()
+        self.max_size = max_size if max_size != None else SSHSessionPool.DEFAULT_MAX_SIZE
+        self.idle_timeout = idle_timeout if idle_timeout != None else SSHSessionPool.DEFAULT_IDLE_TIMEOUT
+
+        self.__sessions = OrderedDict()
+        self.__lock = threading.RLock()
+        self.__connect_locks = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def is_alive(self, client):
+        '''
+        Returns whether or not 'client' still has a usable transport.
+        '''
+        transport = client.get_transport()
+        if transport == None or not transport.is_active():
+            return False
+
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def close_session(self, session):
+
+        try:
+            session.client.close()
+        except Exception:
+            self.logger.debug("Unable to cleanly close SSH session.", exc_info=True)
+
+    def evict_idle(self):
+        '''
+        Closes the sessions that no thread has used for 'idle_timeout' seconds.
+        '''
+        now = time.time()
+        with self.__lock:
+            for key, session in list(self.__sessions.items()):
+                if not session.in_use and now - session.last_used > self.idle_timeout:
+                    self.logger.debug("Closing idle SSH session to %s@%s:%s" % (key[2], key[0], key[1]))
+                    del self.__sessions[key]
+                    self.close_session(session)
+                    self.evictions += 1
+
+    def evict_overflow(self):
+        '''
+        Closes the least recently used sessions no thread is using, while
+        there are more than 'max_size' sessions.
+        '''
+        with self.__lock:
+            for key, session in list(self.__sessions.items()):
+                if len(self.__sessions) <= self.max_size:
+                    break
+                if not session.in_use:
+                    del self.__sessions[key]
+                    self.close_session(session)
+                    self.evictions += 1
+
+    def checkout(self, key):
+        '''
+        Returns the live client stored under 'key', marked as in use, or None.
+        '''
+        with self.__lock:
+            session = self.__sessions.pop(key, None)
+            if session == None:
+                return None
+
+            if not self.is_alive(session.client):
+                self.logger.debug("SSH session to %s@%s:%s is no longer alive." % (key[2], key[0], key[1]))
+                self.close_session(session)
+                return None
+
+            # re-inserting moves the session to the most recently used end
+            session.users += 1
+            self.__sessions[key] = session
+            return session.client
+
+    def get(self, key, connect):
+        '''
+        Returns a connected client for 'key', calling 'connect()' to create
+        one if the pool does not already have a live session for it. The
+        session stays open at least until it is handed back with 'release()'.
+        '''
+        self.evict_idle()
+        with self.__lock:
+            connect_lock = self.__connect_locks.setdefault(key, threading.Lock())
+
+        # only one thread at a time makes the handshake for a given key, and
+        # the others wait for it and reuse its session.
+        with connect_lock:
+            client = self.checkout(key)
+            if client != None:
+                with self.__lock:
+                    self.hits += 1
+                return client
+
+            client = connect()
+            session = PooledSession(client)
+            session.users += 1
+            with self.__lock:
+                self.misses += 1
+                self.__sessions[key] = session
+            self.evict_overflow()
+            return client
+
+    def release(self, key, client):
+        '''
+        Hands back a client returned by 'get()', once the caller is done
+        with it.
+        '''
+        with self.__lock:
+            session = self.__sessions.get(key)
+            if session == None or session.client is not client:
+                # the session was discarded or replaced while it was in use
+                return
+            session.users = max(0, session.users - 1)
+            session.last_used = time.time()
+        self.evict_overflow()
+
+    @contextlib.contextmanager
+    def session(self, key, connect):
+        '''
+        Yields a connected client for 'key' (see 'get()'), and releases it
+        when the block exits.
+        '''
+        client = self.get(key, connect)
+        try:
+            yield client
+        finally:
+            self.release(key, client)
+
+    def discard(self, key):
+        '''
+        Closes and forgets the session stored under 'key'.
+        '''
+        with self.__lock:
+            session = self.__sessions.pop(key, None)
+        if session != None:
+            self.close_session(session)
+
+    def close_all(self):
+        '''
+        Closes every session in the pool.
+        '''
+        with self.__lock:
+            sessions = list(self.__sessions.values())
+            self.__sessions.clear()
+            self.__connect_locks.clear()
+
+        for session in sessions:
+            self.close_session(session)
+
+    @property
+    def stats(self):
+        '''
+        Returns the hit, miss and eviction counts of the pool.
+        '''
+        with self.__lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'open': len(self.__sessions),
+            }
+
+    def reset_stats(self):
+
+        with self.__lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+SessionPool = SSHSessionPool()
@@ -0,0 +1,68 @@
+import threading
+
+
+class OutputStream(object):
+    '''
+    A stream of the outputs a task produces while it runs (like the
+    instances an 'ec2_instance' task launches), which tasks that depend on
+    it can consume as they arrive, instead of waiting for the task to end.
+
+    Every consumer iterates over all the items, from the first one. Once
+    the producing task ends the stream is either closed, which ends the
+    iteration, or failed, which raises the task's error in every consumer.
+    '''
+    def __init__(self, name):
+
+        self.name = name
+        self.__items = []
+        self.__closed = False
+        self.__error = None
+        self.__condition = threading.Condition()
+
+    def put(self, item):
+
+        with self.__condition:
+            if self.__closed:
+                raise ValueError("Output stream '%s' has already been closed." % self.name)
+            self.__items.append(item)
+            self.__condition.notify_all()
+
+    def close(self):
+
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def fail(self, error):
+        '''
+        Closes the stream, making its consumers raise 'error' once they have
+        consumed the items that were put before.
+        '''
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__error = error
+            self.__closed = True
+            self.__condition.notify_all()
+
+    @property
+    def closed(self):
+
+        return self.__closed
+
+    def __iter__(self):
+
+        index = 0
+        while True:
+            with self.__condition:
+                while index >= len(self.__items) and not self.__closed:
+                    self.__condition.wait()
+
+                if index < len(self.__items):
+                    item = self.__items[index]
+                elif self.__error != None:
+                    raise RuntimeError("The task producing '%s' failed: %s" % (self.name, self.__error))
+                else:
+                    return
+            index += 1
+            yield item
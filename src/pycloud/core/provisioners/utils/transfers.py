@@ -0,0 +1,254 @@
+import hashlib
+import os
+import shlex
+import shutil
+import uuid
+
+import paramiko
+
+from pycloud.base import Base
+from pycloud.core.provisioners.utils.channel_output import SSH_COMMAND_SECONDS, SSH_COMMANDS, stream_channel
+from pycloud.core.metrics import Metrics
+from pycloud.core.tracing import Tracer
+
+# files at least this large get an SFTP channel with a larger window
+LARGE_FILE_SIZE = 1024 * 1024
+
+# the window of the SFTP channel used for large files, so that pipelined
+# writes are not held back waiting for the server to open the window
+LARGE_FILE_WINDOW_SIZE = 16 * 1024 * 1024
+
+# how many bytes are read from the local file, and hashed, at a time
+CHUNK_SIZE = 256 * 1024
+
+SFTP_TRANSFERS = Metrics.counter('pycloud_sftp_transfers_total', 'Files put on instances, by how they got there.',
+                                 label_names=['result'])
+
+SFTP_BYTES = Metrics.counter('pycloud_sftp_bytes_total', 'Bytes sent to instances over SFTP.')
+
+
+def local_digest(path):
+    '''
+    Returns the size and the sha256 hex digest of the local file at 'path'.
+    '''
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+class TransferResult(object):
+    '''
+    What a 'FileTransfer' did to put 'source' at 'destination': whether it
+    was skipped (since the remote file had the same content), and if so,
+    whether only its mode or owner had to be changed, whether it was
+    written directly or staged and moved into place with sudo, and how many
+    bytes were sent.
+    '''
+    def __init__(self, source, destination, skipped=False, staged=False, size=0, updated=False):
+
+        self.source = source
+        self.destination = destination
+        self.skipped = skipped
+        self.staged = staged
+        self.size = size
+        self.updated = updated
+
+    def __repr__(self):
+
+        return '<TransferResult %s -> %s (%s)>' % (self.source, self.destination,
+            'skipped' if self.skipped else 'staged' if self.staged else 'direct')
+
+
+class FileTransfer(Base):
+    '''
+    Puts local files on the host an SSH 'client' is connected to.
+
+    Before sending anything, a single command checks whether the
+    destination is writable by the SSH user, and the size, mode, owner and
+    sha256 digest of the file already there. Files with the same content
+    are not sent again, and only get their mode and owner fixed if those
+    differ. Writable
+    destinations are written directly, with pipelined SFTP writes. Other
+    destinations are written to a private file in the staging directory,
+    which one more command installs with sudo (setting its mode and owner)
+    and removes, whether or not that worked.
+    '''
+    SUDO = 'sudo -n'
+
+    # where files for destinations only root can write to are staged
+    STAGING_DIR = '/tmp'
+
+    def __init__(self, client, hostname):
+
+        super(FileTransfer, self).__init__()
+        self.client = client
+        self.hostname = hostname
+
+    def run(self, command):
+        '''
+        Runs 'command' and returns its exit status and stdout lines.
+        '''
+        lines = []
+        exit_status = None
+        try:
+            with SSH_COMMAND_SECONDS.time():
+                _, stdout, _ = self.client.exec_command(command)
+                exit_status = stream_channel(stdout.channel, on_stdout=lines.append,
+                    on_stderr=lambda line: self.logger.debug('[%s] STDERR: %s' % (self.hostname, line)))
+        finally:
+            SSH_COMMANDS.inc(result='ok' if exit_status == 0 else 'failed')
+        return exit_status, lines
+
+    def inspect(self, destination, sudo=None):
+        '''
+        Returns whether 'destination' can be written without sudo, and the
+        size, sha256 digest, mode and 'user:group' owner of the file there
+        (all None if there is none, or it can not be read).
+        '''
+        path = shlex.quote(destination)
+        describe = "stat -c '%%s %%a %%U:%%G' %s && sha256sum %s" % (path, path)
+        command = 'if [ -w {path} ] || {{ [ ! -e {path} ] && [ -w "$(dirname {path})" ]; }}; ' \
+                  'then echo writable; else echo readonly; fi; ' \
+                  '{{ {describe}; }} 2>/dev/null'.format(path=path, describe=describe)
+        if sudo != False:
+            command += ' || %s sh -c %s 2>/dev/null' % (self.SUDO, shlex.quote(describe))
+
+        _, lines = self.run(command)
+        writable = bool(lines) and lines[0] == 'writable'
+        if len(lines) < 3:
+            return writable, None, None, None, None
+        try:
+            size, mode, owner = lines[1].split()
+            return writable, int(size), lines[2].split()[0], int(mode, 8), owner
+        except (ValueError, IndexError):
+            return writable, None, None, None, None
+
+    def open_sftp(self, size):
+
+        window_size = LARGE_FILE_WINDOW_SIZE if size >= LARGE_FILE_SIZE else None
+        return paramiko.SFTPClient.from_transport(self.client.get_transport(), window_size=window_size)
+
+    def upload(self, sftp, source, remote_path, mode=None):
+        '''
+        Writes the local file 'source' to 'remote_path', pipelining the
+        writes instead of waiting for the server to acknowledge each one.
+        '''
+        with open(source, 'rb') as local, sftp.open(remote_path, 'wb') as remote:
+            if mode != None:
+                remote.chmod(mode)
+            remote.set_pipelined(True)
+            shutil.copyfileobj(local, remote, CHUNK_SIZE)
+
+    def put(self, source, destination, mode=None, owner=None, sudo=None):
+        '''
+        Puts the local file 'source' at 'destination', with the given 'mode'
+        and 'owner' ('user' or 'user:group'), and returns a
+        'TransferResult'. With 'sudo' set, the file is always staged and
+        installed with sudo, and when it is False, never.
+        '''
+        with Tracer.span('sftp transfer', category='sftp', host=self.hostname, destination=destination) as span:
+            result = self.transfer(source, destination, mode=mode, owner=owner, sudo=sudo)
+            span.set(bytes=result.size, skipped=result.skipped, staged=result.staged)
+        SFTP_TRANSFERS.inc(result='updated' if result.updated else 'skipped' if result.skipped else
+                           'staged' if result.staged else 'direct')
+        SFTP_BYTES.inc(result.size)
+        return result
+
+    def transfer(self, source, destination, mode=None, owner=None, sudo=None):
+
+        if owner != None and sudo == False:
+            raise ValueError("Setting the owner of '%s' requires sudo." % destination)
+
+        size, digest = local_digest(source)
+        writable, remote_size, remote_digest, remote_mode, remote_owner = self.inspect(destination, sudo=sudo)
+        staged = sudo == True or (sudo != False and (not writable or owner != None))
+        if remote_size == size and remote_digest == digest:
+            self.logger.info("'%s' is already on '%s' at '%s'. Skipping transfer." % (
+                source, self.hostname, destination))
+            wrong_mode = mode != None and remote_mode != mode
+            wrong_owner = owner != None and not self.same_owner(owner, remote_owner)
+            if wrong_mode or wrong_owner:
+                self.set_attributes(destination, mode=mode if wrong_mode else None,
+                                    owner=owner if wrong_owner else None, sudo=staged)
+            return TransferResult(source, destination, skipped=True, updated=wrong_mode or wrong_owner)
+
+        sftp = self.open_sftp(size)
+        try:
+            if not staged:
+                self.logger.info("Transfering '%s' to '%s:%s'." % (source, self.hostname, destination))
+                self.upload(sftp, source, destination, mode=mode)
+                return TransferResult(source, destination, size=size)
+
+            staging_path = os.path.join(self.STAGING_DIR, 'pycloud-%s' % uuid.uuid4().hex)
+            self.logger.info("Transfering '%s' to '%s:%s' through '%s'." % (
+                source, self.hostname, destination, staging_path))
+            try:
+                self.upload(sftp, source, staging_path, mode=0o600)
+            except Exception:
+                self.remove(sftp, staging_path)
+                raise
+        finally:
+            sftp.close()
+
+        self.install(staging_path, destination, mode=mode, owner=owner)
+        return TransferResult(source, destination, staged=True, size=size)
+
+    def same_owner(self, owner, remote_owner):
+        '''
+        Returns whether the 'user' or 'user:group' 'owner' matches the
+        'user:group' owning a remote file.
+        '''
+        if remote_owner == None:
+            return False
+        user, _, group = owner.partition(':')
+        remote_user, _, remote_group = remote_owner.partition(':')
+        return user == remote_user and (not group or group == remote_group)
+
+    def set_attributes(self, destination, mode=None, owner=None, sudo=False):
+        '''
+        Sets the mode and owner of the remote file at 'destination', in a
+        single command.
+        '''
+        prefix = '%s ' % self.SUDO if sudo and self.SUDO else ''
+        commands = []
+        if mode != None:
+            commands.append('%schmod %o %s' % (prefix, mode, shlex.quote(destination)))
+        if owner != None:
+            commands.append('%schown %s %s' % (prefix, shlex.quote(owner), shlex.quote(destination)))
+
+        self.logger.info("Setting the mode and owner of '%s:%s'." % (self.hostname, destination))
+        exit_status, _ = self.run(' && '.join(commands))
+        if exit_status != 0:
+            raise IOError("Unable to set the mode and owner of '%s' on '%s' (exit status %s)." % (
+                destination, self.hostname, exit_status))
+
+    def install(self, staging_path, destination, mode=None, owner=None):
+        '''
+        Moves the staged file into place with sudo, and removes it, in a
+        single command.
+        '''
+        options = ['-m %o' % (mode if mode != None else 0o644)]
+        if owner != None:
+            user, _, group = owner.partition(':')
+            options.append('-o %s' % shlex.quote(user))
+            if group:
+                options.append('-g %s' % shlex.quote(group))
+
+        command = '%s install %s %s %s; status=$?; rm -f %s; exit $status' % (
+            self.SUDO, ' '.join(options), shlex.quote(staging_path), shlex.quote(destination),
+            shlex.quote(staging_path))
+        exit_status, _ = self.run(command)
+        if exit_status != 0:
+            raise IOError("Unable to move '%s' to '%s' on '%s' (exit status %s)." % (
+                staging_path, destination, self.hostname, exit_status))
+
+    def remove(self, sftp, path):
+
+        try:
+            sftp.remove(path)
+        except IOError:
+            pass
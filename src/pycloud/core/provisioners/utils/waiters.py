@@ -0,0 +1,173 @@
+import random
+import re
+import time
+
+from boto.exception import EC2ResponseError
+
+from pycloud.base import Base
+from pycloud.core.errors import WaiterTimeoutError
+from pycloud.core.tracing import Tracer
+
+# states an instance cannot come back from while we wait for it to run
+FAILED_STATES = ['shutting-down', 'terminated', 'stopping', 'stopped']
+
+# the instance ids an 'InvalidInstanceID.NotFound' error names
+INSTANCE_ID_PATTERN = re.compile(r'\bi-[0-9a-f]+\b')
+
+# 'DescribeInstanceStatus' accepts at most this many instance ids per call
+STATUS_BATCH_SIZE = 100
+
+
+class InstanceWaiter(Base):
+    '''
+    Waits for a group of EC2 Instances to reach a state, describing every
+    pending instance with a single API call per round.
+
+    Rounds are spaced with exponential backoff and jitter, starting at
+    'initial_delay' seconds and capped at 'max_delay', and the whole wait
+    fails with a 'WaiterTimeoutError' after 'timeout' seconds.
+    '''
+    DEFAULT_INITIAL_DELAY = 2
+
+    DEFAULT_MAX_DELAY = 30
+
+    DEFAULT_TIMEOUT = 600
+
+    def __init__(self, connection, initial_delay=None, max_delay=None, timeout=None):
+
+        super(InstanceWaiter, self).__init__()
+        self.connection = connection
+        self.initial_delay = initial_delay if initial_delay != None else InstanceWaiter.DEFAULT_INITIAL_DELAY
+        self.max_delay = max_delay if max_delay != None else InstanceWaiter.DEFAULT_MAX_DELAY
+        self.timeout = timeout if timeout != None else InstanceWaiter.DEFAULT_TIMEOUT
+
+        # how many rounds the last wait took, after the first one
+        self.attempts = 0
+
+    def backoff(self, attempt, deadline):
+        '''
+        Returns how long to sleep before round 'attempt', never sleeping past
+        'deadline'.
+        '''
+        delay = min(self.max_delay, self.initial_delay * (2 ** attempt))
+        delay = random.uniform(delay / 2.0, delay)
+        return max(0, min(delay, deadline - time.time()))
+
+    def describe(self, instance_ids):
+        '''
+        Returns the instances with the given ids, keyed by id, and the set of
+        ids that EC2 does not know about (as happens right after
+        'run_instances', or long after an instance was terminated).
+
+        When some ids are not found, the ids named in the error are left out
+        and the others are described again, or, if the error names none of
+        them, every id is described on its own.
+        '''
+        missing = set()
+        remaining = list(instance_ids)
+        while remaining:
+            try:
+                instances = self.connection.get_only_instances(instance_ids=remaining)
+                return dict((instance.id, instance) for instance in instances), missing
+            except EC2ResponseError as e:
+                if e.error_code != 'InvalidInstanceID.NotFound':
+                    raise
+                self.logger.debug("Some instances are not visible: %s" % e.message)
+                named = set(INSTANCE_ID_PATTERN.findall(e.message or '')).intersection(remaining)
+                if not named:
+                    return self.describe_each(remaining, missing)
+                missing.update(named)
+                remaining = [instance_id for instance_id in remaining if instance_id not in named]
+        return {}, missing
+
+    def describe_each(self, instance_ids, missing):
+
+        instances = {}
+        for instance_id in instance_ids:
+            try:
+                for instance in self.connection.get_only_instances(instance_ids=[instance_id]):
+                    instances[instance.id] = instance
+            except EC2ResponseError as e:
+                if e.error_code != 'InvalidInstanceID.NotFound':
+                    raise
+                missing.add(instance_id)
+        return instances, missing
+
+    def healthy_instance_ids(self, instance_ids):
+        '''
+        Returns the subset of 'instance_ids' whose system and instance status
+        checks are both 'ok'.
+        '''
+        healthy = set()
+        for i in range(0, len(instance_ids), STATUS_BATCH_SIZE):
+            statuses = self.connection.get_all_instance_status(
+                instance_ids=instance_ids[i:i + STATUS_BATCH_SIZE])
+            for status in statuses:
+                if status.system_status.status == 'ok' and status.instance_status.status == 'ok':
+                    healthy.add(status.id)
+        return healthy
+
+    def wait(self, instance_ids, state='running', status_ok=False, on_ready=None):
+        '''
+        Waits until every instance in 'instance_ids' is in 'state' and, if
+        'status_ok' is set, has passed its status checks. Returns the ready
+        instances keyed by id.
+
+        'on_ready(instance)' is called for every instance as soon as it is
+        ready, while the others are still being waited for.
+
+        When waiting for 'terminated', instances that EC2 no longer knows
+        about are done, but are not returned.
+        '''
+        with Tracer.span('instance wait', category='wait', instances=len(instance_ids), state=state) as span:
+            try:
+                return self.wait_for(instance_ids, state, status_ok, on_ready)
+            finally:
+                span.set(retries=self.attempts)
+
+    def wait_for(self, instance_ids, state, status_ok, on_ready):
+
+        pending = list(instance_ids)
+        ready = {}
+        deadline = time.time() + self.timeout
+        attempt = 0
+        self.attempts = 0
+
+        while pending:
+            instances, missing = self.describe(pending)
+            if state == 'terminated' and missing:
+                self.logger.debug('%d instances are already gone: %s' % (len(missing), ', '.join(sorted(missing))))
+                pending = [instance_id for instance_id in pending if instance_id not in missing]
+            reached = []
+            for instance_id, instance in instances.items():
+                if instance.state == state:
+                    reached.append(instance_id)
+                elif state == 'running' and instance.state in FAILED_STATES:
+                    raise RuntimeError('Instance (id=%s) went to "%s" while waiting for it to be "%s".' % (
+                        instance_id, instance.state, state))
+
+            if status_ok and reached:
+                healthy = self.healthy_instance_ids(reached)
+                reached = [instance_id for instance_id in reached if instance_id in healthy]
+
+            for instance_id in reached:
+                ready[instance_id] = instances[instance_id]
+                if on_ready != None:
+                    on_ready(instances[instance_id])
+            pending = [instance_id for instance_id in pending if instance_id not in ready]
+            if not pending:
+                break
+
+            if time.time() >= deadline:
+                raise WaiterTimeoutError('%d of %d instances did not reach "%s"%s within %d seconds: %s' % (
+                    len(pending), len(instance_ids), state, ' with status "ok"' if status_ok else '',
+                    self.timeout, ', '.join(pending)), pending=pending)
+
+            delay = self.backoff(attempt, deadline)
+            self.logger.info('Waiting for %d of %d instances to be "%s"%s. Checking again in %.1f seconds.' % (
+                len(pending), len(instance_ids), state, ' with status "ok"' if status_ok else '', delay))
+            time.sleep(delay)
+            attempt += 1
+            self.attempts = attempt
+
+        return ready
@@ -1,26 +1,119 @@
+import importlib
+
 from pycloud.logger import get_logger
 
 from pycloud.base import Base
 
 logger = get_logger()
 
+# the provisioners that ship with PyCloud, as 'slug: module:Class'. The
+# modules are only imported once their provisioner is needed, so that
+# commands which don't need boto, paramiko or sultan don't pay for them.
+BUILTIN_PROVISIONERS = {
+    'debug': 'pycloud.core.provisioners.debug:DebugProvisioner',
+    'err': 'pycloud.core.provisioners.debug:ErrorProvisioner',
+    'ec2_instance': 'pycloud.core.provisioners.aws.ec2:EC2InstanceProvisioner',
+    'ec2_security_group': 'pycloud.core.provisioners.aws.ec2:EC2SecurityGroupProvisioner',
+    'ec2_key_pair': 'pycloud.core.provisioners.aws.ec2:EC2KeyPairProvisioner',
+    'user_add': 'pycloud.core.provisioners.aws.os:UserAdd',
+    'ssh_keygen': 'pycloud.core.provisioners.aws.os:SSHKeyGenerator',
+}
+
+# third party packages can add provisioners by declaring entry points in
+# this group, named after the slug and pointing at the Provisioner Class.
+ENTRY_POINT_GROUP = 'pycloud.provisioners'
+
+
+def iter_entry_points(group):
+    '''
+    Returns '(name, "module:Class")' for every installed entry point in 'group'.
+    '''
+    try:
+        from importlib import metadata
+    except ImportError:  # pragma: no cover
+        import pkg_resources
+        return [(ep.name, '%s:%s' % (ep.module_name, '.'.join(ep.attrs)))
+                for ep in pkg_resources.iter_entry_points(group)]
+
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=group)
+    else:  # pragma: no cover
+        entry_points = entry_points.get(group, [])
+    return [(ep.name, ep.value) for ep in entry_points]
+
+
 class RegistryManager(Base):
 
     def __init__(self):
 
         super(RegistryManager, self).__init__()
         self.__registry = {}
+        self.__lazy = {}
+        self.__entry_points_loaded = False
 
     def register_provisioner(self, provisioner_klass):
         '''
         Registers a Provisioner Class 'provisioner_klass', with slug 'provisioner_slug'.
         '''
         provisioner_slug = provisioner_klass.slug
-        if provisioner_slug not in self.__registry:
-            self.__registry[provisioner_slug] = provisioner_klass
+        if provisioner_slug in self.__registry:
+            raise ValueError("Provisioner with slug '%s' has already been registered." % (provisioner_slug))
+
+        target = self.__lazy.get(provisioner_slug)
+        if target != None and target != '%s:%s' % (provisioner_klass.__module__, provisioner_klass.__name__):
+            raise ValueError("Provisioner with slug '%s' has already been registered." % (provisioner_slug))
 
-        else:
+        # validating tasks only needs the spec compiled here
+        provisioner_klass.compile_argument_spec()
+
+        self.__lazy.pop(provisioner_slug, None)
+        self.__registry[provisioner_slug] = provisioner_klass
+
+    def register_lazy(self, provisioner_slug, target):
+        '''
+        Registers the Provisioner Class at 'target' (given as 'module:Class')
+        under 'provisioner_slug', without importing its module until it is
+        first needed.
+        '''
+        if provisioner_slug in self.__registry or provisioner_slug in self.__lazy:
             raise ValueError("Provisioner with slug '%s' has already been registered." % (provisioner_slug))
+        self.__lazy[provisioner_slug] = target
+
+    def load_entry_points(self):
+        '''
+        Registers the provisioners that installed packages declare in the
+        'pycloud.provisioners' entry point group.
+        '''
+        if self.__entry_points_loaded:
+            return
+        self.__entry_points_loaded = True
+
+        for provisioner_slug, target in iter_entry_points(ENTRY_POINT_GROUP):
+            try:
+                self.register_lazy(provisioner_slug, target)
+            except ValueError:
+                logger.warning("Ignoring entry point for provisioner '%s' (%s): the slug is already registered." % (
+                    provisioner_slug, target))
+
+    def resolve(self, provisioner_slug):
+        '''
+        Imports the module of a lazily registered provisioner, and returns
+        its Provisioner Class.
+        '''
+        target = self.__lazy[provisioner_slug]
+        module_name, _, class_name = target.partition(':')
+        logger.debug("Loading provisioner '%s' from '%s'." % (provisioner_slug, target))
+        module = importlib.import_module(module_name)
+
+        # importing the module usually registers its provisioners already
+        if provisioner_slug not in self.__registry:
+            provisioner_klass = getattr(module, class_name)
+            if provisioner_klass.slug != provisioner_slug:
+                raise ValueError("Provisioner '%s' has slug '%s', but was registered as '%s'." % (
+                    target, provisioner_klass.slug, provisioner_slug))
+            self.register_provisioner(provisioner_klass)
+        return self.__registry[provisioner_slug]
 
     def get(self, provisioner_slug):
         '''
@@ -29,18 +122,34 @@ class RegistryManager(Base):
         if provisioner_slug in self.__registry:
             return self.__registry[provisioner_slug]
 
+        if provisioner_slug not in self.__lazy:
+            self.load_entry_points()
+
+        if provisioner_slug in self.__lazy:
+            return self.resolve(provisioner_slug)
+
         raise ValueError("Provisioner linked with slug '%s' has not been registered." % (provisioner_slug))
 
+    @property
+    def slugs(self):
+        '''
+        Returns the slugs of every known provisioner, without loading them.
+        '''
+        self.load_entry_points()
+        return sorted(set(self.__registry.keys()) | set(self.__lazy.keys()))
+
     @property
     def content(self):
         '''
-        Returns the contents of the Registry.
+        Returns the contents of the Registry, loading every provisioner.
         '''
+        for provisioner_slug in self.slugs:
+            self.get(provisioner_slug)
         return self.__registry
 
 Registry = RegistryManager()
 
+for provisioner_slug, target in sorted(BUILTIN_PROVISIONERS.items()):
+    Registry.register_lazy(provisioner_slug, target)
 
-from .provisioners import *
-
-logger.info("There are %d Provisioners Registered." % len(Registry.content))
+logger.debug("There are %d Provisioners Registered." % len(BUILTIN_PROVISIONERS))
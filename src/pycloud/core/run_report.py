@@ -0,0 +1,238 @@
+import click
+import json
+import os
+
+from pycloud.base import Base
+from pycloud.core.checkpoints import plan_id
+from pycloud.core.config import PyCloudConfig
+from pycloud.core.state import atomic_write
+
+# how many of the slowest hosts of a task are reported
+SLOWEST_HOSTS = 3
+
+
+def merged_duration(intervals):
+    '''
+    Returns how long at least one of the '(start, end)' intervals lasted,
+    counting the time where they overlap once.
+    '''
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end == None or start > current_end:
+            if current_end != None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end != None:
+        total += current_end - current_start
+    return total
+
+
+class RunReport(Base):
+    '''
+    Summarizes where the time of a run went, from the spans recorded while
+    running it (see 'SpanTracer'):
+
+    * the critical path: the chain of tasks, ending with the one that
+      finished last, where each task was held back by the one before it,
+    * the wall time of the run against the time of all its tasks put
+      together, which tells how much they ran in parallel,
+    * the slowest hosts of every task that works on several hosts,
+    * how much of every task was spent waiting on AWS (polling for
+      instances or for their SSH ports) rather than doing work.
+
+    Times are in seconds, relative to the start of the run.
+    '''
+    DEFAULT_REPORT_DIR_PATH = os.path.join(PyCloudConfig.DEFAULT_CONFIG_DIR_PATH, 'reports')
+
+    def __init__(self, graph, action, keys, plan_span, spans, skipped=None):
+
+        super(RunReport, self).__init__()
+        self.graph = graph
+        self.action = action
+        self.keys = keys
+        self.plan_span = plan_span
+        self.skipped = skipped if skipped != None else {}
+
+        self.__children = {}
+        for span in spans:
+            self.__children.setdefault(span.parent, []).append(span)
+
+        # the span of every task that ran, by the index of its node
+        task_spans = dict((span.attributes.get('task'), span) for span in self.__children.get(plan_span.id, [])
+                          if span.category == 'task')
+        self.task_spans = dict((node.index, task_spans[keys[node.index]]) for node in graph.nodes
+                               if keys[node.index] in task_spans)
+
+    @classmethod
+    def path_for(cls, plan_path, action, report_dir=None):
+        '''
+        Returns where the report of the latest 'action' on the plan at
+        'plan_path' is saved.
+        '''
+        report_dir = report_dir if report_dir != None else cls.DEFAULT_REPORT_DIR_PATH
+        return os.path.join(report_dir, '%s.%s.json' % (plan_id(plan_path), action))
+
+    def descendants(self, span, category, stop=None):
+        '''
+        Returns the spans of 'category' nested in 'span', without looking
+        inside the spans of category 'stop'.
+        '''
+        found = []
+        pending = list(self.__children.get(span.id, []))
+        while pending:
+            child = pending.pop()
+            if child.category == category:
+                found.append(child)
+            if child.category != stop:
+                pending.extend(self.__children.get(child.id, []))
+        return found
+
+    def wait_time(self, span):
+        '''
+        Returns how long the operation of 'span' was waiting on AWS.
+        '''
+        return merged_duration([(wait.start, wait.end) for wait in self.descendants(span, 'wait')])
+
+    def offset(self, time):
+
+        return round(time - self.plan_span.start, 3)
+
+    def critical_path(self):
+        '''
+        Returns the tasks of the critical path, in the order they ran, as a
+        list of '(index, held_until)' tuples: the node's index, and when the
+        task it waited for let it start (None for the first task).
+
+        A task waits for the end of an upstream task, or for its start when
+        it streams from it, and the one it waited for last is the one that
+        held it back.
+        '''
+        if not self.task_spans:
+            return []
+
+        index = max(self.task_spans, key=lambda i: self.task_spans[i].end)
+        path = []
+        while index != None:
+            node = self.graph.nodes[index]
+            held_by = None
+            held_until = None
+            for upstream_index in node.upstream:
+                upstream = self.task_spans.get(upstream_index)
+                if upstream == None:
+                    continue
+                until = upstream.start if upstream_index in node.streaming_upstream else upstream.end
+                if held_until == None or until > held_until:
+                    held_by, held_until = upstream_index, until
+            path.append((index, held_until))
+            index = held_by
+        return list(reversed(path))
+
+    def hosts(self, span):
+        '''
+        Returns the hosts a task worked on, slowest first.
+        '''
+        hosts = []
+        for host in sorted(self.descendants(span, 'host', stop='host'), key=lambda host: -host.duration):
+            hosts.append({
+                'host': host.name,
+                'duration': round(host.duration, 3),
+                'wait_time': round(self.wait_time(host), 3),
+                'error': host.attributes.get('error'),
+            })
+        return hosts
+
+    def to_dict(self):
+        '''
+        Returns the report as a dictionary that can be saved as JSON.
+        '''
+        tasks = []
+        for node in self.graph.order:
+            task = {'task': self.keys[node.index], 'name': node.name, 'slug': node.slug}
+            span = self.task_spans.get(node.index)
+            if node.index in self.skipped:
+                task.update(status='skipped', reason=self.skipped[node.index])
+            elif span == None:
+                task.update(status='not run')
+            else:
+                hosts = self.hosts(span)
+                wait_time = self.wait_time(span)
+                task.update(
+                    status='failed' if 'error' in span.attributes else 'completed',
+                    start=self.offset(span.start),
+                    end=self.offset(span.end),
+                    duration=round(span.duration, 3),
+                    wait_time=round(wait_time, 3),
+                    work_time=round(span.duration - wait_time, 3),
+                    hosts=len(hosts),
+                    slowest_hosts=hosts[:SLOWEST_HOSTS],
+                )
+            tasks.append(task)
+
+        critical_path = []
+        for index, held_until in self.critical_path():
+            span = self.task_spans[index]
+            critical_path.append({
+                'task': self.keys[index],
+                'name': self.graph.nodes[index].name,
+                'start': self.offset(span.start),
+                'end': self.offset(span.end),
+                'duration': round(span.duration, 3),
+                # how long the task waited for a free worker
+                'queued': round(span.start - held_until, 3) if held_until != None else self.offset(span.start),
+                'wait_time': round(self.wait_time(span), 3),
+            })
+
+        wall_time = self.plan_span.duration
+        task_time = sum(span.duration for span in self.task_spans.values())
+        wait_time = sum(self.wait_time(span) for span in self.task_spans.values())
+        return {
+            'action': self.action,
+            'plan': self.plan_span.attributes.get('plan'),
+            'jobs': self.plan_span.attributes.get('jobs'),
+            'wall_time': round(wall_time, 3),
+            'task_time': round(task_time, 3),
+            'parallelism': round(task_time / wall_time, 2) if wall_time else None,
+            'wait_time': round(wait_time, 3),
+            'work_time': round(task_time - wait_time, 3),
+            'critical_path': critical_path,
+            'tasks': tasks,
+        }
+
+    def print_report(self, report=None):
+        '''
+        Prints the report: the critical path, the parallelism of the run,
+        the time spent waiting on AWS and the slowest hosts.
+        '''
+        report = report if report != None else self.to_dict()
+        click.secho("--| REPORT - %s: %.1fs wall time, %.1fs task time (%sx parallelism)" % (
+            self.action.upper(), report['wall_time'], report['task_time'], report['parallelism']), fg='green')
+
+        click.secho("      critical path:", fg='green')
+        for task in report['critical_path']:
+            click.secho("        %-30s %7.1fs  (queued %.1fs, waiting on AWS %.1fs)" % (
+                task['name'], task['duration'], task['queued'], task['wait_time']), fg='green')
+
+        if report['task_time']:
+            click.secho("      waiting on AWS: %.1fs, working: %.1fs (%.0f%% waiting)" % (
+                report['wait_time'], report['work_time'], 100.0 * report['wait_time'] / report['task_time']),
+                fg='green')
+
+        for task in report['tasks']:
+            if task.get('hosts', 0) > 1:
+                click.secho("      slowest hosts of %s: %s" % (task['name'], ', '.join(
+                    '%s (%.1fs)' % (host['host'], host['duration']) for host in task['slowest_hosts'])),
+                    fg='green')
+
+    def save(self, path, report=None):
+        '''
+        Writes the report to 'path' as JSON.
+        '''
+        report = report if report != None else self.to_dict()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        atomic_write(path, json.dumps(report, indent=2, sort_keys=True))
+        self.logger.info("Saved the report of the run to '%s'." % path)
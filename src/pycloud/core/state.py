@@ -0,0 +1,364 @@
+import contextlib
+import copy
+import json
+import os
+import yaml
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from pycloud.base import Base
+
+
+def apply_changes(state, changes):
+    '''
+    Applies a list of '(op, key, value)' changes to the 'state' dictionary.
+    '''
+    for op, key, value in changes:
+        if op == 'set':
+            state[key] = value
+        elif op == 'delete':
+            state.pop(key, None)
+
+
+def atomic_write(path, content):
+    '''
+    Replaces the file at 'path' with 'content', so that readers either see
+    the old or the new file, but never a partially written one.
+    '''
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb' if isinstance(content, bytes) else 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+
+
+class FileLock(object):
+    '''
+    An advisory lock (see 'fcntl.flock') held on a file next to the state,
+    which serializes state changes across processes.
+    '''
+    def __init__(self, path):
+
+        self.path = path
+
+    @contextlib.contextmanager
+    def acquire(self, shared=False):
+
+        if fcntl == None:
+            yield
+            return
+
+        with open(self.path, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class StateBackend(Base):
+    '''
+    Stores the key/value state that PyCloudConfig keeps between runs.
+
+    'load()' returns the whole state as a dictionary, and 'write()' persists
+    a list of changes, where every change is either '('set', key, value)' or
+    '('delete', key, None)', along with the state they were applied to.
+
+    Several processes can share one backend: changes are made while holding
+    a file lock, and before persisting its own changes a process merges the
+    changes other processes made into its state with 'refresh()'.
+    '''
+    def __init__(self, path):
+
+        super(StateBackend, self).__init__()
+        self.path = path
+        self.lock = FileLock('%s.lock' % path)
+
+    def load(self):
+
+        raise NotImplementedError("Subclass of 'StateBackend' has not implemented 'load()'.")
+
+    def refresh(self, state):
+        '''
+        Merges the changes other processes persisted since this process last
+        read the state into 'state'. Called with the lock held.
+        '''
+        raise NotImplementedError("Subclass of 'StateBackend' has not implemented 'refresh()'.")
+
+    def persist(self, changes, state):
+        '''
+        Persists 'changes', which have already been applied to 'state'.
+        Called with the lock held, right after 'refresh()'.
+        '''
+        raise NotImplementedError("Subclass of 'StateBackend' has not implemented 'persist()'.")
+
+    def write(self, changes, state):
+
+        if not changes:
+            return
+
+        with self.lock.acquire():
+            self.refresh(state)
+            apply_changes(state, changes)
+            self.persist(changes, state)
+
+    def update(self, state, key, func):
+        '''
+        Atomically sets 'key' to 'func(current_value)', where the current
+        value includes the changes made by every other process, and returns
+        the new value.
+        '''
+        with self.lock.acquire():
+            self.refresh(state)
+            value = func(state.get(key))
+            changes = [('set', key, value)]
+            apply_changes(state, changes)
+            self.persist(changes, state)
+        return value
+
+
+class YAMLStateBackend(StateBackend):
+    '''
+    Keeps the state in a single YAML file, which is rewritten in full on
+    every write.
+    '''
+    def read(self):
+
+        if not os.path.exists(self.path):
+            return {}
+
+        with open(self.path) as f:
+            try:
+                state = yaml.safe_load(f)
+            except yaml.YAMLError:
+                self.logger.exception("Unable to load YAML from file '%s'" % self.path)
+                state = {}
+        return state if state != None else {}
+
+    def load(self):
+
+        with self.lock.acquire(shared=True):
+            self.on_disk = self.read()
+        return copy.deepcopy(self.on_disk)
+
+    def refresh(self, state):
+
+        # keys that are no longer on disk were deleted by another process,
+        # unless this process changed them since it last read the file,
+        # which is told apart by comparing them with what it read then.
+        previous = getattr(self, 'on_disk', None) or {}
+        self.on_disk = self.read()
+        for key in list(state.keys()):
+            if key not in self.on_disk and key in previous and previous[key] == state[key]:
+                del state[key]
+        state.update(copy.deepcopy(self.on_disk))
+
+    def persist(self, changes, state):
+
+        # only this process' changes are applied on top of what is on disk,
+        # so keys deleted by other processes stay deleted.
+        apply_changes(self.on_disk, changes)
+        self.logger.debug('Flushing contents to "%s"' % (self.path))
+        atomic_write(self.path, yaml.dump(self.on_disk, default_flow_style=False))
+
+
+class JournalStateBackend(StateBackend):
+    '''
+    Keeps the state in an append-only journal, with one JSON encoded change
+    per line, so that updating a key costs a single appended line no matter
+    how large the state is.
+
+    Once the journal holds more than 'compact_ratio' lines per live key (and
+    at least 'compact_min_entries' lines), it is compacted into a snapshot
+    with one line per key. If the journal does not exist yet, the state in
+    'legacy_path' (the YAML file older versions used) is imported into it.
+
+    Every process remembers how far into the journal it has read, and reads
+    only the lines appended since then on 'refresh()'. A compaction by
+    another process replaces the file, which is noticed by its inode.
+    '''
+    DEFAULT_COMPACT_MIN_ENTRIES = 1000
+
+    DEFAULT_COMPACT_RATIO = 4
+
+    def __init__(self, path, legacy_path=None, compact_min_entries=None, compact_ratio=None):
+
+        super(JournalStateBackend, self).__init__(path)
+        self.legacy_path = legacy_path
+        self.compact_min_entries = compact_min_entries if compact_min_entries != None \
+            else JournalStateBackend.DEFAULT_COMPACT_MIN_ENTRIES
+        self.compact_ratio = compact_ratio if compact_ratio != None else JournalStateBackend.DEFAULT_COMPACT_RATIO
+
+        # how many lines the journal has, how many bytes of it have been read,
+        # whether it ends in a partially written line, and which file it is.
+        self.entries = 0
+        self.offset = 0
+        self.partial = False
+        self.file = None
+        self.file_id = None
+
+        # the state as this process last saw it on disk
+        self.on_disk = {}
+
+    def encode(self, op, key, value=None):
+
+        record = {'op': op, 'key': key}
+        if op == 'set':
+            record['value'] = value
+        return json.dumps(record, sort_keys=True) + '\n'
+
+    def replay(self, lines, state):
+        '''
+        Applies the journal 'lines' to 'state' and to 'on_disk', returning
+        how many were valid.
+        '''
+        applied = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a crash in the middle of an append leaves a partial line
+                self.logger.warning("Skipping corrupt entry in state journal '%s'." % self.path)
+                continue
+
+            changes = [(record['op'], record['key'], record.get('value'))]
+            apply_changes(state, changes)
+            apply_changes(self.on_disk, changes)
+            applied += 1
+        return applied
+
+    def open_journal(self):
+        '''
+        Opens the journal for reading. The file is kept open, so that its
+        inode can't be reused by a later compaction while this process still
+        remembers it, which would make the new file look unchanged.
+        '''
+        self.close()
+        self.file = open(self.path, 'rb')
+        self.file_id = self.stat_id(os.fstat(self.file.fileno()))
+
+    def close(self):
+
+        if self.file != None:
+            self.file.close()
+            self.file = None
+            self.file_id = None
+
+    def read_from(self, offset, state):
+        '''
+        Applies the complete lines of the journal after byte 'offset' to
+        'state', and remembers where reading stopped.
+        '''
+        self.file.seek(offset)
+        data = self.file.read()
+
+        end = data.rfind(b'\n') + 1
+        self.entries += self.replay(data[:end].decode('utf-8').splitlines(), state)
+        self.offset = offset + end
+        self.partial = end < len(data)
+
+    def stat_id(self, stat):
+
+        return (stat.st_dev, stat.st_ino)
+
+    def import_legacy_state(self):
+        '''
+        Creates the journal from the legacy YAML state file.
+        '''
+        state = {}
+        if self.legacy_path and os.path.exists(self.legacy_path):
+            state = YAMLStateBackend(self.legacy_path).read()
+            if state:
+                self.logger.info("Importing %d keys from '%s' into the state journal '%s'." % (
+                    len(state), self.legacy_path, self.path))
+        self.compact(state)
+
+    def load(self):
+
+        with self.lock.acquire():
+            if not os.path.exists(self.path):
+                self.import_legacy_state()
+
+            state = {}
+            self.entries = 0
+            self.on_disk = {}
+            self.open_journal()
+            self.read_from(0, state)
+        return state
+
+    def refresh(self, state):
+
+        try:
+            file_id = self.stat_id(os.stat(self.path))
+        except OSError:
+            file_id = None
+
+        if self.file != None and file_id == self.file_id:
+            self.read_from(self.offset, state)
+            return
+
+        # the journal was compacted by another process. Keys that are not in
+        # the snapshot were deleted by another process, unless they are
+        # changes of this process that have not been written yet, which is
+        # told apart by comparing them with what this process saw on disk.
+        self.logger.debug("State journal '%s' was replaced. Reloading it." % self.path)
+        previous = self.on_disk
+        if file_id == None:
+            self.import_legacy_state()
+
+        snapshot = {}
+        self.entries = 0
+        self.on_disk = {}
+        self.open_journal()
+        self.read_from(0, snapshot)
+        for key in list(state.keys()):
+            if key not in snapshot and key in previous and previous[key] == state[key]:
+                del state[key]
+        state.update(snapshot)
+
+    def persist(self, changes, state):
+
+        data = ''.join(self.encode(op, key, value) for op, key, value in changes)
+        if self.partial:
+            # terminate the partial line left by a crashed writer, so that it
+            # is skipped instead of corrupting the line written after it
+            data = '\n' + data
+
+        encoded = data.encode('utf-8')
+        with open(self.path, 'ab') as f:
+            f.write(encoded)
+        self.offset += len(encoded)
+        self.partial = False
+        self.entries += len(changes)
+        apply_changes(self.on_disk, changes)
+
+        if self.entries >= self.compact_min_entries and self.entries > self.compact_ratio * max(1, len(state)):
+            self.compact(state)
+
+    def compact(self, state):
+        '''
+        Replaces the journal with a snapshot holding one line per key.
+        Called with the lock held.
+        '''
+        self.logger.debug("Compacting state journal '%s' (%d entries, %d keys)." % (
+            self.path, self.entries, len(state)))
+        content = ''.join(self.encode('set', key, state[key]) for key in sorted(state.keys()))
+        atomic_write(self.path, content)
+
+        self.open_journal()
+        self.offset = len(content.encode('utf-8'))
+        self.partial = False
+        self.entries = len(state)
+        self.on_disk = dict(state)
+
+
+STATE_BACKENDS = {
+    'journal': JournalStateBackend,
+    'yaml': YAMLStateBackend,
+}
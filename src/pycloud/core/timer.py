@@ -1,14 +1,17 @@
 import click
-import datetime
 import sys
+import threading
 import time
 import traceback
 
 LINE_LIMIT = 120
 
+# keeps the lines printed by contexts running on different threads together
+OUTPUT_LOCK = threading.RLock()
+
 class TimeContext(object):
 
-    def __init__(self, name, dry_run=None):
+    def __init__(self, name, dry_run=None, label=None):
 
         if dry_run == None:
             dry_run = False
@@ -16,43 +19,53 @@ class TimeContext(object):
         self.name = name
         self.dry_run = dry_run
 
+        # when tasks run concurrently, their headers and footers interleave,
+        # so 'label' is printed with both to tell them apart.
+        self.label = label
+
 
     def print_header(self, header):
 
+        if self.label:
+            header = '%s: %s' % (header, self.label)
         click.secho('--| ' + '{:25}'.format(header) + ' |' + '-' * (LINE_LIMIT-31), fg='green')
 
     def sec_to_time(self, sec):
 
-        hrs = sec / 3600
-        sec -= 3600*hrs
-
-        mins = sec / 60
-        sec -= 60*mins
-        return int(hrs), int(mins), int(sec)
+        mins, sec = divmod(int(sec), 60)
+        hrs, mins = divmod(mins, 60)
+        return hrs, mins, sec
 
     def print_footer(self, time_taken_sec):
 
-        hrs, mins, secs = self.sec_to_time(time_taken_sec)
-        time_obj = datetime.time(hour=hrs, minute=mins, second=secs)
-        click.secho('-' * (LINE_LIMIT-30) + ' Time Taken to Execute: {:34}'.format(time_obj.strftime('%H:%M:%S')), fg='green')
+        # not a 'datetime.time', since tasks can take more than a day
+        time_taken = '%02d:%02d:%02d' % self.sec_to_time(time_taken_sec)
+        if self.label:
+            click.secho('--| ' + '{:25}'.format(self.label) + ' |' + '-' * (LINE_LIMIT-61) +
+                        ' Time Taken to Execute: {:34}'.format(time_taken), fg='green')
+        else:
+            click.secho('-' * (LINE_LIMIT-30) + ' Time Taken to Execute: {:34}'.format(time_taken), fg='green')
 
     def __enter__(self):
 
-        self.stime = time.time()
+        self.stime = time.monotonic()
         if self.dry_run:
             header = '[DRY-RUN] %s' % self.name
         else:
             header = self.name
-        self.print_header(header)
+        with OUTPUT_LOCK:
+            self.print_header(header)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
 
-        self.etime = time.time()
-        if exc_tb:
-            click.secho("An exception occurred while running.", fg='red')
-            for line in traceback.format_tb(exc_tb):
-                click.secho(line, fg='yellow')
-            click.secho("Halting Execution Now!!", fg='red')
-        self.print_footer(self.etime - self.stime)
-        if exc_tb:
-            click.secho("More Details are printed below:", fg='green')
+        self.etime = time.monotonic()
+        with OUTPUT_LOCK:
+            if exc_tb:
+                click.secho("An exception occurred while running.", fg='red')
+                for line in traceback.format_tb(exc_tb):
+                    click.secho(line, fg='yellow')
+                click.secho("Halting Execution Now!!", fg='red')
+            self.print_footer(self.etime - self.stime)
+            if exc_tb:
+                click.secho("More Details are printed below:", fg='green')
+
@@ -0,0 +1,205 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+from pycloud.base import Base
+from pycloud.core.state import atomic_write
+
+
+class Span(object):
+    '''
+    A timed operation, like a task, an AWS API call or a remote command,
+    nested in the span that was current when it started. 'attributes'
+    describe it (like the host it ran on, or how many bytes it moved).
+
+    Times are read from a monotonic clock, in seconds.
+    '''
+    def __init__(self, span_id, name, category=None, parent=None, attributes=None):
+
+        self.id = span_id
+        self.name = name
+        self.category = category if category != None else 'default'
+        self.parent = parent
+        self.attributes = dict(attributes or {})
+        self.thread_id = threading.get_ident()
+        self.start = time.monotonic()
+        self.end = None
+
+    def set(self, **attributes):
+        '''
+        Adds attributes that are only known once the operation ran.
+        '''
+        self.attributes.update(attributes)
+
+    @property
+    def duration(self):
+
+        return (self.end if self.end != None else time.monotonic()) - self.start
+
+    def __repr__(self):
+
+        return '<Span %d: %s (%s)>' % (self.id, self.name, self.category)
+
+
+class NullSpan(object):
+    '''
+    What 'SpanTracer.span()' yields while tracing is off.
+    '''
+    id = None
+
+    def set(self, **attributes):
+
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class SpanContext(object):
+
+    def __init__(self, tracer, name, category, parent, attributes):
+
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.attributes = attributes
+        self.span = None
+
+    def __enter__(self):
+
+        self.span = self.tracer.start_span(self.name, self.category, self.parent, self.attributes)
+        return self.span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        if exc_type != None:
+            self.span.set(error='%s: %s' % (exc_type.__name__, exc_val))
+        self.tracer.end_span(self.span)
+
+
+class NullSpanContext(object):
+
+    def __enter__(self):
+
+        return NULL_SPAN
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        pass
+
+
+NULL_SPAN_CONTEXT = NullSpanContext()
+
+
+class SpanTracer(Base):
+    '''
+    Records nested spans (plan, task, AWS API call, SSH connection, remote
+    command, file transfer...) while enabled, and exports them in the Chrome
+    trace event format, which chrome://tracing and Perfetto show as a
+    timeline with one row per thread.
+
+    A span is nested in the span that is current on its thread, unless a
+    'parent' is given, which is how work handed to other threads (like the
+    hosts of a task) stays nested in the span that handed it off.
+    '''
+    def __init__(self):
+
+        super(SpanTracer, self).__init__()
+        self.enabled = False
+        self.__spans = []
+        self.__lock = threading.Lock()
+        self.__ids = itertools.count(1)
+        self.__local = threading.local()
+
+    def enable(self):
+
+        with self.__lock:
+            self.enabled = True
+            self.__spans = []
+
+    def disable(self):
+
+        self.enabled = False
+
+    @property
+    def spans(self):
+        '''
+        The finished spans, in the order they finished.
+        '''
+        with self.__lock:
+            return list(self.__spans)
+
+    def current(self):
+        '''
+        Returns the innermost span running on this thread, or None.
+        '''
+        stack = getattr(self.__local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def span(self, name, category=None, parent=None, **attributes):
+        '''
+        Returns a context manager timing the operation 'name' in a 'Span'.
+        '''
+        if not self.enabled:
+            return NULL_SPAN_CONTEXT
+        return SpanContext(self, name, category, parent, attributes)
+
+    def start_span(self, name, category=None, parent=None, attributes=None):
+
+        parent = parent if parent != None else self.current()
+        span = Span(next(self.__ids), name, category=category, parent=parent.id if parent != None else None,
+                    attributes=attributes)
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = []
+        self.__local.stack.append(span)
+        return span
+
+    def end_span(self, span):
+
+        span.end = time.monotonic()
+        stack = self.__local.stack
+        if span in stack:
+            stack.remove(span)
+        with self.__lock:
+            self.__spans.append(span)
+
+    def to_chrome_trace(self):
+        '''
+        Returns the finished spans as a Chrome trace, with times in
+        microseconds since the first span started.
+        '''
+        spans = self.spans
+        origin = min(span.start for span in spans) if spans else 0
+        pid = os.getpid()
+        thread_ids = {}
+        events = []
+        for span in sorted(spans, key=lambda span: span.start):
+            tid = thread_ids.setdefault(span.thread_id, len(thread_ids) + 1)
+            args = dict(span.attributes)
+            args['span_id'] = span.id
+            if span.parent != None:
+                args['parent_id'] = span.parent
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': round((span.start - origin) * 1e6, 3),
+                'dur': round((span.end - span.start) * 1e6, 3),
+                'pid': pid,
+                'tid': tid,
+                'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path):
+        '''
+        Writes the finished spans to 'path' as a Chrome trace.
+        '''
+        atomic_write(path, json.dumps(self.to_chrome_trace(), default=repr))
+        self.logger.info("Wrote %d spans to '%s'." % (len(self.spans), path))
+
+
+Tracer = SpanTracer()
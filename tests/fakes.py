@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""Fake SSH clients, channels and provisioners shared by the tests."""
+
+import contextlib
+import os
+import select
+import subprocess
+
+from pycloud.core.provisioners.utils.mixins import AWSProvisionerMixin
+
+
+class LocalChannel(object):
+    """Runs a command with a local bash, as if it ran over SSH.
+
+    Its stdin, stdout and stderr are pipes that are read and written without
+    blocking, and whose buffers play the windows of an SSH channel.
+    """
+
+    def __init__(self, command):
+        self.process = subprocess.Popen(['bash', '-c', command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        for pipe in [self.process.stdin, self.process.stdout, self.process.stderr]:
+            os.set_blocking(pipe.fileno(), False)
+        self.buffers = {'stdout': b'', 'stderr': b''}
+        self.open = {'stdout': self.process.stdout, 'stderr': self.process.stderr}
+        self.sent = 0
+
+    def poll(self):
+        for name, pipe in list(self.open.items()):
+            try:
+                data = os.read(pipe.fileno(), 65536)
+            except BlockingIOError:
+                continue
+            if data:
+                self.buffers[name] += data
+            else:
+                del self.open[name]
+
+    def take(self, name, size):
+        data, self.buffers[name] = self.buffers[name][:size], self.buffers[name][size:]
+        return data
+
+    def recv_ready(self):
+        self.poll()
+        return len(self.buffers['stdout']) > 0
+
+    def recv_stderr_ready(self):
+        self.poll()
+        return len(self.buffers['stderr']) > 0
+
+    def recv(self, size):
+        return self.take('stdout', size)
+
+    def recv_stderr(self, size):
+        return self.take('stderr', size)
+
+    def send_ready(self):
+        return bool(select.select([], [self.process.stdin], [], 0)[1])
+
+    def send(self, data):
+        try:
+            sent = os.write(self.process.stdin.fileno(), data)
+        except BlockingIOError:
+            return 0
+        self.sent += sent
+        return sent
+
+    def shutdown_write(self):
+        if not self.process.stdin.closed:
+            self.process.stdin.close()
+
+    def exit_status_ready(self):
+        self.poll()
+        return not self.open and self.process.poll() != None
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+
+class ScriptedChannel(object):
+    """A channel whose output arrives in the given '(stream, data)' chunks, one per read."""
+
+    def __init__(self, chunks, exit_status=0):
+        self.chunks = list(chunks)
+        self.exit_status = exit_status
+        self.reads = 0
+
+    def ready(self, stream):
+        return bool(self.chunks) and self.chunks[0][0] == stream
+
+    def recv_ready(self):
+        return self.ready('stdout')
+
+    def recv_stderr_ready(self):
+        return self.ready('stderr')
+
+    def recv(self, size):
+        self.reads += 1
+        return self.chunks.pop(0)[1]
+
+    def recv_stderr(self, size):
+        self.reads += 1
+        return self.chunks.pop(0)[1]
+
+    def shutdown_write(self):
+        pass
+
+    def exit_status_ready(self):
+        return not self.chunks
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+
+class ChannelFile(object):
+    """The stdin, stdout or stderr of a channel, as 'SSHClient.exec_command' returns them."""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeClient(object):
+    """An SSH client running every command on a channel made by 'channel(command)'."""
+
+    def __init__(self, channel=None):
+        self.channel = channel if channel != None else LocalChannel
+        self.commands = []
+
+    def exec_command(self, command):
+        self.commands.append(command)
+        channel = self.channel(command)
+        return ChannelFile(channel), ChannelFile(channel), ChannelFile(channel)
+
+
+class FakeInstance(object):
+
+    id = 'i-1'
+    public_dns_name = 'localhost'
+
+
+class FakeProvisioner(AWSProvisionerMixin):
+    """A provisioner whose SSH sessions all use 'client'."""
+
+    def __init__(self, client):
+        super(FakeProvisioner, self).__init__()
+        self.client = client
+
+    @contextlib.contextmanager
+    def ssh_client(self, connection, instance, fs_keypair, username, ssh_port=22, max_rt=5):
+        yield self.client
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the argument specs of `pycloud.core.provisioners.base`."""
+
+import unittest
+
+from pycloud.core.provisioners.base import ArgumentSpec, BaseProvisioner, ImproperlyConfiguredProvisionerError
+from pycloud.core.registry import Registry
+
+
+class TypedProvisioner(BaseProvisioner):
+
+    name = 'Typed Provisioner'
+
+    description = 'A provisioner with typed arguments.'
+
+    slug = 'typed'
+
+    required_args = ['count']
+
+    optional_args = ['label', 'retries']
+
+    arg_types = {'count': int, 'retries': int}
+
+    arg_defaults = {'retries': 3}
+
+
+class TestArgumentSpec(unittest.TestCase):
+    """Tests for validating task arguments with compiled specs."""
+
+    def test_spec_is_compiled_once(self):
+        """Instantiating a provisioner leaves its class untouched."""
+        spec = TypedProvisioner.argument_spec()
+        for _ in range(3):
+            TypedProvisioner()
+
+        self.assertIs(TypedProvisioner.argument_spec(), spec)
+        self.assertEqual(TypedProvisioner.required_args, ['count'])
+        self.assertEqual(spec.required, frozenset(['name', 'count']))
+        self.assertIn('AWS_ACCESS_KEY', spec.allowed)
+
+    def test_registered_provisioners_have_own_spec(self):
+        """Every provisioner compiles its own spec when it is registered."""
+        debug_spec = Registry.get('debug').argument_spec()
+        error_spec = Registry.get('err').argument_spec()
+
+        self.assertEqual(debug_spec.required, frozenset(['name', 'echo']))
+        self.assertEqual(error_spec.required, frozenset(['name', 'error_msg']))
+
+    def test_validate(self):
+        """Missing, unknown and mistyped arguments are rejected."""
+        provisioner = TypedProvisioner()
+        provisioner.set_arguments(name='task', count=2)
+        self.assertEqual(provisioner.kwargs, {'name': 'task', 'count': 2, 'retries': 3})
+
+        for kwargs in [{'name': 'task'}, {'name': 'task', 'count': 2, 'colour': 'red'},
+                       {'name': 'task', 'count': '2'}]:
+            with self.assertRaises(ImproperlyConfiguredProvisionerError):
+                TypedProvisioner().set_arguments(**kwargs)
+
+    def test_validate_many_tasks(self):
+        """A spec validates a large plan without changing."""
+        spec = TypedProvisioner.argument_spec()
+        for index in range(10000):
+            spec.validate({'name': 'task %d' % index, 'count': index, 'label': 'x'})
+        self.assertEqual(spec.allowed, frozenset(['name', 'count', 'label', 'retries', 'PLAN',
+                                                  'AWS_ACCESS_KEY', 'AWS_SECRET_KEY']))
+
+    def test_unknown_typed_argument(self):
+        """Types and defaults can only be given for the provisioner's arguments."""
+        with self.assertRaises(ValueError):
+            ArgumentSpec(['count'], [], types={'colour': str})
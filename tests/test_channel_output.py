@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.utils.channel_output`."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pycloud.core.metrics import Metrics
+from pycloud.core.provisioners.utils.channel_output import HOST_LOG_DIR_ENV, LineSplitter, stream_channel
+from tests.fakes import FakeClient, FakeInstance, FakeProvisioner, LocalChannel, ScriptedChannel
+
+
+class TestLineSplitter(unittest.TestCase):
+    """Tests for `LineSplitter`."""
+
+    def test_lines_across_chunks(self):
+        """Lines and characters split across chunks are put back together."""
+        lines = []
+        splitter = LineSplitter(lines.append)
+        encoded = u'café\r\nsecond line\nlast'.encode('utf-8')
+        for i in range(len(encoded)):
+            splitter.feed(encoded[i:i + 1])
+        self.assertEqual(lines, [u'café', 'second line'])
+
+        splitter.flush()
+        self.assertEqual(lines[-1], 'last')
+
+    def test_long_lines_are_bounded(self):
+        """Output without newlines is passed on in bounded pieces."""
+        lines = []
+        splitter = LineSplitter(lines.append, max_line_length=10)
+        splitter.feed(b'x' * 25)
+        self.assertEqual(lines, ['x' * 10, 'x' * 10])
+        self.assertEqual(len(splitter.pending), 5)
+
+
+class TestStreamChannel(unittest.TestCase):
+    """Tests for `stream_channel`, and the mixin running commands with it."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        os.environ.pop(HOST_LOG_DIR_ENV, None)
+        shutil.rmtree(self.temp_dir)
+
+    def test_interleaved_output(self):
+        """Both streams are read as the output arrives."""
+        channel = ScriptedChannel([
+            ('stdout', b'one\ntw'), ('stderr', b'warning\n'), ('stdout', b'o\n'), ('stderr', b'big' * 10000),
+        ], exit_status=3)
+        stdout = []
+        stderr = []
+
+        self.assertEqual(stream_channel(channel, on_stdout=stdout.append, on_stderr=stderr.append), 3)
+        self.assertEqual(stdout, ['one', 'two'])
+        self.assertEqual(stderr, ['warning', 'big' * 10000])
+        self.assertEqual(channel.reads, 4)
+
+    def test_large_stdin_and_output(self):
+        """Stdin is written as the command reads it, while its output is read."""
+        # both are far larger than the pipes (the channel's windows) hold
+        lines = ['line %d' % i for i in range(100000)]
+        stdin_data = '\n'.join(lines) + '\n'
+        stdout = []
+        stderr = []
+        Metrics.reset()
+
+        channel = LocalChannel('cat; echo done >&2')
+        exit_status = stream_channel(channel, on_stdout=stdout.append, on_stderr=stderr.append,
+                                     stdin_data=stdin_data)
+        self.assertEqual(exit_status, 0)
+        self.assertEqual(stdout, lines)
+        self.assertEqual(stderr, ['done'])
+        self.assertEqual(Metrics.get('pycloud_ssh_stdin_bytes_total').total, len(stdin_data))
+
+    def test_run_shell_command(self):
+        """Command output is logged below ERROR, and written to the host's log file."""
+        os.environ[HOST_LOG_DIR_ENV] = self.temp_dir
+        provisioner = FakeProvisioner(FakeClient(lambda command: ScriptedChannel([
+            ('stdout', b'hello\n'), ('stderr', b'oops\n')])))
+        instance = FakeInstance()
+        instance.public_dns_name = 'host-1.example.com'
+
+        with self.assertLogs('pycloud', level='DEBUG') as logs:
+            exit_status = provisioner.run_shell_command(None, instance, None, 'ubuntu', 22, 'echo hello')
+        self.assertEqual(exit_status, 0)
+        self.assertIn('DEBUG:pycloud:[host-1.example.com] STDOUT: hello', logs.output)
+        self.assertFalse([line for line in logs.output if line.startswith('ERROR')])
+
+        with open(os.path.join(self.temp_dir, 'host-1.example.com.log')) as f:
+            logged = [line.split(' ', 2)[2].rstrip('\n') for line in f]
+        self.assertEqual(logged, ['COMMAND: echo hello', 'STDOUT: hello', 'STDERR: oops', 'EXIT: 0'])
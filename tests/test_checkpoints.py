@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.checkpoints`, and resuming or skipping tasks with it."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pycloud.core.checkpoints import CheckpointJournal, COMPLETED, FAILED, fingerprint
+from pycloud.core.config import PyCloudConfig
+from pycloud.core.provisioners.base import BaseProvisioner
+from pycloud.core.provisioners.plan_executor import PlanExecutor
+from pycloud.core.registry import Registry
+from pycloud.core.state import JournalStateBackend
+
+
+class RecordingProvisioner(BaseProvisioner):
+
+    name = 'Recording Provisioner'
+
+    description = 'A provisioner that records the tasks it sets up and tears down.'
+
+    slug = 'checkpoint_test'
+
+    required_args = ['output']
+
+    optional_args = ['fail']
+
+    calls = []
+
+    def up(self, name, output=None, fail=None, **kwargs):
+
+        RecordingProvisioner.calls.append(('up', name))
+        self.config.set(output, name)
+        if fail:
+            raise ValueError('%s failed' % name)
+
+    def down(self, name, output=None, fail=None, **kwargs):
+
+        RecordingProvisioner.calls.append(('down', name))
+        if self.config.get(output) != None:
+            self.config.delete(output)
+
+Registry.register_provisioner(RecordingProvisioner)
+
+PLAN = '''
+---
+tasks:
+    - checkpoint_test:
+        name: first
+        output: first_output
+    - checkpoint_test:
+        name: second
+        output: second_output
+        fail: %s
+    - checkpoint_test:
+        name: third
+        output: third_output
+        depends_on: second
+'''
+
+
+class TestCheckpoints(unittest.TestCase):
+    """Tests for resuming and tearing down with the checkpoint journal."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.plan_path = os.path.join(self.temp_dir, 'plan.yml')
+        os.environ['PYCLOUD_PLAN_CACHE'] = '0'
+        PyCloudConfig.use_backend(JournalStateBackend(os.path.join(self.temp_dir, 'state.journal')))
+        RecordingProvisioner.calls = []
+
+    def tearDown(self):
+
+        del os.environ['PYCLOUD_PLAN_CACHE']
+        PyCloudConfig.use_backend(None)
+        shutil.rmtree(self.temp_dir)
+
+    def executor(self, fail):
+
+        with open(self.plan_path, 'w') as f:
+            f.write(PLAN % fail)
+        executor = PlanExecutor(self.plan_path)
+        executor.checkpoints = CheckpointJournal(os.path.join(self.temp_dir, 'plan.journal'))
+        executor.report_dir = self.temp_dir
+        return executor
+
+    def test_resume(self):
+        """A resumed setup starts from the first task that did not complete."""
+        with self.assertRaises(ValueError):
+            self.executor(fail='true').setup()
+
+        executor = self.executor(fail='false')
+        self.assertEqual(executor.checkpoints.get('first')['status'], COMPLETED)
+        self.assertEqual(executor.checkpoints.get('first')['outputs'], {'first_output': 'first'})
+        self.assertEqual(executor.checkpoints.get('second')['status'], FAILED)
+        self.assertEqual(executor.checkpoints.get('third'), None)
+
+        RecordingProvisioner.calls = []
+        executor.setup(resume=True)
+        self.assertEqual(RecordingProvisioner.calls, [('up', 'second'), ('up', 'third')])
+
+        # outputs of skipped tasks that went missing are restored
+        PyCloudConfig().delete('first_output')
+        RecordingProvisioner.calls = []
+        self.executor(fail='false').setup(resume=True)
+        self.assertEqual(RecordingProvisioner.calls, [])
+        self.assertEqual(PyCloudConfig().get('first_output'), 'first')
+
+    def test_changed_arguments_are_not_skipped(self):
+        """Tasks whose arguments changed, and the ones after them, run again."""
+        self.executor(fail='false').setup()
+
+        RecordingProvisioner.calls = []
+        executor = self.executor(fail='0')
+        executor.setup(resume=True)
+        self.assertEqual(RecordingProvisioner.calls, [('up', 'second'), ('up', 'third')])
+
+    def test_teardown_skips_tasks_never_set_up(self):
+        """Teardown only undoes the tasks that were set up."""
+        with self.assertRaises(ValueError):
+            self.executor(fail='true').setup()
+
+        RecordingProvisioner.calls = []
+        self.executor(fail='true').teardown()
+        self.assertEqual(RecordingProvisioner.calls, [('down', 'second'), ('down', 'first')])
+
+        RecordingProvisioner.calls = []
+        self.executor(fail='true').teardown()
+        self.assertEqual(RecordingProvisioner.calls, [])
+
+        self.executor(fail='true').teardown(all_tasks=True)
+        self.assertEqual(len(RecordingProvisioner.calls), 3)
+
+    def test_changed_only(self):
+        """Only tasks whose fingerprint, or an upstream one, changed run again."""
+        self.executor(fail='false').setup()
+
+        RecordingProvisioner.calls = []
+        self.executor(fail='false').setup(changed_only=True)
+        self.assertEqual(RecordingProvisioner.calls, [])
+
+        self.executor(fail='0').setup(changed_only=True)
+        self.assertEqual(RecordingProvisioner.calls, [('up', 'second'), ('up', 'third')])
+
+        # a new provisioner version changes every fingerprint
+        RecordingProvisioner.calls = []
+        RecordingProvisioner.version = 2
+        try:
+            self.executor(fail='0').dry_setup(changed_only=True)
+            self.assertEqual(RecordingProvisioner.calls, [('up', 'first'), ('up', 'second'), ('up', 'third')])
+        finally:
+            RecordingProvisioner.version = 1
+
+        # torn down tasks are no longer unchanged
+        self.executor(fail='0').teardown()
+        RecordingProvisioner.calls = []
+        self.executor(fail='0').setup(changed_only=True)
+        self.assertEqual(len(RecordingProvisioner.calls), 3)
+
+    def test_fingerprint(self):
+        """Fingerprints ignore the arguments passed to every task."""
+        self.assertEqual(fingerprint('debug', {'name': 'a', 'echo': 'b'}),
+                         fingerprint('debug', {'name': 'a', 'echo': 'b', 'AWS_SECRET_KEY': 'secret'}))
+        self.assertNotEqual(fingerprint('debug', {'name': 'a', 'echo': 'b'}),
+                            fingerprint('debug', {'name': 'a', 'echo': 'c'}))
+        self.assertNotEqual(fingerprint('debug', {'name': 'a'}, version=1),
+                            fingerprint('debug', {'name': 'a'}, version=2))
+
+    def test_compaction(self):
+        """A journal with many records per task is compacted when read."""
+        path = os.path.join(self.temp_dir, 'compact.journal')
+        journal = CheckpointJournal(path, compact_ratio=2)
+        for _ in range(5):
+            journal.record('task', 'setup', COMPLETED, fingerprint='abc')
+
+        reloaded = CheckpointJournal(path, compact_ratio=2)
+        self.assertTrue(reloaded.is_completed('task', 'abc'))
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 1)
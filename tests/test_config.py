@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.config` and `pycloud.core.state`."""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+from pycloud.core.config import PyCloudConfig
+from pycloud.core.state import JournalStateBackend, YAMLStateBackend, STATE_BACKENDS
+
+WRITERS = 8
+
+
+def concurrent_writer(backend_name, path, writer, keys):
+    """Writes keys of its own and increments a shared counter."""
+    if backend_name == 'journal':
+        backend = JournalStateBackend(path, compact_min_entries=40, compact_ratio=2)
+    else:
+        backend = YAMLStateBackend(path)
+    PyCloudConfig.use_backend(backend)
+
+    config = PyCloudConfig()
+    for i in range(keys):
+        config.set('writer-%d-%d' % (writer, i), i)
+        config.update('counter', lambda value: (value or 0) + 1)
+        if i % 10 == 0:
+            config.delete('writer-%d-%d' % (writer, i))
+
+
+class TestJournalState(unittest.TestCase):
+    """Tests for `PyCloudConfig` backed by `JournalStateBackend`."""
+
+    def setUp(self):
+        """Points PyCloudConfig at a temporary journal."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.temp_dir, 'state.journal')
+        self.legacy_path = os.path.join(self.temp_dir, 'config.yml')
+
+    def tearDown(self):
+        """Removes the temporary journal."""
+        PyCloudConfig.use_backend(None)
+        shutil.rmtree(self.temp_dir)
+
+    def use_journal(self, **kwargs):
+        backend = JournalStateBackend(self.journal_path, legacy_path=self.legacy_path, **kwargs)
+        PyCloudConfig.use_backend(backend)
+        return backend
+
+    def journal_lines(self):
+        with open(self.journal_path) as f:
+            return f.readlines()
+
+    def test_set_get_delete(self):
+        """Changes are appended to the journal and survive a reload."""
+        self.use_journal()
+        config = PyCloudConfig()
+        config.set('$vms', ['i-1', 'i-2'])
+        config.set('other', 'value')
+        config.delete('other')
+
+        self.assertEqual(len(self.journal_lines()), 3)
+
+        self.use_journal()
+        self.assertEqual(PyCloudConfig().get('$vms'), ['i-1', 'i-2'])
+        self.assertEqual(PyCloudConfig().get('other'), None)
+
+    def test_batch(self):
+        """Nothing is written until the batch ends, and then only once per key."""
+        self.use_journal()
+        config = PyCloudConfig()
+        with config.batch():
+            for i in range(10):
+                config.set('counter', i)
+            self.assertEqual(self.journal_lines(), [])
+
+        self.assertEqual(len(self.journal_lines()), 1)
+        self.use_journal()
+        self.assertEqual(PyCloudConfig().get('counter'), 9)
+
+    def test_imports_legacy_yaml(self):
+        """Existing YAML state is imported when the journal is created."""
+        with open(self.legacy_path, 'w') as f:
+            yaml.dump({'$vms': ['i-1']}, f)
+
+        self.use_journal()
+        self.assertEqual(PyCloudConfig().get('$vms'), ['i-1'])
+        self.assertTrue(os.path.exists(self.journal_path))
+
+    def test_compaction(self):
+        """The journal is compacted once it grows past the live keys."""
+        backend = self.use_journal(compact_min_entries=10, compact_ratio=2)
+        config = PyCloudConfig()
+        for i in range(25):
+            config.set('key', i)
+
+        self.assertLess(len(self.journal_lines()), 10)
+        self.assertLess(backend.entries, 10)
+        self.use_journal()
+        self.assertEqual(PyCloudConfig().get('key'), 24)
+
+
+class TestYAMLState(unittest.TestCase):
+    """Tests for `YAMLStateBackend`."""
+
+    def setUp(self):
+        """Creates a temporary directory for the state."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'config.yml')
+
+    def tearDown(self):
+        """Removes the temporary directory."""
+        shutil.rmtree(self.temp_dir)
+
+    def test_deletions_by_other_processes(self):
+        """Keys another process deleted are dropped, unless this process changed them."""
+        ours = YAMLStateBackend(self.path)
+        theirs = YAMLStateBackend(self.path)
+        theirs_state = theirs.load()
+        theirs.write([('set', 'deleted', 1), ('set', 'changed', 1)], theirs_state)
+
+        state = ours.load()
+        theirs.write([('delete', 'deleted', None), ('delete', 'changed', None)], theirs_state)
+        state['changed'] = 2
+        ours.write([('set', 'changed', 2), ('set', 'new', 3)], state)
+
+        self.assertEqual(state, {'changed': 2, 'new': 3})
+        self.assertEqual(YAMLStateBackend(self.path).load(), {'changed': 2, 'new': 3})
+
+
+class TestConcurrentWriters(unittest.TestCase):
+    """Stress tests for several processes sharing one state store."""
+
+    def setUp(self):
+        """Creates a temporary directory for the state."""
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Removes the temporary directory."""
+        PyCloudConfig.use_backend(None)
+        shutil.rmtree(self.temp_dir)
+
+    def run_writers(self, backend_name, keys):
+        path = os.path.join(self.temp_dir, 'state.%s' % backend_name)
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=concurrent_writer, args=(backend_name, path, writer, keys))
+                     for writer in range(WRITERS)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        PyCloudConfig.use_backend(STATE_BACKENDS[backend_name](path))
+        config = PyCloudConfig()
+        self.assertEqual(config.get('counter'), WRITERS * keys)
+        for writer in range(WRITERS):
+            for i in range(keys):
+                expected = None if i % 10 == 0 else i
+                self.assertEqual(config.get('writer-%d-%d' % (writer, i)), expected)
+
+    def test_journal(self):
+        """No change is lost when processes append and compact concurrently."""
+        self.run_writers('journal', 50)
+
+    def test_yaml(self):
+        """No change is lost when processes rewrite the YAML file concurrently."""
+        self.run_writers('yaml', 10)
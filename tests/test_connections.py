@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.utils.connections`."""
+
+import unittest
+
+from pycloud.core.provisioners.utils.connections import EC2ConnectionCache, normalize_region
+
+
+class TestConnections(unittest.TestCase):
+    """Tests for the EC2 connection cache."""
+
+    def test_normalize_region(self):
+        """Availability zones are turned into their region."""
+        self.assertEqual(normalize_region('us-east-1a'), 'us-east-1')
+        self.assertEqual(normalize_region('us-east-1'), 'us-east-1')
+        self.assertEqual(normalize_region('eu-west-2c'), 'eu-west-2')
+        self.assertEqual(normalize_region('us-gov-west-1b'), 'us-gov-west-1')
+        self.assertEqual(normalize_region('ap-northeast-1'), 'ap-northeast-1')
+
+    def test_connections_are_shared(self):
+        """One connection is created per region and access key."""
+        cache = EC2ConnectionCache()
+        first = cache.get('us-east-1a', 'access', 'secret')
+        second = cache.get('us-east-1b', 'access', 'secret')
+        other_region = cache.get('us-west-2a', 'access', 'secret')
+
+        self.assertIs(first, second)
+        self.assertEqual(first.region.name, 'us-east-1')
+        self.assertEqual(other_region.region.name, 'us-west-2')
+        self.assertEqual(cache.stats, {'created': 2, 'hits': 1, 'regions': ['us-east-1', 'us-west-2']})
+
+    def test_invalid_region(self):
+        """Unknown regions are rejected."""
+        with self.assertRaises(ValueError):
+            EC2ConnectionCache().get('nowhere-1', 'access', 'secret')
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.utils.fanout`."""
+
+import threading
+import time
+import unittest
+
+from pycloud.core.errors import HostFailureError
+from pycloud.core.provisioners.utils.fanout import fan_out
+
+
+class TestFanOut(unittest.TestCase):
+    """Tests for `fan_out`."""
+
+    def test_bounded_concurrency(self):
+        """No more than 'max_parallel_hosts' hosts run at once."""
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def work(host):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+            return 0
+
+        result = fan_out(['host-%d' % i for i in range(12)], work, max_parallel_hosts=3)
+
+        self.assertEqual(state['peak'], 3)
+        self.assertEqual(len(result.succeeded), 12)
+        self.assertEqual(result.exit_statuses['host-0'], 0)
+
+    def test_failures_over_threshold_raise(self):
+        """Failing more hosts than tolerated raises with every result."""
+        def work(host):
+            if host == 'bad':
+                raise IOError('unreachable')
+            return 1 if host == 'exit' else 0
+
+        with self.assertRaises(HostFailureError) as context:
+            fan_out(['good', 'bad', 'exit', 'fine'], work)
+
+        results = context.exception.results
+        self.assertEqual(sorted(r.host for r in results.failed), ['bad', 'exit'])
+        self.assertEqual(results.failure_percent, 50.0)
+
+    def test_failures_within_threshold(self):
+        """Failures within 'max_failed_hosts_percent' are tolerated."""
+        result = fan_out(['a', 'b', 'c', 'd'], lambda host: 1 if host == 'a' else 0,
+                         max_failed_hosts_percent=25)
+
+        self.assertEqual(len(result.failed), 1)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.utils.keygen`, and the `ssh_keygen` provisioner."""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import paramiko
+
+from pycloud.core.provisioners.aws.os import SSHKeyGenerator
+from pycloud.core.provisioners.utils.keygen import write_key_pair
+
+KEY_CLASSES = {
+    'rsa': paramiko.RSAKey,
+    'ecdsa': paramiko.ECDSAKey,
+    'ed25519': paramiko.Ed25519Key,
+}
+
+
+class TestKeygen(unittest.TestCase):
+    """Tests for generating SSH keys in-process."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.temp_dir)
+
+    def test_key_types(self):
+        """Every in-process key type is written in a format paramiko (and ssh) reads."""
+        for key_type, key_class in KEY_CLASSES.items():
+            for passphrase in ['', 'secret']:
+                path = os.path.join(self.temp_dir, '%s-%s' % (key_type, passphrase or 'plain'))
+                public_path = write_key_pair(key_type, path, passphrase=passphrase, comment='rick@example')
+
+                key = key_class.from_private_key_file(path, password=passphrase or None)
+                with open(public_path) as f:
+                    algorithm, encoded, comment = f.read().split()
+                self.assertEqual((algorithm, encoded), (key.get_name(), key.get_base64()))
+                self.assertEqual(comment, 'rick@example')
+                self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+        with self.assertRaises(paramiko.PasswordRequiredException):
+            paramiko.Ed25519Key.from_private_key_file(os.path.join(self.temp_dir, 'ed25519-secret'))
+
+    def test_provisioner_honours_file(self):
+        """'ssh_keygen' writes to 'file' in 'out_dir', and refuses to overwrite it."""
+        provisioner = SSHKeyGenerator()
+        provisioner.up('keys', key_type='ed25519', file='deploy_key', passphrase='', out_dir=self.temp_dir)
+
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['deploy_key', 'deploy_key.pub'])
+        with self.assertRaises(IOError):
+            provisioner.up('keys', key_type='ed25519', file='deploy_key', passphrase='', out_dir=self.temp_dir)
+
+        provisioner.down('keys', key_type='ed25519', file='deploy_key', passphrase='', out_dir=self.temp_dir)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    def test_users(self):
+        """With 'users', a key is generated for each of them, across processes for RSA."""
+        users = ['rick', 'morty', 'summer']
+        kwargs = dict(key_type='rsa', file='id_rsa', passphrase='', out_dir=self.temp_dir, users=users)
+        SSHKeyGenerator().up('keys', **kwargs)
+
+        for user in users:
+            key = paramiko.RSAKey.from_private_key_file(os.path.join(self.temp_dir, user, 'id_rsa'))
+            with open(os.path.join(self.temp_dir, user, 'id_rsa.pub')) as f:
+                self.assertEqual(f.read().split()[1:], [key.get_base64(), user])
+
+        provides, _ = SSHKeyGenerator.references(**kwargs)
+        self.assertIn(('path', os.path.join(self.temp_dir, 'morty', 'id_rsa.pub')), provides)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.keypair_storage`."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from pycloud.core.keypair_storage import KeyPairStorage
+from pycloud.core.provisioners.utils.keygen import write_key_pair
+
+
+class FakeKeyPair(object):
+
+    def __init__(self, material):
+        self.material = material
+
+
+class CountingKeyPairStorage(KeyPairStorage):
+
+    parsed = 0
+
+    def parse(self, material):
+        CountingKeyPairStorage.parsed += 1
+        return super(CountingKeyPairStorage, self).parse(material)
+
+
+def rsa_pem():
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                             serialization.NoEncryption()).decode('ascii')
+
+
+class TestKeyPairStorage(unittest.TestCase):
+    """Tests for the parsed private key cache of `KeyPairStorage`."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_dir = KeyPairStorage.KEY_PAIR_DIR
+        KeyPairStorage.KEY_PAIR_DIR = self.temp_dir
+        KeyPairStorage.key_cache.clear()
+        CountingKeyPairStorage.parsed = 0
+
+    def tearDown(self):
+
+        KeyPairStorage.KEY_PAIR_DIR = self.original_dir
+        KeyPairStorage.key_cache.clear()
+        shutil.rmtree(self.temp_dir)
+
+    def test_saved_keys_are_not_read_back(self):
+        """The key saved for a new key pair is cached, and parsed only once."""
+        storage = CountingKeyPairStorage('admin_kp')
+        storage.save(FakeKeyPair(rsa_pem()))
+
+        key = CountingKeyPairStorage('admin_kp').private_key
+        self.assertIsInstance(key, paramiko.RSAKey)
+        self.assertIs(CountingKeyPairStorage('admin_kp').private_key, key)
+        self.assertEqual(CountingKeyPairStorage.parsed, 1)
+
+    def test_replaced_files_are_parsed_again(self):
+        """A key file that was replaced is parsed again."""
+        storage = CountingKeyPairStorage('admin_kp')
+        storage.save(FakeKeyPair(rsa_pem()))
+        first = storage.private_key
+
+        replacement = os.path.join(self.temp_dir, 'replacement')
+        with open(replacement, 'w') as f:
+            f.write(rsa_pem())
+        os.replace(replacement, storage.path)
+
+        second = storage.private_key
+        self.assertNotEqual(first.get_base64(), second.get_base64())
+        self.assertIs(storage.private_key, second)
+        self.assertEqual(CountingKeyPairStorage.parsed, 2)
+
+    def test_key_types(self):
+        """ECDSA and Ed25519 keys are detected and parsed too."""
+        for key_type, key_class in [('ecdsa', paramiko.ECDSAKey), ('ed25519', paramiko.Ed25519Key),
+                                    ('rsa', paramiko.RSAKey)]:
+            storage = KeyPairStorage('kp_%s' % key_type)
+            write_key_pair(key_type, storage.path, comment='')
+            self.assertIsInstance(storage.private_key, key_class)
+
+    def test_delete(self):
+        """Deleting a key pair drops its cached key."""
+        storage = KeyPairStorage('admin_kp')
+        storage.save(FakeKeyPair(rsa_pem()))
+        storage.delete()
+
+        self.assertFalse(storage.exists)
+        self.assertNotIn(storage.path, KeyPairStorage.key_cache)
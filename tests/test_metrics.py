@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.metrics`."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pycloud.core.config import PyCloudConfig
+from pycloud.core.keypair_storage import KeyPairStorage
+from pycloud.core.metrics import Metrics, MetricsRegistry
+from pycloud.core.provisioners.utils.keygen import write_key_pair
+from pycloud.core.state import JournalStateBackend
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    """Tests for `MetricsRegistry`, and its counters and histograms."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.registry = MetricsRegistry()
+        self.requests = self.registry.counter('requests_total', 'Requests.', label_names=['action'])
+        self.latency = self.registry.histogram('latency_seconds', 'Latency.', buckets=[0.1, 1])
+
+    def tearDown(self):
+
+        shutil.rmtree(self.temp_dir)
+
+    def test_metrics(self):
+        """Counters add up by label, and histograms count values in buckets."""
+        self.requests.inc(action='DescribeInstances')
+        self.requests.inc(2, action='RunInstances')
+        self.requests.inc(action='DescribeInstances')
+        for value in [0.05, 0.5, 5]:
+            self.latency.observe(value)
+
+        self.assertIs(self.registry.counter('requests_total', 'Requests.', label_names=['action']), self.requests)
+        self.assertEqual(self.requests.get(action='DescribeInstances'), 2)
+        self.assertEqual(self.requests.total, 4)
+        self.assertEqual(self.latency.get(), (3, 5.55))
+        with self.assertRaises(ValueError):
+            self.requests.inc(region='us-east-1')
+        with self.assertRaises(ValueError):
+            self.registry.histogram('requests_total', 'Requests.')
+
+        self.registry.reset()
+        self.assertEqual(self.requests.total, 0)
+
+    def test_export(self):
+        """Metrics are written in the Prometheus text format, or as JSON."""
+        self.requests.inc(action='Say "hi"')
+        self.latency.observe(0.5)
+
+        prom_path = os.path.join(self.temp_dir, 'metrics.prom')
+        self.registry.export(prom_path)
+        with open(prom_path) as f:
+            lines = f.read().splitlines()
+        self.assertIn('# TYPE latency_seconds histogram', lines)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('latency_seconds_bucket{le="1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('latency_seconds_count 1', lines)
+        self.assertIn('requests_total{action="Say \\"hi\\""} 1', lines)
+
+        json_path = os.path.join(self.temp_dir, 'metrics.json')
+        self.registry.export(json_path)
+        with open(json_path) as f:
+            metrics = json.load(f)
+        self.assertEqual(metrics['requests_total']['values'], [{'labels': {'action': 'Say "hi"'}, 'value': 1}])
+        self.assertEqual(metrics['latency_seconds']['values'][0]['buckets'], {'0.1': 0, '1': 1, '+Inf': 1})
+
+
+class TestReportedMetrics(unittest.TestCase):
+    """Tests for the metrics the state and the key pair storage report."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_dir = KeyPairStorage.KEY_PAIR_DIR
+        KeyPairStorage.KEY_PAIR_DIR = self.temp_dir
+        KeyPairStorage.key_cache.clear()
+        PyCloudConfig.use_backend(JournalStateBackend(os.path.join(self.temp_dir, 'state.journal')))
+        Metrics.reset()
+
+    def tearDown(self):
+
+        KeyPairStorage.KEY_PAIR_DIR = self.original_dir
+        KeyPairStorage.key_cache.clear()
+        PyCloudConfig.use_backend(None)
+        shutil.rmtree(self.temp_dir)
+
+    def test_state_writes(self):
+        """A batch of changes is a single write to the state backend."""
+        config = PyCloudConfig()
+        with config.batch():
+            config.set('a', 1)
+            config.set('b', 2)
+        config.set('c', 3)
+
+        self.assertEqual(Metrics.get('pycloud_state_loads_total').total, 1)
+        self.assertEqual(Metrics.get('pycloud_state_writes_total').total, 2)
+        self.assertEqual(Metrics.get('pycloud_state_changes_total').total, 3)
+        self.assertEqual(Metrics.get('pycloud_state_write_seconds').get()[0], 2)
+
+    def test_private_key_lookups(self):
+        """Private keys are counted as parsed the first time, and cached after."""
+        storage = KeyPairStorage('admin_kp')
+        write_key_pair('ed25519', storage.path)
+        for _ in range(3):
+            storage.private_key
+
+        lookups = Metrics.get('pycloud_private_key_lookups_total')
+        self.assertEqual(lookups.get(result='parsed'), 1)
+        self.assertEqual(lookups.get(result='cached'), 2)
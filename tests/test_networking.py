@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.utils.networking`."""
+
+import socket
+import time
+import unittest
+
+from pycloud.core.errors import WaiterTimeoutError
+from pycloud.core.provisioners.utils.networking import PortProber, PortReadinessProber, is_port_open
+from tests.fakes import FakeProvisioner
+
+
+def listen():
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(16)
+    return server, ('127.0.0.1', server.getsockname()[1])
+
+
+def closed_port():
+
+    server, target = listen()
+    server.close()
+    return target
+
+
+class TestPortReadinessProber(unittest.TestCase):
+    """Tests for `PortReadinessProber`."""
+
+    def setUp(self):
+
+        self.servers = []
+        self.prober = PortReadinessProber(attempt_timeout=0.5, initial_delay=0.05, max_delay=0.1)
+
+    def tearDown(self):
+
+        for server in self.servers:
+            server.close()
+
+    def open_port(self):
+
+        server, target = listen()
+        self.servers.append(server)
+        return target
+
+    def test_is_port_open(self):
+        """'is_port_open' tells open and closed ports apart."""
+        self.assertTrue(is_port_open(*self.open_port(), timeout=1))
+        self.assertFalse(is_port_open(*closed_port(), timeout=1))
+
+    def test_probes_many_ports_at_once(self):
+        """One round checks every port, and reports the open ones."""
+        open_ports = [self.open_port() for _ in range(10)]
+        closed = closed_port()
+
+        self.assertEqual(self.prober.probe(open_ports + [closed]), set(open_ports))
+        self.assertEqual(self.prober.stats['attempts'], 11)
+
+    def test_deadline(self):
+        """Ports that never open fail the wait once the deadline passes."""
+        target = closed_port()
+        started = time.time()
+        with self.assertRaises(WaiterTimeoutError):
+            self.prober.wait([self.open_port(), target], timeout=0.3)
+        self.assertLess(time.time() - started, 2)
+
+    def test_open_ports_are_remembered(self):
+        """A port found open is not probed again until it is forgotten."""
+        server, target = listen()
+        self.prober.wait([target], timeout=1)
+        server.close()
+
+        self.prober.wait([target], timeout=1)
+        self.assertEqual(self.prober.stats['hits'], 1)
+
+        self.prober.forget(*target)
+        with self.assertRaises(WaiterTimeoutError):
+            self.prober.wait([target], timeout=0.2)
+
+
+class Host(object):
+
+    def __init__(self, hostname):
+        self.id = hostname
+        self.public_dns_name = hostname
+
+
+class TestProbeBeforeFanOut(unittest.TestCase):
+    """Tests for `AWSProvisionerMixin.run_on_instances` with an SSH port."""
+
+    def setUp(self):
+
+        self.server, (_, self.port) = listen()
+        PortProber.forget()
+        PortProber.reset_stats()
+
+    def tearDown(self):
+
+        self.server.close()
+        PortProber.forget()
+
+    def test_hosts_are_probed_once_before_the_fan_out(self):
+        """Every host is probed in one wait, and unreachable ones fail without running."""
+        ran = []
+
+        def work(instance):
+            ran.append(instance.public_dns_name)
+            return 0
+
+        provisioner = FakeProvisioner(None)
+        result = provisioner.run_on_instances([Host('127.0.0.1'), Host('unreachable.invalid')], work,
+                                              max_failed_hosts_percent=100, ssh_port=self.port, max_rt=0.05)
+
+        self.assertEqual(ran, ['127.0.0.1'])
+        self.assertEqual([r.host for r in result.succeeded], ['127.0.0.1'])
+        self.assertIsInstance(result.failed[0].error, WaiterTimeoutError)
+
+        # later connections find the port known to be open
+        provisioner.wait_for_ssh(['127.0.0.1'], ssh_port=self.port)
+        self.assertEqual(PortProber.stats['hits'], 1)
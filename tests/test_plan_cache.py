@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.plan_cache`."""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from pycloud.core.errors import InvalidPlanError
+from pycloud.core.plan_cache import ParsedPlanCache
+from pycloud.core.provisioners import plan_executor
+from pycloud.core.provisioners.plan_executor import PlanExecutor
+
+PLAN = '''
+---
+tasks:
+    - debug:
+        name: Say Hello
+        echo: Hello World
+    - debug:
+        name: Say Goodbye
+        echo: Goodbye
+        depends_on: Say Hello
+'''
+
+
+class TestPlanCache(unittest.TestCase):
+    """Tests for the parsed plan cache."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = ParsedPlanCache(os.path.join(self.temp_dir, 'cache'), max_entries=2)
+        self.parsed = []
+
+    def tearDown(self):
+
+        shutil.rmtree(self.temp_dir)
+
+    def write_plan(self, content, name='plan.yml'):
+
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def parse(self, content):
+
+        self.parsed.append(content)
+        return {'content': content.decode('utf-8')}
+
+    def test_cached_plans_are_not_parsed(self):
+        """A plan is parsed once, until its content changes."""
+        path = self.write_plan('first')
+        self.assertEqual(self.cache.load(path, self.parse), {'content': 'first'})
+        self.assertEqual(self.cache.load(path, self.parse), {'content': 'first'})
+        self.assertEqual(len(self.parsed), 1)
+
+        self.write_plan('second')
+        self.assertEqual(self.cache.load(path, self.parse), {'content': 'second'})
+        self.assertEqual(len(self.parsed), 2)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_corrupt_entries_are_ignored(self):
+        """A corrupt entry is replaced by parsing the plan again."""
+        path = self.write_plan('plan')
+        self.cache.load(path, self.parse)
+        with open(self.cache.path(self.cache.key(b'plan')), 'wb') as f:
+            f.write(b'\x00garbage')
+
+        self.assertEqual(self.cache.load(path, self.parse), {'content': 'plan'})
+        self.assertEqual(len(self.parsed), 2)
+
+    def test_unserializable_plans_are_not_cached(self):
+        """Plans that marshal can not store are parsed every time."""
+        path = self.write_plan('plan')
+        parse = lambda content: {'when': datetime.date(2020, 1, 1)}
+        self.cache.load(path, parse)
+
+        self.assertFalse(os.path.exists(self.cache.path(self.cache.key(b'plan'))))
+
+    def test_prune(self):
+        """Only the most recently used entries are kept."""
+        for index in range(4):
+            self.cache.load(self.write_plan('plan %d' % index, 'plan_%d.yml' % index), self.parse)
+
+        self.assertEqual(len(os.listdir(self.cache.cache_dir)), 2)
+
+    def test_disabled(self):
+        """PYCLOUD_PLAN_CACHE=0 turns the cache off."""
+        path = self.write_plan('plan')
+        os.environ['PYCLOUD_PLAN_CACHE'] = '0'
+        try:
+            self.cache.load(path, self.parse)
+            self.cache.load(path, self.parse)
+        finally:
+            del os.environ['PYCLOUD_PLAN_CACHE']
+
+        self.assertEqual(len(self.parsed), 2)
+        self.assertFalse(os.path.exists(self.cache.cache_dir))
+
+    def test_plan_executor(self):
+        """The plan executor reads its tasks through the cache."""
+        original = plan_executor.PlanCache
+        plan_executor.PlanCache = self.cache
+        try:
+            path = self.write_plan(PLAN)
+            first = PlanExecutor(path)
+            second = PlanExecutor(path)
+        finally:
+            plan_executor.PlanCache = original
+
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(first.tasks, second.tasks)
+        self.assertEqual(second.tasks[1], ('debug', {'name': 'Say Goodbye', 'echo': 'Goodbye',
+                                                      'depends_on': 'Say Hello'}))
+        for _ in range(2):
+            self.assertEqual(second.dependency_graph.nodes[1].upstream, set([0]))
+
+    def test_invalid_plans(self):
+        """Invalid plans are rejected, and not cached."""
+        for content in ['', 'tasks: {}', 'tasks: [{debug: {}, err: {}}]', 'tasks: [{debug: hello}]']:
+            with self.assertRaises(InvalidPlanError):
+                PlanExecutor(None).parse_plan(content.encode('utf-8'))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.registry`."""
+
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import unittest
+
+from pycloud.core.provisioners.base import BaseProvisioner
+from pycloud.core.registry import BUILTIN_PROVISIONERS, Registry, RegistryManager
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+
+class LazyProvisioner(BaseProvisioner):
+
+    name = 'Lazy Provisioner'
+
+    description = 'A provisioner that is registered lazily.'
+
+    slug = 'lazy'
+
+
+class TestRegistry(unittest.TestCase):
+    """Tests for lazily loaded provisioners."""
+
+    def test_builtin_provisioners_are_listed(self):
+        """Every builtin provisioner is known by slug."""
+        self.assertEqual(set(BUILTIN_PROVISIONERS.keys()) - set(Registry.slugs), set())
+
+    def test_get_imports_on_first_use(self):
+        """Resolving a provisioner imports only the module that implements it."""
+        script = textwrap.dedent('''
+            import json, sys
+            import pycloud.core.cli
+            from pycloud.core.registry import Registry
+            before = [m for m in ('boto', 'paramiko', 'sultan') if m in sys.modules]
+            slug = Registry.get('debug').slug
+            after = [m for m in ('boto', 'paramiko', 'sultan') if m in sys.modules]
+            Registry.get('ec2_instance')
+            print(json.dumps([before, slug, after, 'boto' in sys.modules]))
+        ''')
+        env = dict(os.environ, PYTHONPATH=SRC_PATH)
+        output = subprocess.check_output([sys.executable, '-c', script], env=env)
+        before, slug, after, aws_loaded = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+        self.assertEqual(before, [])
+        self.assertEqual(slug, 'debug')
+        self.assertEqual(after, [])
+        self.assertTrue(aws_loaded)
+
+    def test_register_lazy(self):
+        """A lazily registered provisioner is imported from 'module:Class'."""
+        registry = RegistryManager()
+        registry.register_lazy('lazy', '%s:LazyProvisioner' % __name__)
+
+        self.assertIn('lazy', registry.slugs)
+        self.assertIs(registry.get('lazy'), LazyProvisioner)
+        with self.assertRaises(ValueError):
+            registry.register_lazy('lazy', '%s:LazyProvisioner' % __name__)
+
+    def test_slug_mismatch(self):
+        """A target whose slug differs from the registered one is rejected."""
+        registry = RegistryManager()
+        registry.register_lazy('other', '%s:LazyProvisioner' % __name__)
+
+        with self.assertRaises(ValueError):
+            registry.get('other')
+
+    def test_unknown_slug(self):
+        """Unknown slugs raise a ValueError."""
+        with self.assertRaises(ValueError):
+            RegistryManager().get('does_not_exist')
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.utils.remote_script`."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pycloud.core.provisioners.utils.remote_script import RemoteScript
+from tests.fakes import FakeClient, FakeInstance, FakeProvisioner
+
+
+class TestRemoteScript(unittest.TestCase):
+    """Tests for `RemoteScript`, run with a local bash."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.client = FakeClient()
+        self.provisioner = FakeProvisioner(self.client)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.temp_dir)
+
+    def run_script(self, script):
+
+        return self.provisioner.run_script(None, FakeInstance(), None, 'ubuntu', 22, script)
+
+    def test_runs_every_step_over_one_channel(self):
+        """Commands and files run in order, in a single command."""
+        source = os.path.join(self.temp_dir, 'source')
+        with open(source, 'wb') as f:
+            f.write(b'line one\n\x00binary\'"$(quotes)\n' * 100)
+        destination = os.path.join(self.temp_dir, 'sub dir', 'copy')
+
+        script = RemoteScript()
+        script.run('mkdir -p "%s"' % os.path.dirname(destination))
+        script.put_file(source, destination)
+        script.run('printf "no newline"')
+        script.run('cat > /dev/null; echo stdin is empty')
+        result = self.run_script(script)
+
+        self.assertEqual(self.client.commands, ['bash -s'])
+        self.assertEqual(result.step_statuses, [0, 0, 0, 0])
+        self.assertTrue(result.ok)
+        self.assertEqual(result.stdout, ['no newline', 'stdin is empty'])
+        with open(source, 'rb') as expected, open(destination, 'rb') as copied:
+            self.assertEqual(expected.read(), copied.read())
+
+    def test_stops_at_first_failure(self):
+        """A failing step stops the script, unless its status is allowed."""
+        script = RemoteScript()
+        script.run('exit 9', ok_statuses=[0, 9])
+        script.run('echo failing >&2; exit 3', description='failing step')
+        script.run('echo never')
+        result = self.run_script(script)
+
+        self.assertEqual(result.step_statuses, [9, 3, None])
+        self.assertEqual(result.exit_status, 3)
+        self.assertEqual(result.failed_step.description, 'failing step')
+        self.assertEqual(result.stderr, ['failing'])
+        self.assertEqual(result.stdout, [])
+
+    def test_unchanged_files_are_not_written(self):
+        """A file with the same content only gets its mode set."""
+        destination = os.path.join(self.temp_dir, 'key')
+        with open(destination, 'wb') as f:
+            f.write(b'key')
+        os.chmod(destination, 0o644)
+        os.utime(destination, (0, 0))
+
+        result = self.run_script(RemoteScript().write_file(destination, b'key', mode=0o400))
+        self.assertTrue(result.ok)
+        self.assertEqual(os.stat(destination).st_mtime, 0)
+        self.assertEqual(os.stat(destination).st_mode & 0o777, 0o400)
+
+        result = self.run_script(RemoteScript().write_file(destination, b'new key', mode=0o400))
+        self.assertTrue(result.ok)
+        self.assertNotEqual(os.stat(destination).st_mtime, 0)
+        self.assertEqual(os.stat(destination).st_mode & 0o777, 0o400)
+        with open(destination, 'rb') as f:
+            self.assertEqual(f.read(), b'new key')
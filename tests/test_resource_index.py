@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.utils.resource_index`."""
+
+import unittest
+
+from pycloud.core.provisioners.utils.resource_index import AWSResourceIndex, UNKNOWN, \
+    INSTANCES, KEY_PAIRS, SECURITY_GROUPS
+
+
+class Resource(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def get_all_security_groups(self, filters=None):
+        self.calls.append(('security_groups', filters))
+        return [Resource(name='web', id='sg-1')]
+
+    def get_all_key_pairs(self, filters=None):
+        self.calls.append(('key_pairs', filters))
+        return [Resource(name='admin')]
+
+    def get_only_instances(self, filters=None):
+        self.calls.append(('instances', filters))
+        return [Resource(id='i-1')]
+
+
+class TestAWSResourceIndex(unittest.TestCase):
+    """Tests for `AWSResourceIndex`."""
+
+    def setUp(self):
+        """Prefetches a region with a fake connection."""
+        self.connection = FakeConnection()
+        self.index = AWSResourceIndex()
+        self.index.prefetch(self.connection, 'us-east-1a',
+            security_groups=set(['web', 'db']), key_pairs=set(['admin']), instance_ids=set(['i-1', 'i-2']))
+
+    def test_one_call_per_kind(self):
+        """Each kind of resource is described once."""
+        self.assertEqual([kind for kind, _ in self.connection.calls], ['security_groups', 'key_pairs', 'instances'])
+        self.assertEqual(self.connection.calls[0][1], {'group-name': ['db', 'web']})
+
+    def test_lookups(self):
+        """Prefetched keys are found or known to be missing, others are unknown."""
+        self.assertEqual(self.index.lookup('us-east-1', SECURITY_GROUPS, 'web').id, 'sg-1')
+        self.assertEqual(self.index.lookup('us-east-1', SECURITY_GROUPS, 'db'), None)
+        self.assertIs(self.index.lookup('us-east-1', SECURITY_GROUPS, 'other'), UNKNOWN)
+        self.assertIs(self.index.lookup('us-west-2', KEY_PAIRS, 'admin'), UNKNOWN)
+        self.assertEqual(self.index.lookup('us-east-1', INSTANCES, 'i-2'), None)
+
+    def test_invalidate(self):
+        """Invalidated keys have to be looked up again."""
+        self.index.invalidate('us-east-1b', SECURITY_GROUPS, 'db')
+        self.assertIs(self.index.lookup('us-east-1', SECURITY_GROUPS, 'db'), UNKNOWN)
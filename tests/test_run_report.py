@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.run_report`."""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from unittest import mock
+
+from pycloud.core.config import PyCloudConfig
+from pycloud.core.provisioners.base import BaseProvisioner
+from pycloud.core.provisioners.plan_executor import PlanExecutor
+from pycloud.core.provisioners.utils.fanout import fan_out
+from pycloud.core.registry import Registry
+from pycloud.core.run_report import RunReport, merged_duration
+from pycloud.core.state import JournalStateBackend
+from pycloud.core.tracing import Tracer
+
+
+class SleepProvisioner(BaseProvisioner):
+
+    name = 'Sleep Provisioner'
+
+    description = 'A provisioner that sleeps, on its own or on several hosts, and waits on AWS.'
+
+    slug = 'report_sleep'
+
+    required_args = ['seconds']
+
+    optional_args = ['hosts', 'wait']
+
+    def up(self, name, seconds=None, hosts=None, wait=None, **kwargs):
+
+        if wait:
+            with Tracer.span('instance wait', category='wait'):
+                time.sleep(wait)
+        if hosts:
+            fan_out(sorted(hosts), lambda host: time.sleep(hosts[host]) or 0)
+        time.sleep(seconds)
+
+Registry.register_provisioner(SleepProvisioner)
+
+PLAN = '''
+---
+tasks:
+    - report_sleep:
+        name: instances
+        seconds: 0.05
+        wait: 0.1
+        hosts:
+            host-1: 0.01
+            host-2: 0.1
+    - report_sleep:
+        name: keys
+        seconds: 0.15
+    - report_sleep:
+        name: users
+        seconds: 0.05
+        depends_on: instances
+'''
+
+
+class TestRunReport(unittest.TestCase):
+    """Tests for the `RunReport` of a run."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.plan_path = os.path.join(self.temp_dir, 'plan.yml')
+        with open(self.plan_path, 'w') as f:
+            f.write(PLAN)
+        os.environ['PYCLOUD_PLAN_CACHE'] = '0'
+        PyCloudConfig.use_backend(JournalStateBackend(os.path.join(self.temp_dir, 'state.journal')))
+
+    def tearDown(self):
+
+        del os.environ['PYCLOUD_PLAN_CACHE']
+        PyCloudConfig.use_backend(None)
+        shutil.rmtree(self.temp_dir)
+
+    def test_merged_duration(self):
+        """Overlapping intervals are only counted once."""
+        self.assertEqual(merged_duration([(0, 2), (1, 3), (5, 6)]), 4)
+        self.assertEqual(merged_duration([]), 0)
+
+    def test_report(self):
+        """The report of a run is saved, with its critical path, hosts and waits."""
+        executor = PlanExecutor(self.plan_path)
+        executor.checkpoints = None
+        executor.fingerprints = None
+        executor.report_dir = self.temp_dir
+        executor.setup(jobs=2)
+        self.assertFalse(Tracer.enabled)
+
+        with open(RunReport.path_for(self.plan_path, 'setup', self.temp_dir)) as f:
+            report = json.load(f)
+
+        self.assertEqual([task['name'] for task in report['critical_path']], ['instances', 'users'])
+        self.assertGreater(report['parallelism'], 1)
+        self.assertLess(report['wall_time'], report['task_time'])
+
+        tasks = dict((task['name'], task) for task in report['tasks'])
+        self.assertEqual(tasks['instances']['hosts'], 2)
+        self.assertEqual([host['host'] for host in tasks['instances']['slowest_hosts']], ['host-2', 'host-1'])
+        self.assertGreaterEqual(tasks['instances']['wait_time'], 0.1)
+        self.assertEqual(tasks['keys']['wait_time'], 0)
+        self.assertAlmostEqual(report['wait_time'] + report['work_time'], report['task_time'], places=2)
+
+    def test_report_failure_keeps_the_run_error(self):
+        """A report that can not be made does not hide the error the run failed with."""
+        with open(self.plan_path, 'w') as f:
+            f.write('tasks:\n    - err:\n        name: failing\n        error_msg: task failed\n')
+        executor = PlanExecutor(self.plan_path)
+        executor.checkpoints = None
+        executor.fingerprints = None
+        executor.report_dir = None
+
+        with mock.patch.object(RunReport, 'print_report', side_effect=KeyError('report')), \
+                self.assertRaisesRegex(ValueError, 'task failed'):
+            executor.setup()
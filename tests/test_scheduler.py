@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.scheduler`."""
+
+import os
+import threading
+import time
+import unittest
+
+import yaml
+
+from pycloud.core.errors import InvalidPlanError
+from pycloud.core.registry import Registry
+from pycloud.core.provisioners.scheduler import DependencyGraph, TaskScheduler
+
+EXAMPLE_PLAN = os.path.join(os.path.dirname(__file__), '..', 'example_plans', 'test_plan.yml')
+
+
+def load_tasks(path):
+
+    with open(path) as f:
+        plan = yaml.safe_load(f)
+    return [(list(task.keys())[0], list(task.values())[0]) for task in plan['tasks']]
+
+
+def debug_task(name, **kwargs):
+
+    details = {'name': name, 'echo': name}
+    details.update(kwargs)
+    return ('debug', details)
+
+
+class TestDependencyGraph(unittest.TestCase):
+    """Tests for `DependencyGraph`."""
+
+    def test_infers_edges_from_references(self):
+        """Shared references between tasks become edges."""
+        graph = DependencyGraph.from_tasks(load_tasks(EXAMPLE_PLAN), Registry)
+        security_group, key_pair, instance, keygen, user_add = graph.nodes
+
+        self.assertEqual(security_group.upstream, set())
+        self.assertEqual(key_pair.upstream, set())
+        self.assertEqual(keygen.upstream, set())
+        self.assertEqual(instance.upstream, set([security_group.index, key_pair.index]))
+        self.assertEqual(user_add.upstream, set([key_pair.index, instance.index, keygen.index]))
+
+    def test_streaming_edges(self):
+        """Edges over a streamed output are streaming, unless also explicit."""
+        tasks = load_tasks(EXAMPLE_PLAN)
+        graph = DependencyGraph.from_tasks(tasks, Registry)
+        security_group, key_pair, instance, keygen, user_add = graph.nodes
+
+        self.assertEqual(user_add.streaming_upstream, set([instance.index]))
+        self.assertEqual(instance.streaming_upstream, set())
+        self.assertEqual(graph.reversed().nodes[instance.index].streaming_upstream, set())
+
+        tasks[4][1]['depends_on'] = instance.name
+        graph = DependencyGraph.from_tasks(tasks, Registry)
+        self.assertEqual(graph.nodes[4].streaming_upstream, set())
+
+    def test_explicit_depends_on(self):
+        """'depends_on' adds edges, and is removed from the task details."""
+        graph = DependencyGraph.from_tasks([
+            debug_task('one'),
+            debug_task('two', depends_on='one'),
+            debug_task('three', depends_on=['one', 'two']),
+        ], Registry)
+
+        self.assertEqual(graph.nodes[1].upstream, set([0]))
+        self.assertEqual(graph.nodes[2].upstream, set([0, 1]))
+        self.assertNotIn('depends_on', graph.nodes[1].details)
+
+    def test_unknown_dependency(self):
+        """Depending on a task that does not exist is an invalid plan."""
+        with self.assertRaises(InvalidPlanError):
+            DependencyGraph.from_tasks([debug_task('one', depends_on='missing')], Registry)
+
+    def test_cycle(self):
+        """Dependency cycles are rejected."""
+        with self.assertRaises(InvalidPlanError):
+            DependencyGraph.from_tasks([
+                debug_task('one', depends_on='two'),
+                debug_task('two', depends_on='one'),
+            ], Registry)
+
+    def test_order_follows_plan(self):
+        """Independent tasks keep the order of the plan."""
+        graph = DependencyGraph.from_tasks([
+            debug_task('one', depends_on='three'),
+            debug_task('two'),
+            debug_task('three'),
+        ], Registry)
+
+        self.assertEqual([node.name for node in graph.order], ['two', 'three', 'one'])
+
+    def test_reversed(self):
+        """A reversed graph tears tasks down after everything that used them."""
+        graph = DependencyGraph.from_tasks(load_tasks(EXAMPLE_PLAN), Registry).reversed()
+        security_group, key_pair, instance, keygen, user_add = graph.nodes
+
+        self.assertEqual(user_add.upstream, set())
+        self.assertEqual(keygen.upstream, set([user_add.index]))
+        self.assertEqual(instance.upstream, set([user_add.index]))
+        self.assertEqual(security_group.upstream, set([instance.index]))
+        self.assertEqual(
+            [node.slug for node in graph.order],
+            ['user_add', 'ssh_keygen', 'ec2_instance', 'ec2_key_pair', 'ec2_security_group'])
+
+
+class TestTaskScheduler(unittest.TestCase):
+    """Tests for `TaskScheduler`."""
+
+    def test_runs_independent_tasks_concurrently(self):
+        """Independent tasks overlap, dependent tasks wait."""
+        graph = DependencyGraph.from_tasks([
+            debug_task('a'),
+            debug_task('b'),
+            debug_task('c', depends_on=['a', 'b']),
+        ], Registry)
+
+        lock = threading.Lock()
+        events = []
+
+        def execute(node):
+            with lock:
+                events.append(('start', node.name))
+            time.sleep(0.1)
+            with lock:
+                events.append(('end', node.name))
+
+        TaskScheduler(graph, jobs=4).run(execute)
+
+        self.assertEqual(set(events[:2]), set([('start', 'a'), ('start', 'b')]))
+        self.assertEqual(events[-2:], [('start', 'c'), ('end', 'c')])
+
+    def test_failure_stops_new_tasks(self):
+        """After a failure, running tasks finish and nothing new starts."""
+        graph = DependencyGraph.from_tasks([
+            debug_task('fails'),
+            debug_task('slow'),
+            debug_task('after', depends_on='fails'),
+            debug_task('later', depends_on='slow'),
+        ], Registry)
+
+        finished = []
+
+        def execute(node):
+            if node.name == 'fails':
+                raise ValueError('boom')
+            time.sleep(0.2)
+            finished.append(node.name)
+
+        with self.assertRaises(ValueError):
+            TaskScheduler(graph, jobs=2).run(execute)
+
+        self.assertEqual(finished, ['slow'])
+
+    def test_streaming_upstream_only_has_to_start(self):
+        """A task starts as soon as the task it streams from starts."""
+        graph = DependencyGraph.from_tasks([debug_task('producer'), debug_task('consumer')], Registry)
+        graph.add_edge(graph.nodes[0], graph.nodes[1], streaming=True)
+
+        started = threading.Event()
+        overlapped = []
+
+        def execute(node):
+            if node.name == 'consumer':
+                started.set()
+            else:
+                overlapped.append(started.wait(5))
+
+        TaskScheduler(graph, jobs=2).run(execute)
+        self.assertEqual(overlapped, [True])
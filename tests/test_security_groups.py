@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `EC2SecurityGroupProvisioner` rule diffing."""
+
+import unittest
+
+from boto.exception import EC2ResponseError
+
+from pycloud.core.provisioners.aws.ec2 import EC2SecurityGroupProvisioner
+
+
+class Object(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def error(code, message):
+
+    return EC2ResponseError(400, 'Bad Request', '<?xml version="1.0" encoding="UTF-8"?><Response><Errors>'
+                            '<Error><Code>%s</Code><Message>%s</Message></Error></Errors></Response>' % (
+                                code, message))
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def get_status(self, action, params, verb=None):
+        self.calls.append((action, params))
+        if params.get('DryRun'):
+            raise error('DryRunOperation', 'Request would have succeeded, but DryRun flag is set.')
+        return True
+
+    def create_security_group(self, name, description, dry_run=False):
+        self.calls.append(('CreateSecurityGroup', {'GroupName': name, 'DryRun': dry_run}))
+        if dry_run:
+            raise error('DryRunOperation', 'Request would have succeeded, but DryRun flag is set.')
+        return Object(id='sg-2', rules=[])
+
+    def delete_security_group(self, group_id=None, dry_run=False):
+        self.calls.append(('DeleteSecurityGroup', {'GroupId': group_id}))
+        if dry_run:
+            raise error('DryRunOperation', 'Request would have succeeded, but DryRun flag is set.')
+        raise error('DependencyViolation', 'resource sg-1 has a dependent object')
+
+
+class TestSecurityGroupRules(unittest.TestCase):
+    """Tests for computing and applying rule deltas."""
+
+    def setUp(self):
+        """Creates a group with two existing rules."""
+        self.provisioner = EC2SecurityGroupProvisioner()
+        self.group = Object(id='sg-1', rules=[
+            Object(ip_protocol='tcp', from_port='22', to_port='22', grants=[Object(cidr_ip='0.0.0.0/0')]),
+            Object(ip_protocol='tcp', from_port='80', to_port='80', grants=[Object(cidr_ip='10.0.0.0/8')]),
+        ])
+        self.rules = [
+            {'tcp': {'start': 22, 'end': 22, 'cidr_ip': '0.0.0.0/0'}},
+            {'tcp': {'start': 443, 'end': 443, 'cidr_ip': '0.0.0.0/0'}},
+            {'tcp': {'start': 443, 'end': 443, 'cidr_ip': '10.0.0.0/8'}},
+            {'udp': {'start': 53, 'end': 53, 'cidr_ip': '10.0.0.0/8'}},
+        ]
+
+    def test_delta(self):
+        """Only missing rules are added, and only unplanned rules are removed."""
+        existing = self.provisioner.existing_permissions(self.group)
+        desired = self.provisioner.desired_permissions(self.rules)
+
+        self.assertEqual(desired - existing, set([
+            ('tcp', '443', '443', '0.0.0.0/0'),
+            ('tcp', '443', '443', '10.0.0.0/8'),
+            ('udp', '53', '53', '10.0.0.0/8'),
+        ]))
+        self.assertEqual(existing - desired, set([('tcp', '80', '80', '10.0.0.0/8')]))
+
+    def test_batched_authorize(self):
+        """All missing rules are authorized in a single call."""
+        connection = FakeConnection()
+        desired = self.provisioner.desired_permissions(self.rules)
+        missing = desired - self.provisioner.existing_permissions(self.group)
+        self.provisioner.apply_permissions(connection, self.group, 'AuthorizeSecurityGroupIngress', missing)
+
+        self.assertEqual(len(connection.calls), 1)
+        action, params = connection.calls[0]
+        self.assertEqual(action, 'AuthorizeSecurityGroupIngress')
+        self.assertEqual(params, {
+            'GroupId': 'sg-1',
+            'IpPermissions.1.IpProtocol': 'tcp',
+            'IpPermissions.1.FromPort': '443',
+            'IpPermissions.1.ToPort': '443',
+            'IpPermissions.1.IpRanges.1.CidrIp': '0.0.0.0/0',
+            'IpPermissions.1.IpRanges.2.CidrIp': '10.0.0.0/8',
+            'IpPermissions.2.IpProtocol': 'udp',
+            'IpPermissions.2.FromPort': '53',
+            'IpPermissions.2.ToPort': '53',
+            'IpPermissions.2.IpRanges.1.CidrIp': '10.0.0.0/8',
+        })
+
+    def test_prune_all_traffic_rule(self):
+        """Rules without ports, like all traffic, are revoked without ports."""
+        self.group.rules.append(Object(ip_protocol='-1', from_port=None, to_port=None,
+                                       grants=[Object(cidr_ip='0.0.0.0/0')]))
+        connection = FakeConnection()
+        desired = self.provisioner.desired_permissions(self.rules)
+        extra = self.provisioner.existing_permissions(self.group) - desired
+        self.assertEqual(extra, set([('-1', None, None, '0.0.0.0/0'), ('tcp', '80', '80', '10.0.0.0/8')]))
+
+        self.provisioner.apply_permissions(connection, self.group, 'RevokeSecurityGroupIngress', extra)
+        action, params = connection.calls[0]
+        self.assertEqual(params, {
+            'GroupId': 'sg-1',
+            'IpPermissions.1.IpProtocol': '-1',
+            'IpPermissions.1.IpRanges.1.CidrIp': '0.0.0.0/0',
+            'IpPermissions.2.IpProtocol': 'tcp',
+            'IpPermissions.2.FromPort': '80',
+            'IpPermissions.2.ToPort': '80',
+            'IpPermissions.2.IpRanges.1.CidrIp': '10.0.0.0/8',
+        })
+
+    def test_delete_failure_does_not_fail_teardown(self):
+        """A group that can not be deleted is left in place with a warning."""
+        connection = FakeConnection()
+        self.provisioner.ec2_connect = lambda *args: connection
+        self.provisioner.find_security_group = lambda *args: self.group
+
+        self.provisioner.down('group', group_name='group', region='us-east-1', rules=self.rules)
+        self.assertEqual(connection.calls, [('DeleteSecurityGroup', {'GroupId': 'sg-1'})])
+
+    def test_dry_run(self):
+        """A dry run only asks AWS whether the changes would succeed."""
+        connection = FakeConnection()
+        self.provisioner.dry_run = True
+        self.provisioner.ec2_connect = lambda *args: connection
+        self.provisioner.find_security_group = lambda *args: None
+
+        self.provisioner.up('group', group_name='group', region='us-east-1', rules=self.rules)
+        self.assertEqual(connection.calls, [('CreateSecurityGroup', {'GroupName': 'group', 'DryRun': True})])
+
+        connection.calls = []
+        self.provisioner.find_security_group = lambda *args: self.group
+        self.provisioner.up('group', group_name='group', region='us-east-1', rules=self.rules)
+        self.assertEqual([(action, params['DryRun']) for action, params in connection.calls],
+                         [('AuthorizeSecurityGroupIngress', 'true')])
+
+        connection.calls = []
+        self.provisioner.down('group', group_name='group', region='us-east-1', rules=self.rules)
+        self.assertEqual(connection.calls, [('DeleteSecurityGroup', {'GroupId': 'sg-1'})])
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.utils.session_pool`."""
+
+import unittest
+
+from pycloud.core.provisioners.utils.session_pool import SSHSessionPool
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        pass
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+        self.transport.active = False
+
+
+class TestSSHSessionPool(unittest.TestCase):
+    """Tests for `SSHSessionPool`."""
+
+    def test_reuses_live_sessions(self):
+        """A second request for the same key reuses the client."""
+        pool = SSHSessionPool()
+        key = ('host', 22, 'ubuntu', '/tmp/key.pem')
+
+        with pool.session(key, FakeClient) as first:
+            pass
+        with pool.session(key, FakeClient) as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(pool.stats['hits'], 1)
+        self.assertEqual(pool.stats['misses'], 1)
+
+    def test_replaces_dead_sessions(self):
+        """A session whose transport died is replaced."""
+        pool = SSHSessionPool()
+        key = ('host', 22, 'ubuntu', '/tmp/key.pem')
+
+        with pool.session(key, FakeClient) as first:
+            first.transport.active = False
+        with pool.session(key, FakeClient) as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.assertEqual(pool.stats['misses'], 2)
+
+    def test_lru_eviction(self):
+        """The least recently used session is closed when the pool is full."""
+        pool = SSHSessionPool(max_size=2)
+
+        for host in ['a', 'b', 'a', 'c']:
+            with pool.session((host, 22, 'ubuntu', 'k'), FakeClient) as client:
+                if host == 'a':
+                    a = client
+
+        self.assertFalse(a.closed)
+        self.assertEqual(pool.stats['evictions'], 1)
+        self.assertEqual(pool.stats['open'], 2)
+
+    def test_idle_eviction_and_close_all(self):
+        """Idle sessions are closed, and close_all() closes the rest."""
+        pool = SSHSessionPool(idle_timeout=-1)
+        with pool.session(('a', 22, 'ubuntu', 'k'), FakeClient) as a:
+            pass
+        with pool.session(('b', 22, 'ubuntu', 'k'), FakeClient) as b:
+            pass
+        self.assertTrue(a.closed)
+
+        pool.close_all()
+        self.assertTrue(b.closed)
+        self.assertEqual(pool.stats['open'], 0)
+
+    def test_sessions_in_use_are_not_evicted(self):
+        """Sessions are only closed once no thread is using them."""
+        pool = SSHSessionPool(max_size=1, idle_timeout=-1)
+        key = ('a', 22, 'ubuntu', 'k')
+
+        held = pool.get(key, FakeClient)
+        with pool.session(('b', 22, 'ubuntu', 'k'), FakeClient) as b:
+            # 'a' is idle for longer than the timeout and over the size
+            # limit, but still in use
+            self.assertFalse(held.closed)
+            self.assertEqual(pool.stats['open'], 2)
+        self.assertFalse(held.closed)
+        self.assertTrue(b.closed)
+
+        pool.release(key, held)
+        pool.get(('c', 22, 'ubuntu', 'k'), FakeClient)
+        self.assertTrue(held.closed)
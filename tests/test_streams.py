@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.utils.streams`, and streaming outputs between tasks."""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pycloud.core.config import PyCloudConfig
+from pycloud.core.provisioners.base import BaseProvisioner
+from pycloud.core.provisioners.plan_executor import PlanExecutor
+from pycloud.core.provisioners.utils.streams import OutputStream
+from pycloud.core.registry import Registry
+from pycloud.core.state import JournalStateBackend
+
+
+class StreamingProducer(BaseProvisioner):
+
+    name = 'Streaming Producer'
+
+    description = 'A provisioner that streams items, and waits for them to be consumed.'
+
+    slug = 'stream_producer'
+
+    required_args = ['instance_id_ref', 'items']
+
+    optional_args = ['fail']
+
+    provides_args = ['instance_id_ref']
+
+    stream_outputs = ['instance_id_ref']
+
+    def up(self, name, instance_id_ref=None, items=None, fail=None, **kwargs):
+
+        stream = self.output_streams.get('instance_id_ref')
+        for item in items:
+            stream.put(item)
+            # only returns once the consumer got the item, so it must be
+            # running alongside this task
+            if not StreamingConsumer.consumed[item].wait(5):
+                raise RuntimeError('%s was not consumed' % item)
+        if fail:
+            raise ValueError('producer failed')
+        self.config.set(instance_id_ref, items)
+
+
+class StreamingConsumer(BaseProvisioner):
+
+    name = 'Streaming Consumer'
+
+    description = 'A provisioner that consumes the items streamed to it.'
+
+    slug = 'stream_consumer'
+
+    required_args = ['instance_id_ref']
+
+    stream_inputs = ['instance_id_ref']
+
+    consumed = {}
+
+    def up(self, name, instance_id_ref=None, **kwargs):
+
+        for item in self.input_streams['instance_id_ref']:
+            StreamingConsumer.consumed[item].set()
+
+Registry.register_provisioner(StreamingProducer)
+Registry.register_provisioner(StreamingConsumer)
+
+PLAN = '''
+---
+tasks:
+    - stream_producer:
+        name: producer
+        instance_id_ref: $items
+        items: [a, b]
+        fail: %s
+    - stream_consumer:
+        name: consumer
+        instance_id_ref: $items
+'''
+
+
+class FailingCheckpoints(object):
+    """A checkpoint journal that can not record the start of the producer."""
+
+    def record(self, key, action, status, **kwargs):
+        if key == 'producer':
+            raise IOError('journal is not writable')
+
+
+class TestOutputStream(unittest.TestCase):
+    """Tests for `OutputStream`."""
+
+    def test_consumers_get_every_item(self):
+        """Every consumer iterates over all the items, until the stream closes."""
+        stream = OutputStream('items')
+        results = []
+
+        def consume():
+            results.append(list(stream))
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        stream.put(1)
+        stream.put(2)
+        stream.close()
+        consumer.join(5)
+
+        self.assertEqual(results, [[1, 2]])
+        self.assertEqual(list(stream), [1, 2])
+        with self.assertRaises(ValueError):
+            stream.put(3)
+
+    def test_failure(self):
+        """Consumers of a failed stream raise after the items put before."""
+        stream = OutputStream('items')
+        stream.put(1)
+        stream.fail(ValueError('boom'))
+
+        items = []
+        with self.assertRaises(RuntimeError):
+            for item in stream:
+                items.append(item)
+        self.assertEqual(items, [1])
+
+        # a closed stream can no longer fail
+        stream = OutputStream('items')
+        stream.close()
+        stream.fail(ValueError('boom'))
+        self.assertEqual(list(stream), [])
+
+
+class TestStreamingTasks(unittest.TestCase):
+    """Tests for streaming outputs between the tasks of a plan."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.plan_path = os.path.join(self.temp_dir, 'plan.yml')
+        os.environ['PYCLOUD_PLAN_CACHE'] = '0'
+        PyCloudConfig.use_backend(JournalStateBackend(os.path.join(self.temp_dir, 'state.journal')))
+        StreamingConsumer.consumed = {'a': threading.Event(), 'b': threading.Event()}
+
+    def tearDown(self):
+
+        del os.environ['PYCLOUD_PLAN_CACHE']
+        PyCloudConfig.use_backend(None)
+        shutil.rmtree(self.temp_dir)
+
+    def executor(self, fail):
+
+        with open(self.plan_path, 'w') as f:
+            f.write(PLAN % fail)
+        executor = PlanExecutor(self.plan_path)
+        executor.checkpoints = None
+        executor.fingerprints = None
+        executor.report_dir = None
+        return executor
+
+    def test_consumer_runs_alongside_producer(self):
+        """With several jobs, a consumer gets each item while the producer runs."""
+        self.executor(fail='false').setup(jobs=2)
+
+        self.assertTrue(StreamingConsumer.consumed['b'].is_set())
+        self.assertEqual(PyCloudConfig().get('$items'), ['a', 'b'])
+
+    def test_producer_failure_fails_consumer(self):
+        """When the producer fails, the consumer fails with it."""
+        # whichever of the two is reported first
+        with self.assertRaises((ValueError, RuntimeError)):
+            self.executor(fail='true').setup(jobs=2)
+
+    def test_producer_stopped_before_its_action(self):
+        """A producer failing before its action runs still ends its streams."""
+        executor = self.executor(fail='false')
+        executor.checkpoints = FailingCheckpoints()
+        errors = []
+
+        def run():
+            try:
+                executor.setup(jobs=2)
+            except Exception as e:
+                errors.append(e)
+
+        runner = threading.Thread(target=run)
+        runner.daemon = True
+        runner.start()
+        runner.join(10)
+
+        self.assertFalse(runner.is_alive())
+        self.assertEqual(len(errors), 1)
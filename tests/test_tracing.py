@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.tracing`."""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pycloud.core.config import PyCloudConfig
+from pycloud.core.provisioners.plan_executor import PlanExecutor
+from pycloud.core.state import JournalStateBackend
+from pycloud.core.timer import TimeContext
+from pycloud.core.tracing import SpanTracer, Tracer
+
+PLAN = '''
+---
+tasks:
+    - debug:
+        name: first
+        echo: one
+    - debug:
+        name: second
+        echo: two
+'''
+
+
+class TestSpanTracer(unittest.TestCase):
+    """Tests for `SpanTracer`."""
+
+    def setUp(self):
+
+        self.tracer = SpanTracer()
+        self.tracer.enable()
+
+    def test_nested_spans(self):
+        """Spans are nested in the span current on their thread, or in the given parent."""
+        with self.tracer.span('plan', category='plan') as plan:
+            with self.tracer.span('task', category='task', slug='debug') as task:
+                task.set(done=True)
+
+            def host():
+                with self.tracer.span('host', category='host', parent=plan):
+                    pass
+
+            worker = threading.Thread(target=host)
+            worker.start()
+            worker.join(5)
+
+        spans = dict((span.name, span) for span in self.tracer.spans)
+        self.assertIsNone(spans['plan'].parent)
+        self.assertEqual(spans['task'].parent, spans['plan'].id)
+        self.assertEqual(spans['host'].parent, spans['plan'].id)
+        self.assertEqual(spans['task'].attributes, {'slug': 'debug', 'done': True})
+        self.assertNotEqual(spans['host'].thread_id, spans['plan'].thread_id)
+        self.assertIsNone(self.tracer.current())
+
+    def test_errors_are_recorded(self):
+        """A span that raised records the error."""
+        with self.assertRaises(ValueError):
+            with self.tracer.span('failing'):
+                raise ValueError('boom')
+        self.assertEqual(self.tracer.spans[0].attributes['error'], 'ValueError: boom')
+
+    def test_disabled(self):
+        """Nothing is recorded while tracing is off."""
+        self.tracer.disable()
+        with self.tracer.span('ignored') as span:
+            span.set(size=1)
+        self.assertEqual(self.tracer.spans, [])
+
+    def test_chrome_trace(self):
+        """Spans are exported as complete events, in microseconds."""
+        with self.tracer.span('outer', category='plan'):
+            with self.tracer.span('inner', category='task'):
+                pass
+
+        events = self.tracer.to_chrome_trace()['traceEvents']
+        self.assertEqual([event['name'] for event in events], ['outer', 'inner'])
+        self.assertTrue(all(event['ph'] == 'X' for event in events))
+        self.assertEqual(events[0]['ts'], 0)
+        self.assertGreaterEqual(events[0]['dur'], events[1]['dur'])
+        self.assertEqual(events[1]['args']['parent_id'], events[0]['args']['span_id'])
+
+
+class TestPlanTracing(unittest.TestCase):
+    """Tests for the spans recorded while running a plan."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.plan_path = os.path.join(self.temp_dir, 'plan.yml')
+        with open(self.plan_path, 'w') as f:
+            f.write(PLAN)
+        os.environ['PYCLOUD_PLAN_CACHE'] = '0'
+        PyCloudConfig.use_backend(JournalStateBackend(os.path.join(self.temp_dir, 'state.journal')))
+        Tracer.enable()
+
+    def tearDown(self):
+
+        Tracer.disable()
+        del os.environ['PYCLOUD_PLAN_CACHE']
+        PyCloudConfig.use_backend(None)
+        shutil.rmtree(self.temp_dir)
+
+    def test_tasks_are_nested_in_the_plan(self):
+        """Every task gets a span in the plan's span, and the trace is written as JSON."""
+        executor = PlanExecutor(self.plan_path)
+        executor.checkpoints = None
+        executor.fingerprints = None
+        executor.report_dir = None
+        executor.setup(jobs=2)
+
+        spans = Tracer.spans
+        plan = [span for span in spans if span.category == 'plan'][0]
+        tasks = [span for span in spans if span.category == 'task']
+        self.assertEqual(sorted(span.name for span in tasks), ['first', 'second'])
+        self.assertTrue(all(span.parent == plan.id for span in tasks))
+
+        trace_path = os.path.join(self.temp_dir, 'trace.json')
+        Tracer.export(trace_path)
+        with open(trace_path) as f:
+            self.assertEqual(len(json.load(f)['traceEvents']), len(spans))
+
+
+class TestTimeContext(unittest.TestCase):
+    """Tests for `TimeContext`."""
+
+    def test_sec_to_time(self):
+        """Durations over an hour keep their hours."""
+        self.assertEqual(TimeContext('x').sec_to_time(3725), (1, 2, 5))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.utils.transfers`."""
+
+import grp
+import os
+import pwd
+import shutil
+import stat
+import tempfile
+import unittest
+
+from pycloud.core.metrics import Metrics
+from pycloud.core.provisioners.utils.transfers import FileTransfer
+from tests.fakes import FakeClient
+
+
+class LocalFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.pipelined = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+    def chmod(self, mode):
+        os.chmod(self.path, mode)
+
+    def set_pipelined(self, pipelined):
+        self.pipelined = pipelined
+
+    def write(self, data):
+        self.file.write(data)
+
+
+class LocalSFTP(object):
+
+    def __init__(self):
+        self.files = []
+
+    def open(self, path, mode):
+        self.files.append(LocalFile(path))
+        return self.files[-1]
+
+    def remove(self, path):
+        os.remove(path)
+
+    def close(self):
+        pass
+
+
+class LocalTransfer(FileTransfer):
+
+    # the local user plays root
+    SUDO = ''
+
+    def __init__(self, staging_dir):
+        super(LocalTransfer, self).__init__(FakeClient(), 'localhost')
+        self.STAGING_DIR = staging_dir
+        self.sftp = LocalSFTP()
+
+    def open_sftp(self, size):
+        return self.sftp
+
+
+class TestFileTransfer(unittest.TestCase):
+    """Tests for `FileTransfer`, against the local host."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.staging_dir = os.path.join(self.temp_dir, 'staging')
+        os.mkdir(self.staging_dir)
+        self.source = os.path.join(self.temp_dir, 'source')
+        with open(self.source, 'wb') as f:
+            f.write(os.urandom(300 * 1024))
+        self.transfer = LocalTransfer(self.staging_dir)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.temp_dir)
+
+    def assertCopied(self, destination):
+
+        with open(self.source, 'rb') as expected, open(destination, 'rb') as copied:
+            self.assertEqual(expected.read(), copied.read())
+
+    def test_direct_transfer(self):
+        """Writable destinations are written directly, with pipelined writes."""
+        destination = os.path.join(self.temp_dir, 'destination')
+        result = self.transfer.put(self.source, destination, mode=0o640)
+
+        self.assertFalse(result.skipped or result.staged)
+        self.assertCopied(destination)
+        self.assertEqual(stat.S_IMODE(os.stat(destination).st_mode), 0o640)
+        self.assertTrue(self.transfer.sftp.files[0].pipelined)
+        self.assertEqual(len(self.transfer.client.commands), 1)
+
+    def test_transfers_are_counted(self):
+        """Transfers are counted by how they went, along with the bytes they sent."""
+        Metrics.reset()
+        destination = os.path.join(self.temp_dir, 'destination')
+        self.transfer.put(self.source, destination)
+        self.transfer.put(self.source, destination)
+
+        transfers = Metrics.get('pycloud_sftp_transfers_total')
+        self.assertEqual(transfers.get(result='direct'), 1)
+        self.assertEqual(transfers.get(result='skipped'), 1)
+        self.assertEqual(Metrics.get('pycloud_sftp_bytes_total').total, 300 * 1024)
+
+    def test_identical_files_are_skipped(self):
+        """A destination with the same size and digest is left alone."""
+        destination = os.path.join(self.temp_dir, 'destination')
+        shutil.copy(self.source, destination)
+
+        result = self.transfer.put(self.source, destination)
+        self.assertTrue(result.skipped)
+        self.assertEqual(self.transfer.sftp.files, [])
+
+        with open(destination, 'ab') as f:
+            f.write(b'changed')
+        self.assertFalse(self.transfer.put(self.source, destination).skipped)
+        self.assertCopied(destination)
+
+    def test_attributes_of_identical_files(self):
+        """An identical destination only gets its mode and owner fixed, in one command."""
+        destination = os.path.join(self.temp_dir, 'destination')
+        shutil.copy(self.source, destination)
+        os.chmod(destination, 0o644)
+        owner = '%s:%s' % (pwd.getpwuid(os.getuid()).pw_name, grp.getgrgid(os.getgid()).gr_name)
+
+        result = self.transfer.put(self.source, destination, mode=0o644, owner=owner)
+        self.assertTrue(result.skipped)
+        self.assertFalse(result.updated)
+        self.assertEqual(len(self.transfer.client.commands), 1)
+
+        result = self.transfer.put(self.source, destination, mode=0o400, owner=owner)
+        self.assertTrue(result.skipped and result.updated)
+        self.assertEqual(self.transfer.sftp.files, [])
+        self.assertEqual(stat.S_IMODE(os.stat(destination).st_mode), 0o400)
+        self.assertEqual(len(self.transfer.client.commands), 3)
+
+    def test_staged_transfer(self):
+        """With sudo, the file is staged, installed and cleaned up in one command."""
+        destination = os.path.join(self.temp_dir, 'destination')
+        result = self.transfer.put(self.source, destination, mode=0o400, sudo=True)
+
+        self.assertTrue(result.staged)
+        self.assertCopied(destination)
+        self.assertEqual(stat.S_IMODE(os.stat(destination).st_mode), 0o400)
+        self.assertEqual(os.listdir(self.staging_dir), [])
+        self.assertEqual(len(self.transfer.client.commands), 2)
+
+    def test_failed_install_is_cleaned_up(self):
+        """The staged file is removed even when it can not be installed."""
+        destination = os.path.join(self.temp_dir, 'missing', 'destination')
+        with self.assertRaises(IOError):
+            self.transfer.put(self.source, destination, sudo=True)
+        self.assertEqual(os.listdir(self.staging_dir), [])
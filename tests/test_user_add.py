@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `UserAdd` provisioner of `pycloud.core.provisioners.aws.os`."""
+
+import contextlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from pycloud.core.config import PyCloudConfig
+from pycloud.core.provisioners.aws.os import UserAdd
+from pycloud.core.provisioners.plan_executor import PlanExecutor
+from pycloud.core.state import JournalStateBackend
+from tests.fakes import FakeClient, FakeInstance, ScriptedChannel
+
+PLAN = '''
+---
+tasks:
+    - user_add:
+        name: add user
+        instance_id_ref: $instances
+        region: us-east-1
+        key_name: pycloud-test
+        user_name: pycloud
+        public_key: %s
+'''
+
+
+class TestUserAdd(unittest.TestCase):
+    """Tests for `UserAdd`."""
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.plan_path = os.path.join(self.temp_dir, 'plan.yml')
+        os.environ['PYCLOUD_PLAN_CACHE'] = '0'
+        PyCloudConfig.use_backend(JournalStateBackend(os.path.join(self.temp_dir, 'state.journal')))
+        PyCloudConfig().set('$instances', [FakeInstance.id])
+
+        # commands are recorded, and never run
+        self.client = FakeClient(channel=lambda command: ScriptedChannel([]))
+
+        @contextlib.contextmanager
+        def ssh_client(provisioner, *args, **kwargs):
+            yield self.client
+
+        self.patches = [
+            mock.patch.object(UserAdd, 'ssh_client', ssh_client),
+            mock.patch.object(UserAdd, 'ec2_connect', lambda *args: None),
+            mock.patch.object(UserAdd, 'find_instances', lambda *args: [FakeInstance()]),
+            mock.patch.object(UserAdd, 'wait_for_ssh', lambda *args, **kwargs: None),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+
+        for patch in self.patches:
+            patch.stop()
+        del os.environ['PYCLOUD_PLAN_CACHE']
+        PyCloudConfig.use_backend(None)
+        shutil.rmtree(self.temp_dir)
+
+    def executor(self):
+
+        public_key = os.path.join(self.temp_dir, 'id_rsa.pub')
+        with open(public_key, 'w') as f:
+            f.write('ssh-rsa AAAA pycloud\n')
+        with open(self.plan_path, 'w') as f:
+            f.write(PLAN % public_key)
+        executor = PlanExecutor(self.plan_path)
+        executor.checkpoints = None
+        executor.fingerprints = None
+        executor.report_dir = None
+        return executor
+
+    def test_dry_teardown_does_not_touch_the_hosts(self):
+        """A dry-run teardown sends no command to the instances."""
+        self.executor().dry_teardown()
+
+        self.assertEqual(self.client.commands, [])
+        self.assertEqual(PyCloudConfig().get('$instances'), [FakeInstance.id])
+
+    def test_setup_is_one_round_trip(self):
+        """The user and its public key are set up with a single command."""
+        self.executor().setup()
+
+        self.assertEqual(self.client.commands, ['bash -s'])
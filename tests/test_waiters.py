@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pycloud.core.provisioners.utils.waiters`."""
+
+import unittest
+
+from boto.exception import EC2ResponseError
+
+from pycloud.core.errors import WaiterTimeoutError
+from pycloud.core.provisioners.utils.waiters import InstanceWaiter
+
+
+class FakeInstance(object):
+
+    def __init__(self, instance_id, states):
+        self.id = instance_id
+        self.states = list(states)
+
+    @property
+    def state(self):
+        return self.states[0]
+
+    def advance(self):
+        if len(self.states) > 1:
+            self.states.pop(0)
+
+
+def not_found(message):
+
+    return EC2ResponseError(400, 'Bad Request', '<?xml version="1.0" encoding="UTF-8"?><Response><Errors><Error>'
+                            '<Code>InvalidInstanceID.NotFound</Code><Message>%s</Message></Error></Errors>'
+                            '</Response>' % message)
+
+
+class FakeConnection(object):
+
+    def __init__(self, instances, name_missing=True):
+        self.instances = dict((i.id, i) for i in instances)
+        self.name_missing = name_missing
+        self.calls = []
+
+    def get_only_instances(self, instance_ids=None):
+        self.calls.append(list(instance_ids))
+        missing = [i for i in instance_ids if i not in self.instances]
+        if missing:
+            raise not_found("The instance IDs '%s' do not exist" % ', '.join(missing) if self.name_missing
+                            else 'Some instance IDs do not exist')
+        found = [self.instances[i] for i in instance_ids]
+        for instance in found:
+            instance.advance()
+        return found
+
+
+class TestInstanceWaiter(unittest.TestCase):
+    """Tests for `InstanceWaiter`."""
+
+    def test_one_call_per_round(self):
+        """Every round describes all pending instances in one call."""
+        connection = FakeConnection([
+            FakeInstance('i-1', ['pending', 'running']),
+            FakeInstance('i-2', ['pending', 'pending', 'pending', 'running']),
+            FakeInstance('i-3', ['pending', 'pending', 'running']),
+        ])
+        waiter = InstanceWaiter(connection, initial_delay=0, max_delay=0)
+
+        ready = waiter.wait(['i-1', 'i-2', 'i-3'])
+
+        self.assertEqual(sorted(ready.keys()), ['i-1', 'i-2', 'i-3'])
+        self.assertEqual(connection.calls, [['i-1', 'i-2', 'i-3'], ['i-2', 'i-3'], ['i-2']])
+
+    def test_deadline(self):
+        """Instances that never become ready time out."""
+        connection = FakeConnection([FakeInstance('i-1', ['pending'])])
+        waiter = InstanceWaiter(connection, initial_delay=0, max_delay=0, timeout=0)
+
+        with self.assertRaises(WaiterTimeoutError):
+            waiter.wait(['i-1'])
+
+    def test_failed_state(self):
+        """An instance that terminates while starting fails the wait."""
+        connection = FakeConnection([FakeInstance('i-1', ['pending', 'terminated'])])
+        waiter = InstanceWaiter(connection, initial_delay=0, max_delay=0)
+
+        with self.assertRaises(RuntimeError):
+            waiter.wait(['i-1'])
+
+    def test_missing_instance_does_not_hide_the_others(self):
+        """An id EC2 never finds times out alone, while the others become ready."""
+        for name_missing in [True, False]:
+            connection = FakeConnection([
+                FakeInstance('i-1', ['pending', 'running']),
+                FakeInstance('i-3', ['pending', 'pending', 'running']),
+            ], name_missing=name_missing)
+            waiter = InstanceWaiter(connection, initial_delay=0, max_delay=0, timeout=0.2)
+            ready = []
+
+            with self.assertRaises(WaiterTimeoutError) as context:
+                waiter.wait(['i-1', 'i-2', 'i-3'], on_ready=lambda instance: ready.append(instance.id))
+
+            self.assertEqual(sorted(ready), ['i-1', 'i-3'])
+            self.assertEqual(context.exception.pending, ['i-2'])
+
+    def test_purged_instance_is_terminated(self):
+        """Waiting for 'terminated' is done for ids EC2 no longer knows about."""
+        connection = FakeConnection([FakeInstance('i-1', ['shutting-down', 'shutting-down', 'terminated'])])
+        waiter = InstanceWaiter(connection, initial_delay=0, max_delay=0, timeout=1)
+
+        ready = waiter.wait(['i-1', 'i-2'], state='terminated')
+
+        self.assertEqual(list(ready.keys()), ['i-1'])
+        self.assertEqual(connection.calls, [['i-1', 'i-2'], ['i-1'], ['i-1']])